@@ -0,0 +1,326 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from contextlib import contextmanager
+
+from flask import current_app
+
+# Priorities of signing work, lower goes first
+interactive = 0
+bulk = 1
+
+priority_names = {interactive: "interactive", bulk: "bulk"}
+
+class OverloadedException(Exception):
+  """
+  Raised when signing work isn't admitted
+
+  :param status:
+    429 when over the rate of the CA or role, 503 when its queue is full or the wait timed out
+
+  :param retry_after:
+    Seconds after which the request is likely to be admitted
+  """
+  def __init__(self, message, status, retry_after):
+    super().__init__(message)
+    self.status = status
+    self.retry_after = max(1, math.ceil(retry_after))
+
+  def response(self):
+    return str(self), self.status, {"Retry-After": str(self.retry_after)}
+
+class TokenBucket():
+  """
+  Token bucket rate limit
+  """
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = max(1.0, float(burst))
+
+    self._tokens = self.burst
+    self._updated = time.monotonic()
+
+  def _refill(self, now):
+    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def available(self, cost=1):
+    """
+    Check if there are enough tokens
+
+    :return:
+      0 if there are, otherwise the seconds until there will be enough
+    """
+    self._refill(time.monotonic())
+
+    return max(0, (cost - self._tokens) / self.rate)
+
+  def take(self, cost=1):
+    """
+    Take tokens, once checked they are available
+    """
+    self._tokens -= cost
+
+  def reserve(self, cost=1):
+    """
+    Take tokens, going into debt if there aren't enough
+
+    :return:
+      The seconds to wait until the tokens are covered
+    """
+    self._refill(time.monotonic())
+    self._tokens -= cost
+
+    return max(0, -self._tokens / self.rate)
+
+class Limiter():
+  """
+  Concurrency limit, with the waiting work admitted in order of priority
+
+  A released slot is handed to the first waiter directly, so waiting work is never overtaken.
+  """
+  def __init__(self, limit, queue_size):
+    self.limit = int(limit)
+    self.queue_size = int(queue_size)
+
+    self.active = 0
+    self._waiters = []
+    self._seq = itertools.count()
+    self._hold = 0.05 # Average seconds a slot is held, for the Retry-After estimate
+
+  def depth(self):
+    return len(self._waiters)
+
+  def retry_after(self):
+    return (len(self._waiters) + 1) * self._hold / self.limit
+
+  def acquire(self, lock, priority, timeout):
+    """
+    Take a slot, waiting for one if all are in use
+
+    :param lock:
+      The admission control lock, held by the caller and released while waiting
+
+    :param timeout:
+      Seconds to wait at most, None to wait until a slot is free
+
+    :return:
+      True if a slot was taken, False if the wait timed out
+    """
+    if self.active < self.limit:
+      self.active += 1
+      return True
+
+    waiter = [priority, next(self._seq), threading.Condition(lock), False]
+    heapq.heappush(self._waiters, waiter)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not waiter[3]:
+      remaining = None if deadline is None else deadline - time.monotonic()
+      if remaining is not None and remaining <= 0:
+        self._waiters.remove(waiter)
+        heapq.heapify(self._waiters)
+        return False
+
+      waiter[2].wait(remaining)
+
+    return True
+
+  def release(self, held):
+    """
+    Release a slot, handing it to the first waiter
+
+    :param held:
+      Seconds the slot was held, None if the work never ran
+    """
+    if held is not None:
+      self._hold = 0.9 * self._hold + 0.1 * held
+
+    if self._waiters:
+      waiter = heapq.heappop(self._waiters)
+      waiter[3] = True
+      waiter[2].notify()
+    else:
+      self.active -= 1
+
+class AdmissionControl():
+  """
+  Admission control for signing work
+
+  Signing work holds a slot of its role, and of its CA, for as long as it runs. There are
+  ADMISSION_ROLE_CONCURRENCY slots per role and ADMISSION_CA_CONCURRENCY per CA; client
+  certificates count against their client role instead of a CA role. When all slots are in
+  use, work waits for one in order of priority, interactive requests before batch items,
+  so a bulk rollover can't starve single requests. Reads aren't admission controlled at all.
+
+  The rate of each CA and role can be limited with token buckets, see ADMISSION_CA_RATE
+  and ADMISSION_ROLE_RATE.
+
+  Single requests are rejected straight away when over the rate, with a 429, or when the
+  queue is full, with a 503. One waiting longer than ADMISSION_QUEUE_TIMEOUT is rejected
+  with a 503. Both carry a Retry-After. Batch items are never rejected, they wait for their
+  turn and are paced to the rate instead; the batch as a whole is rejected up front if the
+  CA or role is already over its rate or queue.
+  """
+  def __init__(self, app):
+    self.app = app
+    self.ca_concurrency = int(app.config["ADMISSION_CA_CONCURRENCY"])
+    self.role_concurrency = int(app.config["ADMISSION_ROLE_CONCURRENCY"])
+    self.ca_rate = float(app.config["ADMISSION_CA_RATE"])
+    self.role_rate = float(app.config["ADMISSION_ROLE_RATE"])
+    self.ca_burst = float(app.config["ADMISSION_CA_BURST"] or self.ca_rate)
+    self.role_burst = float(app.config["ADMISSION_ROLE_BURST"] or self.role_rate)
+    self.queue_size = int(app.config["ADMISSION_QUEUE_SIZE"])
+    self.queue_timeout = float(app.config["ADMISSION_QUEUE_TIMEOUT"]) / 1000
+
+    self._limiters = {}
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+    app.metrics.describe("certmanager_admission_queue_depth", "gauge", "Signing work waiting for a slot, by CA or role")
+    app.metrics.describe("certmanager_admission_active", "gauge", "Signing work holding a slot, by CA or role")
+    app.metrics.describe("certmanager_admission_wait_seconds", "histogram", "Time signing work waited to be admitted, by priority")
+    app.metrics.describe("certmanager_admission_rejected_total", "counter", "Signing requests rejected by admission control, by reason")
+
+    app.metrics.gauge("certmanager_admission_queue_depth", lambda: self._gauge(Limiter.depth))
+    app.metrics.gauge("certmanager_admission_active", lambda: self._gauge(lambda limiter: limiter.active))
+
+  def _gauge(self, value):
+    with self._lock:
+      return [({"scope": key[0], "name": "/".join(key[1:])}, value(limiter)) for key, limiter in self._limiters.items()]
+
+  def _keys(self, ca, role, client=None):
+    role_key = ("client", client, role) if client else ("role", ca, role)
+    return [
+      (role_key, self.role_concurrency, self.role_rate, self.role_burst),
+      (("ca", ca), self.ca_concurrency, self.ca_rate, self.ca_burst)
+    ]
+
+  def _limiter(self, key, limit):
+    if limit <= 0:
+      return None
+
+    limiter = self._limiters.get(key)
+    if limiter is None:
+      limiter = self._limiters[key] = Limiter(limit, self.queue_size)
+
+    return limiter
+
+  def _bucket(self, key, rate, burst):
+    if rate <= 0:
+      return None
+
+    bucket = self._buckets.get(key)
+    if bucket is None:
+      bucket = self._buckets[key] = TokenBucket(rate, burst)
+
+    return bucket
+
+  def _reject(self, reason, message, status, retry_after):
+    self.app.metrics.inc("certmanager_admission_rejected_total", reason=reason)
+    raise OverloadedException(message, status, retry_after)
+
+  def check(self, ca, role, client=None):
+    """
+    Check signing work can be admitted, before any of it is done, e.g. the items of a batch
+    or the deduplication of a signing request
+
+    :raises OverloadedException:
+      If the CA or role is over its rate or its queue is full
+    """
+    with self._lock:
+      for key, limit, rate, burst in self._keys(ca, role, client):
+        self._check_rate(key, self._bucket(key, rate, burst))
+        self._check_queue(key, self._limiter(key, limit))
+
+  def _check_rate(self, key, bucket):
+    wait = bucket.available() if bucket else 0
+    if wait:
+      self._reject("rate", f"{'/'.join(key[1:])} is over its signing rate", 429, wait)
+
+  def _check_queue(self, key, limiter):
+    if limiter and limiter.queue_size > 0 and limiter.active >= limiter.limit and limiter.depth() >= limiter.queue_size:
+      self._reject("queue_full", f"Too much signing work queued for {'/'.join(key[1:])}", 503, limiter.retry_after())
+
+  @contextmanager
+  def admit(self, ca, role, client=None, priority=interactive):
+    """
+    Admit signing work, holding its slots until the block exits
+
+    :param ca:
+      The signing CA
+
+    :param role:
+      The role, or the client role for client certificates
+
+    :param client:
+      The client, for client certificates
+
+    :param priority:
+      interactive for single requests, which are rejected when overloaded, or bulk for batch items, which wait
+
+    :raises OverloadedException:
+      If interactive work isn't admitted
+    """
+    start = time.monotonic()
+    keys = self._keys(ca, role, client)
+    held = []
+    admitted = None
+
+    try:
+      delay = 0
+      with self._lock:
+        buckets = [(key, self._bucket(key, rate, burst)) for key, limit, rate, burst in keys]
+        buckets = [(key, bucket) for key, bucket in buckets if bucket]
+
+        if priority == bulk:
+          delay = max([0] + [bucket.reserve() for _, bucket in buckets])
+        else:
+          for key, bucket in buckets:
+            self._check_rate(key, bucket)
+          for _, bucket in buckets:
+            bucket.take()
+
+      # Batch items are paced to the rate
+      if delay:
+        time.sleep(delay)
+
+      with self._lock:
+        # Take the role slot first, so waiting for a busy role never holds a CA slot
+        for key, limit, rate, burst in keys:
+          limiter = self._limiter(key, limit)
+          if limiter is None:
+            continue
+
+          if priority != bulk:
+            self._check_queue(key, limiter)
+
+          if not limiter.acquire(self._lock, priority, None if priority == bulk else self.queue_timeout):
+            self._reject("timeout", f"Timed out waiting to sign with {'/'.join(key[1:])}", 503, limiter.retry_after())
+
+          held.append(limiter)
+
+      admitted = time.monotonic()
+      self.app.metrics.observe("certmanager_admission_wait_seconds", admitted - start, priority=priority_names[priority])
+
+      yield
+    finally:
+      if held:
+        elapsed = time.monotonic() - admitted if admitted else None
+        with self._lock:
+          for limiter in reversed(held):
+            limiter.release(elapsed)
+
+@contextmanager
+def admit(ca, role, client=None, priority=interactive):
+  """
+  Admit signing work through the admission control of the current app
+  """
+  with current_app.admission.admit(ca, role, client, priority):
+    yield
+
+def check(ca, role, client=None):
+  current_app.admission.check(ca, role, client)
@@ -0,0 +1,267 @@
+"""
+ASGI deployment mode
+
+  uvicorn --factory asgi:create_app --app-dir /usr/local/app/python --port 8080
+
+Requests are accepted on the event loop, so a single process can hold many requests in flight.
+The read operations with an async variant (ca.get_chain, ca.get_cert and cert.info) are answered
+on the event loop, with the storage reads offloaded through the async storage managers.
+They are passed the If-None-Match ETags of the request, and answer matching requests with a 304.
+Every other request runs through the WSGI app, with reads and writes on separate thread pools,
+so reads never queue behind signing. Signing itself can be moved off the request threads
+entirely with SIGNING_WORKERS.
+
+When running several uvicorn workers, set WORKERS to their number, so they pass their
+changes to each other through the invalidation log.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags
+
+from manager.aio import AsyncManager
+
+import ca
+import cert
+
+# Operations answered on the event loop, by operationId
+async_operations = {
+  "ca.get_chain": ca.get_chain_async,
+  "ca.get_cert": ca.get_cert_async,
+  "cert.info": cert.info_async
+}
+
+def _environ(scope, body):
+  """
+  Construct the WSGI environ of an ASGI HTTP request
+  """
+  server = scope.get("server") or ("localhost", 80)
+
+  environ = {
+    "REQUEST_METHOD": scope["method"],
+    "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin-1"),
+    "PATH_INFO": scope["path"].encode("utf8").decode("latin-1"),
+    "QUERY_STRING": scope["query_string"].decode("latin-1"),
+    "SERVER_NAME": server[0],
+    "SERVER_PORT": str(server[1]),
+    "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+    "CONTENT_LENGTH": str(len(body)),
+    "wsgi.version": (1, 0),
+    "wsgi.url_scheme": scope.get("scheme", "http"),
+    "wsgi.input": io.BytesIO(body),
+    "wsgi.errors": sys.stderr,
+    "wsgi.multithread": True,
+    "wsgi.multiprocess": False,
+    "wsgi.run_once": False
+  }
+
+  if scope.get("client"):
+    environ["REMOTE_ADDR"] = scope["client"][0]
+
+  for name, value in scope["headers"]:
+    name = name.decode("latin-1")
+    value = value.decode("latin-1")
+
+    if name == "content-type":
+      environ["CONTENT_TYPE"] = value
+    elif name != "content-length":
+      key = "HTTP_" + name.upper().replace("-", "_")
+      environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+  return environ
+
+async def _read_body(receive):
+  body = []
+
+  while True:
+    message = await receive()
+    body.append(message.get("body", b""))
+
+    if not message.get("more_body"):
+      return b"".join(body)
+
+async def _send_response(send, status, content_type, body, headers=None):
+  await send({
+    "type": "http.response.start",
+    "status": status,
+    "headers": [
+      (b"content-type", content_type.encode("latin-1")),
+      (b"content-length", str(len(body)).encode("latin-1")),
+      *((name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items())
+    ]
+  })
+  await send({"type": "http.response.body", "body": body})
+
+class ASGIApp():
+  """
+  ASGI application serving the Flask app
+  """
+  def __init__(self, app):
+    self.app = app
+
+    self.read_executor = ThreadPoolExecutor(int(app.config["ASGI_READ_WORKERS"]), thread_name_prefix="asgi-read")
+    self.write_executor = ThreadPoolExecutor(int(app.config["ASGI_WRITE_WORKERS"]), thread_name_prefix="asgi-write")
+    self.io_executor = ThreadPoolExecutor(int(app.config["ASGI_IO_WORKERS"]), thread_name_prefix="asgi-io")
+
+    app.async_secretmanager = AsyncManager(app.secretmanager, self.io_executor)
+    app.async_certmanager = AsyncManager(app.certmanager, self.io_executor)
+
+    # Map the endpoints of the async operations to their handlers
+    # Connexion names the endpoints <base path>.<operationId with _ for .>
+    self.async_endpoints = {}
+    for rule in app.url_map.iter_rules():
+      for operation_id, handler in async_operations.items():
+        if rule.endpoint.rsplit(".", 1)[-1] == operation_id.replace(".", "_"):
+          self.async_endpoints[rule.endpoint] = handler
+
+    self.url_adapter = app.url_map.bind("localhost")
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] == "lifespan":
+      await self._lifespan(receive, send)
+    elif scope["type"] == "http":
+      if not await self._async_operation(scope, send):
+        executor = self.read_executor if scope["method"] in ["GET", "HEAD"] else self.write_executor
+        await self._wsgi(scope, receive, send, executor)
+
+  async def _lifespan(self, receive, send):
+    while True:
+      message = await receive()
+
+      if message["type"] == "lifespan.startup":
+        await send({"type": "lifespan.startup.complete"})
+      elif message["type"] == "lifespan.shutdown":
+        for executor in [self.read_executor, self.write_executor, self.io_executor]:
+          executor.shutdown(wait=False)
+
+        await send({"type": "lifespan.shutdown.complete"})
+        return
+
+  async def _async_operation(self, scope, send):
+    """
+    Answer a request on the event loop, if it is for an operation with an async variant
+
+    :return:
+      True if the request was answered
+    """
+    if scope["method"] != "GET":
+      return False
+
+    try:
+      rule, args = self.url_adapter.match(scope["path"], method="GET", return_rule=True)
+    except HTTPException:
+      return False
+
+    handler = self.async_endpoints.get(rule.endpoint)
+    if handler is None:
+      return False
+
+    if_none_match = parse_etags(b",".join(value for name, value in scope["headers"] if name == b"if-none-match").decode("latin-1") or None)
+
+    start = time.perf_counter()
+    headers = None
+    try:
+      # Changes made by other processes are applied first, as the before_request hooks of the Flask app don't run here.
+      # Only checking for them runs on the event loop, applying them reads the log and drops caches on a thread.
+      if self.app.invalidation.pending():
+        await asyncio.get_running_loop().run_in_executor(self.io_executor, self._poll)
+
+      with self.app.app_context():
+        body, status, *headers = await handler(**args, if_none_match=if_none_match)
+        headers = headers[0] if headers else None
+    except Exception as e:
+      self.app.logger.exception(e)
+      body, status = "Internal server error", 500
+
+    if status == 304:
+      await _send_response(send, status, "text/plain; charset=utf-8", b"", headers)
+    elif isinstance(body, str):
+      await _send_response(send, status, "text/plain; charset=utf-8", body.encode("utf8"), headers)
+    else:
+      await _send_response(send, status, "application/json", (json.dumps(body, indent=2) + "\n").encode("utf8"), headers)
+
+    self.app.metrics.inc("certmanager_requests_total", endpoint=rule.rule, method="GET", status=status)
+    self.app.metrics.observe("certmanager_request_seconds", time.perf_counter() - start, endpoint=rule.rule, method="GET")
+
+    return True
+
+  def _poll(self):
+    with self.app.app_context():
+      self.app.invalidation.poll()
+
+  async def _wsgi(self, scope, receive, send, executor):
+    """
+    Run a request through the WSGI app on an executor thread
+
+    The response is passed back to the event loop chunk by chunk, so streamed responses stay streamed.
+    The WSGI iterable is consumed on a single thread, as streamed responses hold the request context.
+    """
+    environ = _environ(scope, await _read_body(receive))
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def _put(item):
+      loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def _run():
+      def start_response(status, headers, exc_info=None):
+        _put(("start", int(status.split(" ", 1)[0]), headers))
+        return lambda data: _put(("body", data))
+
+      try:
+        iterable = self.app(environ, start_response)
+        try:
+          for chunk in iterable:
+            if chunk:
+              _put(("body", chunk))
+        finally:
+          if hasattr(iterable, "close"):
+            iterable.close()
+      finally:
+        _put(("end", None))
+
+    future = loop.run_in_executor(executor, _run)
+
+    started = False
+    while True:
+      kind, *data = await queue.get()
+
+      if kind == "start":
+        status, headers = data
+        await send({
+          "type": "http.response.start",
+          "status": status,
+          "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        })
+        started = True
+      elif kind == "body":
+        await send({"type": "http.response.body", "body": data[0], "more_body": True})
+      else:
+        break
+
+    try:
+      await future
+    except Exception as e:
+      self.app.logger.exception(e)
+      if not started:
+        await _send_response(send, 500, "text/plain; charset=utf-8", b"Internal server error")
+        return
+
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def create_app():
+  """
+  Create the ASGI application
+  """
+  from connexion_flask.main import App
+
+  specification_dir = os.getenv("SPECIFICATION_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+  return ASGIApp(App(specification_dir=specification_dir, run=False).application)
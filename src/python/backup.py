@@ -0,0 +1,366 @@
+"""
+Export and restore the whole PKI state as a single compressed archive
+
+  python -m backup export --secrets-path /secrets --certs-path /certs > backup.tar.gz
+  python -m backup export --since <marker> > incremental.tar.gz
+  python -m backup import < backup.tar.gz
+
+The archive is a gzip compressed tar stream holding the objects of the secret and certificate
+managers, i.e. the CA hierarchy, roles, clients and issued certificates, and the records of
+the inventory. It is written and read member by member, so memory use doesn't grow with the
+number of objects.
+
+The archive holds the private keys of every CA, unencrypted as they are stored, so it must be
+kept as safe as the storage itself. For that reason it is only available through this command,
+run with access to the storage, and never served by the API.
+
+Every export starts with a manifest holding its snapshot marker, which the command prints.
+Exporting with a previous marker only includes the objects written and the inventory records
+added or revoked since, so a full archive followed by its incremental archives, imported in
+order, restores the latest state. Deleted objects aren't tracked, they are left in place when
+restoring an incremental archive.
+
+Importing writes the objects through the batch write path of the storage managers, so an
+archive can be restored into either backend, and overwrites existing objects. The CRL state
+of a CA is the exception, it is only restored if its CRL number is higher than the stored one, so the CRLs
+of a running CA never go backwards. The server processes are told to drop their cached state
+once it is done.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+
+from types import SimpleNamespace
+
+from crl import crl_number_filename, state_filenames as crl_state_filenames
+from idempotency import records_path
+from invalidation import InvalidationLog
+from inventory import Inventory
+from manager.file import FileSecretManager, FileCertificateManager
+from manager.sqlite import SqliteSecretManager, SqliteCertificateManager
+
+# Version of the archive layout
+archive_version = 1
+
+# The first member of every archive
+manifest_name = "manifest.json"
+
+# Seconds the snapshot marker is moved back, so writes in flight while it is taken are exported again next time
+marker_margin = 60
+
+# Objects restored per batch write, and the bytes buffered for one at most
+chunk_size = 256
+chunk_bytes = 4 * 1024 * 1024
+
+# Inventory records per archive member
+inventory_chunk_size = 1000
+
+# Config entries of files kept next to the objects of the file backend, which aren't objects
+_state_files = ["SECRETS_DB", "CERTS_DB", "INVENTORY_DB", "INVALIDATION_LOG", "RENEWAL_LOCK", "CRL_LOCK"]
+
+class InvalidArchiveException(Exception):
+  pass
+
+class _Buffer():
+  """
+  File object collecting the compressed archive, drained after each member
+  """
+  def __init__(self):
+    self._chunks = []
+
+  def write(self, data):
+    self._chunks.append(bytes(data))
+    return len(data)
+
+  def drain(self):
+    data = b"".join(self._chunks)
+    self._chunks = []
+
+    return data
+
+def parse_marker(marker):
+  """
+  Parse a snapshot marker
+
+  :return:
+    Tuple of the timestamp objects were exported up to and the inventory position
+  """
+  try:
+    timestamp, position = marker.split(":")
+    return int(timestamp), int(position)
+  except ValueError:
+    raise InvalidArchiveException(f"Invalid snapshot marker {marker}")
+
+def _skipped_names(config):
+  """
+  Get the names at the top of the storage trees which aren't objects, e.g. the inventory database and its WAL files
+  """
+  names = set()
+  for key in _state_files:
+    if config.get(key):
+      name = os.path.basename(config[key])
+      names.update([name, f"{name}-wal", f"{name}-shm", f"{name}-journal"])
+
+  return names
+
+def _objects(app, kind, manager, since):
+  skipped = _skipped_names(app.config)
+
+  for sub_path, name in manager.walk("", since=since):
+    if (not sub_path and name in skipped) or sub_path.split("/")[0] == records_path:
+      continue
+
+    try:
+      value = manager.read_bytes(name, path=sub_path or None)
+    except FileNotFoundError:
+      # Deleted since it was listed
+      continue
+
+    yield f"{kind}/{sub_path}/{name}" if sub_path else f"{kind}/{name}", value
+
+def _members(app, manifest, since):
+  timestamp, position = since or (None, 0)
+
+  yield manifest_name, json.dumps(manifest).encode("utf8")
+
+  yield from _objects(app, "secrets", app.secretmanager, timestamp)
+  yield from _objects(app, "certs", app.certmanager, timestamp)
+
+  for i, records in enumerate(app.inventory.export(position, timestamp, inventory_chunk_size)):
+    yield f"inventory/{i:06d}.jsonl", "".join(json.dumps(record) + "\n" for record in records).encode("utf8")
+
+def export_archive(app, since=None):
+  """
+  Export the PKI state
+
+  The snapshot marker is taken before anything is read, so an object written during the
+  export is included in the next incremental export too.
+
+  :param since:
+    Snapshot marker of a previous export, to only export what changed since
+
+  :return:
+    Tuple of the snapshot marker and a generator of the chunks of the archive
+  """
+  since = parse_marker(since) if since else None
+  now = time.time()
+  marker = f"{int(now) - marker_margin}:{app.inventory.position()}"
+
+  manifest = {
+    "version": archive_version,
+    "created": now,
+    "marker": marker,
+    "since": f"{since[0]}:{since[1]}" if since else None
+  }
+
+  def _stream():
+    buffer = _Buffer()
+
+    with tarfile.open(fileobj=buffer, mode="w|gz") as archive:
+      for name, value in _members(app, manifest, since):
+        info = tarfile.TarInfo(name)
+        info.size = len(value)
+        info.mtime = int(now)
+        info.mode = 0o600
+
+        archive.addfile(info, io.BytesIO(value))
+
+        data = buffer.drain()
+        if data:
+          yield data
+
+    yield buffer.drain()
+
+  return marker, _stream()
+
+def _object_path(member_name):
+  """
+  Get the path and name of an object from its archive member name
+
+  :return:
+    Tuple of the path, None at the top of the tree, and the name
+  """
+  parts = member_name.split("/")
+  if any(part in ["", ".", ".."] for part in parts):
+    raise InvalidArchiveException(f"Invalid object name {member_name}")
+
+  return "/".join(parts[:-1]) or None, parts[-1]
+
+def _restore_crl_state(app, states):
+  """
+  Restore the CRL numbers of the CAs, unless the stored ones are already higher
+
+  :param states:
+    Dict of the CRL paths and the dicts of the restored CRL state files
+
+  :return:
+    The number of restored files
+  """
+  count = 0
+
+  for path, files in states.items():
+    if crl_number_filename not in files:
+      continue
+
+    try:
+      current = int(app.certmanager.read_string(crl_number_filename, path=path))
+    except FileNotFoundError:
+      current = None
+
+    if current is not None and current >= int(files[crl_number_filename]):
+      continue
+
+    # The number is written last, as the server processes only use the other files once it matches them
+    app.certmanager.write_many([(name, value, path) for name, value in files.items() if name != crl_number_filename])
+    app.certmanager.write_many([(crl_number_filename, files[crl_number_filename], path)])
+    count += len(files)
+
+  return count
+
+def restore_archive(app, stream):
+  """
+  Restore the PKI state from an archive
+
+  The objects are written in batches of chunk_size. A broken archive stops the restore with
+  only the batches before the error written, so it should be imported again once fixed.
+
+  :param stream:
+    Binary file object the archive is read from
+
+  :return:
+    Tuple of the manifest and a dict with the number of restored secrets, certificates and inventory records
+  """
+  managers = {"secrets": app.secretmanager, "certs": app.certmanager}
+  counts = {"secrets": 0, "certs": 0, "inventory": 0}
+  pending = {kind: [] for kind in managers}
+  pending_bytes = 0
+  crl_states = {}
+  manifest = None
+
+  def _flush(kind):
+    nonlocal pending_bytes
+    if pending[kind]:
+      managers[kind].write_many(pending[kind])
+      counts[kind] += len(pending[kind])
+      pending_bytes -= sum(len(value) for _, value, _ in pending[kind])
+      pending[kind] = []
+
+  try:
+    with tarfile.open(fileobj=stream, mode="r|gz") as archive:
+      for member in archive:
+        if not member.isfile():
+          raise InvalidArchiveException(f"Invalid archive member {member.name}")
+
+        data = archive.extractfile(member).read()
+
+        if manifest is None:
+          if member.name != manifest_name:
+            raise InvalidArchiveException("The archive doesn't start with a manifest")
+
+          manifest = json.loads(data)
+          if manifest.get("version") != archive_version:
+            raise InvalidArchiveException(f"Unsupported archive version {manifest.get('version')}")
+          continue
+
+        kind, _, name = member.name.partition("/")
+        if kind == "inventory":
+          records = [json.loads(line) for line in data.splitlines() if line]
+          app.inventory.load(records)
+          counts["inventory"] += len(records)
+        elif kind in managers:
+          path, name = _object_path(name)
+          if kind == "certs" and path and path.startswith("crl/") and name in crl_state_filenames:
+            # Restored last, once compared with the stored CRL number
+            crl_states.setdefault(path, {})[name] = data
+            continue
+
+          pending[kind].append((name, data, path))
+          pending_bytes += len(data)
+
+          if len(pending[kind]) >= chunk_size or pending_bytes >= chunk_bytes:
+            _flush(kind)
+        else:
+          raise InvalidArchiveException(f"Unknown archive member {member.name}")
+
+    if manifest is None:
+      raise InvalidArchiveException("The archive is empty")
+  except (tarfile.TarError, EOFError, ValueError, KeyError) as e:
+    raise InvalidArchiveException(f"Invalid archive: {e}")
+
+  for kind in managers:
+    _flush(kind)
+  counts["certs"] += _restore_crl_state(app, crl_states)
+
+  return manifest, counts
+
+def _cli_app(args):
+  """
+  Create the storage managers and inventory of the API outside of it, from the CLI arguments
+  """
+  config = {
+    "SECRETS_PATH": args.secrets_path,
+    "CERTS_PATH": args.certs_path,
+    "SECRETS_DB": os.getenv("SECRETS_DB", f"{args.secrets_path}/secrets.db"),
+    "CERTS_DB": os.getenv("CERTS_DB", f"{args.certs_path}/certs.db"),
+    "INVENTORY_DB": os.getenv("INVENTORY_DB", f"{args.certs_path}/inventory.db"),
+    "INVALIDATION_LOG": os.getenv("INVALIDATION_LOG", f"{args.certs_path}/invalidation.log"),
+    "RENEWAL_LOCK": os.getenv("RENEWAL_LOCK", f"{args.certs_path}/renewal.lock"),
+    "CRL_LOCK": os.getenv("CRL_LOCK", f"{args.certs_path}/crl.lock"),
+    "FILE_SYNC": os.getenv("FILE_SYNC", "none"),
+    "FILE_SYNC_WINDOW": os.getenv("FILE_SYNC_WINDOW", 2),
+    "FILE_SYNC_MAX_BATCH": os.getenv("FILE_SYNC_MAX_BATCH", 256)
+  }
+  app = SimpleNamespace(config=config)
+
+  if args.backend == "sqlite":
+    app.secretmanager = SqliteSecretManager(app)
+    app.certmanager = SqliteCertificateManager(app)
+  else:
+    app.secretmanager = FileSecretManager(app)
+    app.certmanager = FileCertificateManager(app)
+  app.inventory = Inventory(app)
+
+  return app
+
+def main():
+  parser = argparse.ArgumentParser(description="Export or restore the PKI state as a compressed archive")
+  parser.add_argument("command", choices=["export", "import"])
+  parser.add_argument("--secrets-path", default=os.getenv("SECRETS_PATH", "/secrets"))
+  parser.add_argument("--certs-path", default=os.getenv("CERTS_PATH", "/certs"))
+  parser.add_argument("--backend", choices=["file", "sqlite"], default=os.getenv("STORAGE_BACKEND", "file"))
+  parser.add_argument("--since", default=None, help="Snapshot marker of a previous export, to only export what changed since")
+  parser.add_argument("--file", default=None, help="Archive to write or read, defaults to stdout or stdin")
+  args = parser.parse_args()
+
+  app = _cli_app(args)
+
+  if args.command == "export":
+    marker, chunks = export_archive(app, args.since)
+
+    with open(args.file, "wb") if args.file else sys.stdout.buffer as f:
+      for chunk in chunks:
+        f.write(chunk)
+
+    print(f"Exported snapshot {marker}", file=sys.stderr)
+  else:
+    with open(args.file, "rb") if args.file else sys.stdin.buffer as f:
+      try:
+        manifest, counts = restore_archive(app, f)
+      except InvalidArchiveException as e:
+        parser.exit(1, f"{e}\n")
+
+    # Running servers drop their cached state
+    InvalidationLog(app).publish("reset", local=False)
+
+    print(
+      f"Restored snapshot {manifest['marker']}: {counts['secrets']} secrets, "
+      f"{counts['certs']} certificates and {counts['inventory']} inventory records",
+      file=sys.stderr
+    )
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,72 @@
+import json
+
+from collections import deque
+
+from flask import current_app, Response, stream_with_context
+
+from ca import NotFoundException, InvalidValueException
+
+import metrics
+
+def _run_item(app, operation, func, index, item):
+  """
+  Run the function for a single batch item
+
+  The item runs under the operation of the batch and is timed as its item phase.
+  Errors are caught and returned as the result of the item, so one failing item doesn't stop the batch.
+
+  :return:
+    Dict with the index and HTTP status of the item, together with either the result or the error
+  """
+  with app.app_context(), metrics.operation(operation):
+    try:
+      with metrics.phase("item"):
+        return {"index": index, "status": 201, **func(item)}
+    except NotFoundException as e:
+      return {"index": index, "status": 404, "error": str(e)}
+    except (InvalidValueException, ValueError, KeyError, TypeError) as e:
+      return {"index": index, "status": 400, "error": str(e)}
+    except Exception as e:
+      return {"index": index, "status": 500, "error": str(e)}
+
+def stream(items, func):
+  """
+  Run a function for each item of a batch on the batch workers
+
+  The results are streamed as a JSON array, in the same order as the items.
+  Only a bounded number of items are in flight at any time.
+
+  :param items:
+    List of batch items
+
+  :param func:
+    Function called with each item, returning a dict with the result
+
+  :return:
+    Streamed response
+  """
+  app = current_app._get_current_object()
+  executor = app.batch_executor
+  window = int(app.config["BATCH_WORKERS"]) * 4
+  operation = metrics.current_operation()
+
+  def _generate():
+    pending = deque()
+    first = True
+
+    yield "["
+
+    for index, item in enumerate(items):
+      pending.append(executor.submit(_run_item, app, operation, func, index, item))
+
+      while len(pending) >= window or (pending and pending[0].done()):
+        yield ("" if first else ",") + json.dumps(pending.popleft().result())
+        first = False
+
+    while pending:
+      yield ("" if first else ",") + json.dumps(pending.popleft().result())
+      first = False
+
+    yield "]"
+
+  return Response(stream_with_context(_generate()), status=200, mimetype="application/json")
@@ -0,0 +1,370 @@
+"""
+Benchmark the API operations against temporary storage
+
+  python -m benchmark --iterations 50 --output results.json
+  python -m benchmark --baseline results.json --max-regression 20
+
+Every storage backend gets its own temporary SECRETS_PATH and CERTS_PATH, holding a root CA
+with a chain of intermediate CAs below it for every requested depth. The operations are called
+through the full API stack with the Flask test client, so no server or network is involved.
+
+The results are written as JSON, with the latency percentiles and throughput of every
+operation and parameter combination. When a baseline from an earlier run is given, the
+median latencies are compared, and the exit code is 1 if any regressed by more than
+--max-regression percent.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from asn1crypto import csr, pem, x509
+from oscrypto import asymmetric
+
+from ca import _signature_hash
+from keypool import generate_pair
+
+operations = ["cert.issue", "cert.sign", "client.sign", "ca.get_chain", "role.get_role"]
+
+# Dimensions identifying a benchmark case, used to match cases against a baseline
+_case_keys = ["operation", "backend", "depth", "key", "sans", "role_paths"]
+
+def _parse_key(value):
+  """
+  Parse a key type argument, e.g. rsa:2048 or ec:secp256r1
+
+  :return:
+    Tuple of the algorithm and size or curve, as used by the key pool
+  """
+  algorithm, size = value.split(":")
+
+  return (algorithm, int(size) if size.isdigit() else size)
+
+def _key_fields(key):
+  """
+  Get the request fields selecting a key type
+  """
+  algorithm, size = key
+  if algorithm == "ec":
+    return {"key_type": "ec", "curve": size}
+  else:
+    return {"key_type": algorithm, "size": size}
+
+def _build_csr(key, common_name):
+  """
+  Build a CSR in PEM format for a new key pair
+  """
+  public_key, private_key = generate_pair(*key)
+
+  info = csr.CertificationRequestInfo({
+    "version": "v1",
+    "subject": x509.Name.build({"common_name": common_name}),
+    "subject_pk_info": public_key.asn1,
+    "attributes": []
+  })
+
+  hash_algorithm = _signature_hash(private_key)
+  if private_key.algorithm == "ec":
+    signature = asymmetric.ecdsa_sign(private_key, info.dump(), hash_algorithm)
+    signature_algorithm = f"{hash_algorithm}_ecdsa"
+  else:
+    signature = asymmetric.rsa_pkcs1v15_sign(private_key, info.dump(), hash_algorithm)
+    signature_algorithm = f"{hash_algorithm}_rsa"
+
+  request = csr.CertificationRequest({
+    "certification_request_info": info,
+    "signature_algorithm": {"algorithm": signature_algorithm},
+    "signature": signature
+  })
+
+  return pem.armor("CERTIFICATE REQUEST", request.dump())
+
+def _percentile(values, percent):
+  # Nearest-rank percentile of sorted values
+  return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def _measure(app, call, iterations, warmup, concurrency):
+  """
+  Measure the latency and throughput of an API call
+
+  :param call:
+    Function taking a test client and the iteration number, returning the response
+
+  :return:
+    Dict with the number of errors, latency statistics in milliseconds and the throughput per second
+  """
+  client = app.test_client()
+  for i in range(warmup):
+    call(client, -1 - i)
+
+  def _worker(worker):
+    worker_client = app.test_client()
+    latencies = []
+    errors = 0
+
+    for i in range(worker, iterations, concurrency):
+      start = time.perf_counter()
+      response = call(worker_client, i)
+      latencies.append(time.perf_counter() - start)
+
+      if response.status_code >= 400:
+        errors += 1
+
+    return latencies, errors
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as executor:
+    results = list(executor.map(_worker, range(concurrency)))
+  elapsed = time.perf_counter() - start
+
+  latencies = sorted(latency * 1000 for worker_latencies, _ in results for latency in worker_latencies)
+
+  return {
+    "iterations": iterations,
+    "concurrency": concurrency,
+    "errors": sum(errors for _, errors in results),
+    "latency_ms": {
+      "mean": round(sum(latencies) / len(latencies), 3),
+      "p50": round(_percentile(latencies, 50), 3),
+      "p90": round(_percentile(latencies, 90), 3),
+      "p99": round(_percentile(latencies, 99), 3),
+      "max": round(latencies[-1], 3)
+    },
+    "throughput": round(iterations / elapsed, 2)
+  }
+
+def _create_app(backend, base_path):
+  """
+  Create the API with storage in a temporary directory
+  """
+  os.environ["SECRETS_PATH"] = os.path.join(base_path, "secrets")
+  os.environ["CERTS_PATH"] = os.path.join(base_path, "certs")
+  os.environ["STORAGE_BACKEND"] = backend
+  # Repeated signing of the same CSR is measured, not replayed
+  os.environ["IDEMPOTENCY_WINDOW"] = "0"
+  for name in ["SECRETS_DB", "CERTS_DB", "INVENTORY_DB"]:
+    os.environ.pop(name, None)
+
+  from connexion_flask.main import App
+
+  return App(specification_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"), run=False).application
+
+def _check(response, what):
+  if response.status_code >= 400:
+    raise RuntimeError(f"Setting up {what} failed with {response.status_code}: {response.get_data(as_text=True)}")
+
+  return response
+
+def _setup(client, depth, args):
+  """
+  Create a CA hierarchy of a given depth, with roles and a client for the benchmarks
+
+  :return:
+    The name of the CA at the bottom of the hierarchy
+  """
+  ca_fields = _key_fields(args.ca_key)
+
+  parent = f"bench-{depth}-0"
+  _check(client.post("/1.0/ca/root", data={"name": parent, "common_name": f"Bench root {depth}", **ca_fields}), "the root CA")
+
+  for level in range(1, depth + 1):
+    name = f"bench-{depth}-{level}"
+    _check(client.post(f"/1.0/ca/intermediate/{parent}", data={"name": name, "common_name": f"Bench intermediate {depth}-{level}", **ca_fields}), f"intermediate CA {name}")
+    parent = name
+
+  # The matching path is the last one, so every path is checked
+  for role_paths in args.role_paths:
+    paths = [f"svc{i}.bench.local" for i in range(role_paths - 1)] + ["example.com"]
+    _check(client.put(f"/1.0/ca/roles/{parent}/paths-{role_paths}", json={"paths": paths, "allow_naked": False}), "the roles")
+
+  _check(client.put(f"/1.0/client/bench-{depth}", json={"ca": parent}), "the client")
+  _check(client.put(f"/1.0/client/role/bench-{depth}/bench", json={"common_names": [], "subject": {"organization_name": "Bench"}}), "the client role")
+
+  return parent
+
+def _cases(args, depth, ca):
+  """
+  Generate the benchmark cases for a CA hierarchy
+
+  :return:
+    Generator of tuples of the case description and the API call
+  """
+  client_name = f"bench-{depth}"
+  csrs = {key: _build_csr(key, "sign.example.com") for key in args.keys}
+
+  if "cert.issue" in args.operations:
+    for key in args.keys:
+      for sans in args.sans:
+        for role_paths in args.role_paths:
+          def _issue(client, i, key=key, sans=sans, role_paths=role_paths):
+            query = "&".join(f"alt_domains=san{j}-{i}.example.com" for j in range(sans))
+            return client.post(f"/1.0/cert/issue/{ca}/paths-{role_paths}?{query}", data={"common_name": f"host{i}.example.com", **_key_fields(key)})
+
+          yield {"operation": "cert.issue", "key": f"{key[0]}:{key[1]}", "sans": sans, "role_paths": role_paths}, _issue
+
+  if "cert.sign" in args.operations:
+    for key in args.keys:
+      for role_paths in args.role_paths:
+        def _sign(client, i, key=key, role_paths=role_paths):
+          return client.post(f"/1.0/cert/sign/{ca}/paths-{role_paths}", data=csrs[key], content_type="plain/text")
+
+        yield {"operation": "cert.sign", "key": f"{key[0]}:{key[1]}", "role_paths": role_paths}, _sign
+
+  if "client.sign" in args.operations:
+    for key in args.keys:
+      def _client_sign(client, i, key=key):
+        return client.post(f"/1.0/client/cert/sign/{client_name}/bench?cn=bench{i}", data=csrs[key], content_type="plain/text")
+
+      yield {"operation": "client.sign", "key": f"{key[0]}:{key[1]}"}, _client_sign
+
+  if "ca.get_chain" in args.operations:
+    def _get_chain(client, i):
+      return client.get(f"/1.0/ca/ca-chain/{ca}")
+
+    yield {"operation": "ca.get_chain"}, _get_chain
+
+  if "role.get_role" in args.operations:
+    for role_paths in args.role_paths:
+      def _get_role(client, i, role_paths=role_paths):
+        return client.get(f"/1.0/ca/roles/{ca}/paths-{role_paths}")
+
+      yield {"operation": "role.get_role", "role_paths": role_paths}, _get_role
+
+def _case_id(result):
+  return tuple(result.get(k) for k in _case_keys)
+
+def _describe(result):
+  return " ".join(f"{k}={result[k]}" for k in _case_keys if result.get(k) is not None)
+
+def compare(results, baseline):
+  """
+  Compare the median latencies of a run against a baseline run
+
+  :return:
+    List of tuples of the case description, the baseline and current median latency and the change in percent
+  """
+  baseline_cases = {_case_id(result): result for result in baseline["results"]}
+  changes = []
+
+  for result in results:
+    previous = baseline_cases.get(_case_id(result))
+    if previous:
+      before = previous["latency_ms"]["p50"]
+      after = result["latency_ms"]["p50"]
+      changes.append((_describe(result), before, after, (after - before) / before * 100 if before else 0.0))
+
+  return changes
+
+def _git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(args):
+  """
+  Run all the benchmark cases
+
+  :return:
+    Dict with the details of the run and the results
+  """
+  results = []
+
+  for backend in args.backends:
+    base_path = tempfile.mkdtemp(prefix=f"certmanager-bench-{backend}-")
+
+    try:
+      app = _create_app(backend, base_path)
+      client = app.test_client()
+
+      for depth in args.depths:
+        ca = _setup(client, depth, args)
+
+        for case, call in _cases(args, depth, ca):
+          result = {"operation": case["operation"], "backend": backend, "depth": depth, "key": None, "sans": None, "role_paths": None, **case}
+          result.update(_measure(app, call, args.iterations, args.warmup, args.concurrency))
+          results.append(result)
+
+          print(f"{_describe(result)}: p50 {result['latency_ms']['p50']}ms p99 {result['latency_ms']['p99']}ms {result['throughput']}/s errors {result['errors']}", file=sys.stderr)
+    finally:
+      if not args.keep:
+        shutil.rmtree(base_path, ignore_errors=True)
+
+  return {
+    "meta": {
+      "timestamp": datetime.now(timezone.utc).isoformat(),
+      "commit": _git_commit(),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpu_count": os.cpu_count(),
+      "config": {name: os.getenv(name) for name in ["KEY_POOL_SIZE", "SIGNING_WORKERS", "BATCH_WORKERS"]},
+      "arguments": {
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "concurrency": args.concurrency,
+        "backends": args.backends,
+        "depths": args.depths,
+        "keys": [f"{algorithm}:{size}" for algorithm, size in args.keys],
+        "ca_key": f"{args.ca_key[0]}:{args.ca_key[1]}",
+        "sans": args.sans,
+        "role_paths": args.role_paths,
+        "operations": args.operations
+      }
+    },
+    "results": results
+  }
+
+def _int_list(value):
+  return [int(v) for v in value.split(",") if v.strip()]
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the API operations against temporary storage")
+  parser.add_argument("--iterations", type=int, default=20, help="Measured calls per case")
+  parser.add_argument("--warmup", type=int, default=2, help="Unmeasured calls per case before measuring")
+  parser.add_argument("--concurrency", type=int, default=1, help="Threads calling the API at the same time")
+  parser.add_argument("--backends", type=lambda v: v.split(","), default=["file", "sqlite"])
+  parser.add_argument("--depths", type=_int_list, default=[1], help="Number of intermediate CAs below the root")
+  parser.add_argument("--keys", type=lambda v: [_parse_key(k) for k in v.split(",")], default=[("rsa", 2048), ("ec", "secp256r1")], help="Key types of issued and signed certificates, e.g. rsa:2048,ec:secp256r1")
+  parser.add_argument("--ca-key", type=_parse_key, default=("rsa", 2048), help="Key type of the CAs")
+  parser.add_argument("--sans", type=_int_list, default=[0, 10], help="Number of subject alt names of issued certificates")
+  parser.add_argument("--role-paths", type=_int_list, default=[1, 100], help="Number of paths in the roles")
+  parser.add_argument("--operations", type=lambda v: v.split(","), default=operations, help=f"Any of {','.join(operations)}")
+  parser.add_argument("--output", default=None, help="File to write the JSON results to, instead of stdout")
+  parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+  parser.add_argument("--max-regression", type=float, default=None, help="Fail if a median latency regressed by more than this percentage")
+  parser.add_argument("--keep", action="store_true", help="Keep the temporary storage directories")
+  args = parser.parse_args()
+
+  report = run(args)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      changes = compare(report["results"], json.load(f))
+
+    regressed = False
+    for description, before, after, change in changes:
+      print(f"{description}: p50 {before}ms -> {after}ms ({change:+.1f}%)", file=sys.stderr)
+      if args.max_regression is not None and change > args.max_regression:
+        regressed = True
+
+    if regressed:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -3,13 +3,34 @@ from certbuilder import CertificateBuilder, pem_armor_certificate
 
 from flask import current_app
 
+from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 
+import httpcache
+import listing
+import metrics
+
 # Defaults
 encryption_schema = 'rsa'
+default_curve = 'secp256r1'
 private_key_filename = "private"
 parent_ca_filename = "parent"
 
+# Supported RSA key sizes
+rsa_sizes = [2048, 4096]
+
+# Supported EC curves, and the hash used when signing with a key on the curve
+# The certificate and CRL builders only support SHA-256 and SHA-512, so P-384 keys sign with SHA-512
+ec_curves = {
+  "secp256r1": "sha256",
+  "secp384r1": "sha512",
+  "secp521r1": "sha512"
+}
+
+# The loaded material of a CA
+# certificate_pem is the certificate as stored, certificate and private_key are the parsed objects
+CAMaterial = namedtuple("CAMaterial", ["certificate_pem", "certificate", "private_key"])
+
 class NotFoundException(Exception):
   pass
 
@@ -42,7 +63,56 @@ def _calc_enddate(cert_ttl, max_ttl=None, default_ttl=None):
 
   return (datetime.now() + timedelta(hours=int(ttl))).replace(tzinfo=timezone.utc)
 
-def _construct_subject(body, parent=None, inherit_parent=True):
+def _key_spec(body, defaults=None, default_size=2048):
+  """
+  Get the type of a new key pair
+
+  :param body:
+    Dict with the key_type, and the size for RSA keys or the curve for EC keys
+
+  :param defaults:
+    Dict used for the fields missing from the body, e.g. the role
+
+  :param default_size:
+    The RSA key size used if neither the body nor the defaults have one
+
+  :return:
+    Tuple of the algorithm, and the bit size for RSA keys or the curve name for EC keys
+  """
+  defaults = defaults or {}
+
+  key_type = (body.get("key_type") or defaults.get("key_type") or encryption_schema).lower()
+  if key_type == "rsa":
+    size = body.get("size") or defaults.get("size") or default_size
+    try:
+      size = int(size)
+    except (TypeError, ValueError):
+      raise InvalidValueException(f"Invalid key size {size}")
+    if size not in rsa_sizes:
+      raise InvalidValueException(f"Invalid key size {size}, must be one of {', '.join(str(s) for s in rsa_sizes)}")
+
+    return ("rsa", size)
+  elif key_type == "ec":
+    curve = body.get("curve") or defaults.get("curve") or default_curve
+    if curve not in ec_curves:
+      raise InvalidValueException(f"Invalid curve {curve}")
+
+    return ("ec", curve)
+  elif key_type == "ed25519":
+    raise InvalidValueException("Ed25519 keys are not supported")
+  else:
+    raise InvalidValueException(f"Invalid key type {key_type}")
+
+def _signature_hash(private_key):
+  """
+  Get the hash algorithm to sign with a private key
+  """
+  if private_key.algorithm == "ec":
+    return ec_curves.get(private_key.curve, "sha256")
+  else:
+    return "sha256"
+
+def _construct_subject(body, parent=None, inherit_parent=True, parent_subject=None):
   """
   Constructs the subject for a certificate
 
@@ -57,6 +127,9 @@ def _construct_subject(body, parent=None, inherit_parent=True):
   :param inherit_parent:
     Set to True to inherit missing subject fields from the parent certificate
 
+  :param parent_subject:
+    The subject of the parent certificate, if already parsed
+
   :return:
     Dict with new certificate subject
 
@@ -65,7 +138,8 @@ def _construct_subject(body, parent=None, inherit_parent=True):
     "common_name": body["common_name"]
   }
 
-  parent_subject = crypto_keys.parse_certificate(parent).subject.native if parent else None
+  if parent_subject is None and parent:
+    parent_subject = crypto_keys.parse_certificate(parent).subject.native
 
   for s in [
     "organization_name", "locality_name", "locality_name", "state_or_province_name", "country_name",
@@ -80,6 +154,77 @@ def _construct_subject(body, parent=None, inherit_parent=True):
 
   return subject
 
+def _ca_chain(ca):
+  """
+  Get the certificate chain of a CA, starting with the CA itself and ending with the root CA
+
+  :param ca:
+    The name of the CA
+
+  :return:
+    A string containing the certificate chain in PEM format
+  """
+  return _load_chain(ca)[0]
+
+def _load_chain(ca):
+  """
+  Load the certificate chain of a CA
+
+  The chain is kept in the chain cache, together with the names of the CAs in the chain,
+  so it can be dropped when any of them changes.
+
+  :return:
+    Tuple of the certificate chain in PEM format and the names of the CAs in the chain
+  """
+  cached = current_app.chain_cache.get(ca)
+  if cached:
+    return cached
+
+  generation = current_app.chain_cache.generation()
+  chain = []
+  path = []
+
+  current_ca = ca
+  while True:
+    chain.append(current_app.certmanager.read_bytes(current_ca).decode('utf8'))
+    path.append(current_ca)
+
+    if current_app.secretmanager.exists(parent_ca_filename, path=current_ca):
+      current_ca = current_app.secretmanager.read_string(parent_ca_filename, path=current_ca)
+    else:
+      break
+
+  return current_app.chain_cache.put(ca, ("".join(chain), tuple(path)), generation)
+
+async def _load_chain_async(ca):
+  """
+  Load the certificate chain of a CA, reading through the async storage managers
+
+  Shares the chain cache with _load_chain.
+  """
+  cached = current_app.chain_cache.get(ca)
+  if cached:
+    return cached
+
+  generation = current_app.chain_cache.generation()
+  chain = []
+  path = []
+
+  current_ca = ca
+  while True:
+    chain.append((await current_app.async_certmanager.read_bytes(current_ca)).decode('utf8'))
+    path.append(current_ca)
+
+    if await current_app.async_secretmanager.exists(parent_ca_filename, path=current_ca):
+      current_ca = await current_app.async_secretmanager.read_string(parent_ca_filename, path=current_ca)
+    else:
+      break
+
+  return current_app.chain_cache.put(ca, ("".join(chain), tuple(path)), generation)
+
+async def _ca_exists_async(ca):
+  return ca in current_app.ca_cache or await current_app.async_secretmanager.exists(private_key_filename, path=ca)
+
 def _construct_ca_chain(cert, parent=None):
   """
   Construct the certificate chain, including the CA certs
@@ -97,54 +242,117 @@ def _construct_ca_chain(cert, parent=None):
   ca_chain = pem_armor_certificate(cert).decode('utf8')
 
   if parent:
-    current_parent = parent
-    while True:
-      parent_cert = current_app.certmanager.read_bytes(current_parent)
-      ca_chain += parent_cert.decode('utf8')
-
-      if current_app.secretmanager.exists(parent_ca_filename, path=current_parent):
-        current_parent = current_app.secretmanager.read_string(parent_ca_filename, path=current_parent)
-      else:
-        break
+    ca_chain += _ca_chain(parent)
 
   return ca_chain
 
 
+def _generate_pair(size, algorithm=encryption_schema):
+  """
+  Get a new key pair
+
+  The key pair is taken from the key pool, and only generated inline if the pool is empty.
+
+  :param size:
+    The key size in bits for RSA keys, or the curve name for EC keys
+
+  :param algorithm:
+    The key algorithm
+
+  :return:
+    Tuple containing the public and private key
+  """
+  return current_app.keypool.take(algorithm, size)
+
 def _load_ca(ca):
   """
   Load the certificate and private key for a CA
 
+  The loaded material is kept in the CA cache, so the CA is only read and parsed once.
+
   :param ca:
     The name of the CA to load
 
   :return:
-    Tuple containing the certificate and private key in PEM format
+    CAMaterial containing the certificate in PEM format and the loaded certificate and private key
   """
-  if current_app.secretmanager.exists(private_key_filename, path=ca):
-    return current_app.certmanager.read_bytes(ca), current_app.secretmanager.read_bytes(private_key_filename, path=ca)
-  else:
-    raise NotFoundException(f"{ca} CA not found")
+  material = current_app.ca_cache.get(ca)
+  if material:
+    current_app.metrics.inc("certmanager_ca_cache_total", result="hit")
+    return material
+
+  current_app.metrics.inc("certmanager_ca_cache_total", result="miss")
+  # Not put back if the CA is dropped while it is loaded
+  generation = current_app.ca_cache.generation()
+  with metrics.phase("ca_load"):
+    if current_app.secretmanager.exists(private_key_filename, path=ca):
+      certificate_pem = current_app.certmanager.read_bytes(ca)
+      private_key = current_app.secretmanager.read_bytes(private_key_filename, path=ca)
+
+      return current_app.ca_cache.put(ca, CAMaterial(
+        certificate_pem,
+        asymmetric.load_certificate(certificate_pem),
+        asymmetric.load_private_key(private_key, None)
+      ), generation)
+    else:
+      raise NotFoundException(f"{ca} CA not found")
+
+def _invalidate_ca(ca):
+  """
+  Drop any cached state for a CA, in every server process
+
+  Must be called whenever a CA is created or removed.
+
+  :param ca:
+    The name of the CA
+  """
+  current_app.invalidation.publish("ca", ca)
+
+def _drop_ca(ca):
+  """
+  Drop the cached state for a CA in this process
+  """
+  current_app.ca_cache.pop(ca)
+  current_app.chain_cache.pop_if(lambda _, cached: ca in cached[1])
+  current_app.role_cache.pop_if(lambda key, _: key[0] == ca)
+  current_app.profile_cache.pop_if(lambda _, profile: profile.ca == ca)
+  current_app.signer.invalidate(ca)
+  current_app.crls.invalidate(ca)
+  current_app.ocsp.invalidate(ca)
+  httpcache.drop(ca=ca)
+
+def _drop_all():
+  """
+  Drop all cached CA, role, client and revocation state in this process
+  """
+  current_app.ca_cache.clear()
+  current_app.chain_cache.clear()
+  current_app.role_cache.clear()
+  current_app.profile_cache.clear()
+  current_app.signer.clear()
+  current_app.crls.clear()
+  current_app.ocsp.clear()
+  current_app.etag_cache.clear()
 
 
 ############################
 #### API calls
 ############################
-def list():
-  return current_app.secretmanager.list(), 200
+def list(prefix=None, cursor=None, limit=None, format=None):
+  return listing.respond(current_app.secretmanager.iterate(prefix=prefix, after=cursor), limit, format)
 
 def get_ca(ca):
-  try:
-    ca_certificate, _ = _load_ca(ca)
-
-    if current_app.secretmanager.exists(parent_ca_filename, path=ca):
-      parent = current_app.secretmanager.read_string(parent_ca_filename, path=ca)
-    else:
-      parent = None
+  def _load():
+    ca_material = _load_ca(ca)
+    chain, path = _load_chain(ca)
 
     return {
-      "certificate": ca_certificate.decode("utf-8"),
-      "ca_chain": _construct_ca_chain(asymmetric.load_certificate(ca_certificate), parent)
-    }, 200
+      "certificate": ca_material.certificate_pem.decode("utf-8"),
+      "ca_chain": chain
+    }, path
+
+  try:
+    return httpcache.respond(("ca", ca), _load)
   except NotFoundException as e:
     return str(e), 404
 
@@ -155,41 +363,42 @@ def delete_ca(ca):
 
   current_app.secretmanager.delete(ca)
   current_app.certmanager.delete(ca)
+  _invalidate_ca(ca)
 
 def get_cert(ca):
   try:
-    ca_certificate, _ = _load_ca(ca)
-
-    return ca_certificate.decode("utf-8")
+    return httpcache.respond(("cert", ca), lambda: (_load_ca(ca).certificate_pem.decode("utf-8"), (ca,)))
   except NotFoundException as e:
     return str(e), 404
 
 def get_chain(ca):
-  try:
-    ca_certificate, _ = _load_ca(ca)
+  def _load():
+    _ = _load_ca(ca) # Check if the CA exists
 
-    if current_app.secretmanager.exists(parent_ca_filename, path=ca):
-      parent = current_app.secretmanager.read_string(parent_ca_filename, path=ca)
-    else:
-      parent = None
+    return _load_chain(ca)
 
-    return _construct_ca_chain(asymmetric.load_certificate(ca_certificate), parent)
+  try:
+    return httpcache.respond(("chain", ca), _load)
   except NotFoundException as e:
     return str(e), 404
 
+@metrics.operation("ca.root")
 def root(body, ttl=None):
   # Extract parameters
   name = body["name"]
-  bit_size = int(body["size"])
 
   # Check if the private key for the new CA already exists
   if current_app.secretmanager.exists(private_key_filename, path=name):
     return f"CA {name} already exist", 400
 
   try:
+    algorithm, size = _key_spec(body, default_size=4096)
+
     # Generate and save the key and certificate for the root CA
-    root_ca_public_key, root_ca_private_key = asymmetric.generate_pair(encryption_schema, bit_size=bit_size)
-    current_app.secretmanager.write_bytes(private_key_filename, asymmetric.dump_private_key(root_ca_private_key, None), path=name)
+    with metrics.phase("keygen"):
+      root_ca_public_key, root_ca_private_key = _generate_pair(size, algorithm)
+    with metrics.phase("store"):
+      current_app.secretmanager.write_bytes(private_key_filename, asymmetric.dump_private_key(root_ca_private_key, None), path=name)
 
     # Create the self-signed certificate
     builder = CertificateBuilder(
@@ -198,10 +407,14 @@ def root(body, ttl=None):
     )
     builder.self_signed = True
     builder.ca = True
+    builder.hash_algo = _signature_hash(root_ca_private_key)
     builder.end_date = _calc_enddate(ttl, current_app.config["CA_MAX_TTL"], current_app.config["CA_ROOT_TTL"])
-    root_ca_certificate = builder.build(root_ca_private_key)
+    with metrics.phase("sign"):
+      root_ca_certificate = builder.build(root_ca_private_key)
 
-    current_app.certmanager.write_bytes(name, pem_armor_certificate(root_ca_certificate))
+    with metrics.phase("store"):
+      current_app.certmanager.write_bytes(name, pem_armor_certificate(root_ca_certificate))
+    _invalidate_ca(name)
 
     return {
       "certificate": pem_armor_certificate(root_ca_certificate).decode('utf8'),
@@ -213,6 +426,7 @@ def root(body, ttl=None):
     return str(e), 400
 
 
+@metrics.operation("ca.intermediate")
 def intermediate(parent, body, ttl=None):
   """
   Create an intermediate CA
@@ -231,32 +445,39 @@ def intermediate(parent, body, ttl=None):
 
   # Extract parameters
   name = body["name"]
-  bit_size = int(body["size"])
 
   # Check if the private key for the new CA already exists
   if current_app.secretmanager.exists(private_key_filename, path=name):
     return f"CA {name} already exist", 400
 
   try:
+    algorithm, size = _key_spec(body, default_size=4096)
+
     # Generate and save the key and certificate for the root CA
-    intermediate_ca_public_key, intermediate_ca_private_key = asymmetric.generate_pair(encryption_schema, bit_size=bit_size)
-    current_app.secretmanager.write_bytes(private_key_filename, asymmetric.dump_private_key(intermediate_ca_private_key, None), path=name)
-    current_app.secretmanager.write_string(parent_ca_filename, parent, path=name)
+    with metrics.phase("keygen"):
+      intermediate_ca_public_key, intermediate_ca_private_key = _generate_pair(size, algorithm)
+    with metrics.phase("store"):
+      current_app.secretmanager.write_bytes(private_key_filename, asymmetric.dump_private_key(intermediate_ca_private_key, None), path=name)
+      current_app.secretmanager.write_string(parent_ca_filename, parent, path=name)
 
     # Get the parent CA
-    signing_ca_certificate, signing_ca_private_key = _load_ca(parent)
+    signing_ca = _load_ca(parent)
 
     # Create the certificate
     builder = CertificateBuilder(
-        _construct_subject(body, parent=signing_ca_certificate),
+        _construct_subject(body, parent=signing_ca.certificate_pem),
         intermediate_ca_public_key
     )
     builder.ca = True
     builder.end_date = _calc_enddate(ttl, current_app.config["CA_MAX_TTL"], current_app.config["CA_INTERMEDIATE_TTL"])
-    builder.issuer = asymmetric.load_certificate(signing_ca_certificate)
-    intermediate_ca_certificate = builder.build(asymmetric.load_private_key(signing_ca_private_key, None))
+    builder.issuer = signing_ca.certificate
+    builder.hash_algo = _signature_hash(signing_ca.private_key)
+    with metrics.phase("sign"):
+      intermediate_ca_certificate = builder.build(signing_ca.private_key)
 
-    current_app.certmanager.write_bytes(name, pem_armor_certificate(intermediate_ca_certificate))
+    with metrics.phase("store"):
+      current_app.certmanager.write_bytes(name, pem_armor_certificate(intermediate_ca_certificate))
+    _invalidate_ca(name)
 
     return {
       "certificate": pem_armor_certificate(intermediate_ca_certificate).decode('utf8'),
@@ -266,3 +487,37 @@ def intermediate(parent, body, ttl=None):
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+
+async def get_cert_async(ca, if_none_match=None):
+  """
+  Async variant of get_cert, served by the ASGI app without blocking the event loop
+  """
+  async def _load():
+    material = current_app.ca_cache.get(ca)
+    if material:
+      return material.certificate_pem.decode("utf-8"), (ca,)
+
+    if not await _ca_exists_async(ca):
+      raise NotFoundException(f"{ca} CA not found")
+
+    return (await current_app.async_certmanager.read_bytes(ca)).decode("utf-8"), (ca,)
+
+  try:
+    return await httpcache.respond_async(("cert", ca), _load, if_none_match=if_none_match)
+  except NotFoundException as e:
+    return str(e), 404
+
+async def get_chain_async(ca, if_none_match=None):
+  """
+  Async variant of get_chain, served by the ASGI app without blocking the event loop
+  """
+  async def _load():
+    if not await _ca_exists_async(ca):
+      raise NotFoundException(f"{ca} CA not found")
+
+    return await _load_chain_async(ca)
+
+  try:
+    return await httpcache.respond_async(("chain", ca), _load, if_none_match=if_none_match)
+  except NotFoundException as e:
+    return str(e), 404
@@ -0,0 +1,96 @@
+import threading
+
+from collections import OrderedDict
+
+class LRUCache():
+  """
+  Thread safe, size bounded cache with least recently used eviction
+
+  Every removal moves the cache to a new generation. A value loaded while an entry was being
+  removed is only put if it is passed the generation taken before loading and no removal
+  happened since, so stale values aren't put back after an invalidation.
+  """
+  def __init__(self, maxsize):
+    self.maxsize = int(maxsize)
+
+    self._data = OrderedDict()
+    self._generation = 0
+    self._lock = threading.Lock()
+
+  def generation(self):
+    """
+    Get the current generation, to be taken before loading a value to put
+    """
+    with self._lock:
+      return self._generation
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key in self._data:
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    return default
+
+  def put(self, key, value, generation=None):
+    """
+    Put a value in the cache
+
+    :param generation:
+      The generation taken before the value was loaded. The value is only put if nothing
+      was removed since, it is always put if None
+
+    :return:
+      The value
+    """
+    if self.maxsize <= 0:
+      return value
+
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return value
+
+      self._data[key] = value
+      self._data.move_to_end(key)
+
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+    return value
+
+  def pop(self, key, default=None):
+    with self._lock:
+      self._generation += 1
+      return self._data.pop(key, default)
+
+  def pop_if(self, predicate):
+    """
+    Remove all entries matching a predicate
+
+    :param predicate:
+      Function called with the key and value of each entry.
+      The entry is removed if it returns True
+
+    :return:
+      List of the removed keys
+    """
+    with self._lock:
+      self._generation += 1
+      keys = [k for k, v in self._data.items() if predicate(k, v)]
+      for k in keys:
+        del self._data[k]
+
+    return keys
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._data.clear()
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._data
+
+  def __len__(self):
+    with self._lock:
+      return len(self._data)
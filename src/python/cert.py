@@ -1,151 +1,352 @@
-from oscrypto import asymmetric, keys as crypto_keys
-from certbuilder import CertificateBuilder, pem_armor_certificate
+from oscrypto import keys as crypto_keys
+from certbuilder import pem_armor_certificate
 
 from asn1crypto import pem, x509
 from asn1crypto.csr import CertificationRequest
 
 from flask import current_app
 
-from ca import _construct_subject, _construct_ca_chain, _load_ca, _calc_enddate, encryption_schema, NotFoundException, InvalidValueException
-from role import _get_role
+from datetime import datetime
 
-def _check_role(ca, role, subject, ttl=None):
+from ca import _construct_subject, _construct_ca_chain, _load_ca, _calc_enddate, _key_spec, NotFoundException, InvalidValueException
+from role import _get_role_policy
+from manager.file import leaf_dirname, sharded_path
+
+import admission
+import batch
+import crl
+import idempotency
+import listing
+import metrics
+
+def _check_role(ca, role, subject, alt_domains=None):
   """
-  Validate that a certificate subject conforms to the rules of a role
+  Validate that a certificate subject and any alternative domains conform to the rules of a role
+
+  All the names are validated against the compiled role policy in a single pass.
 
   :return:
-    the end date of the certificate
+    the role
   """
-  cert_role = _get_role(ca, role)
+  policy = _get_role_policy(ca, role)
+  policy.check([*(alt_domains or []), subject["common_name"]])
 
-  cn = subject["common_name"]
+  return policy.role
 
-  # Check wildcard
-  if cn.startswith("*") and not cert_role["allow_wildcards"]:
-    raise InvalidValueException(f"Wildcards not allowed for {role} role")
+def _leaf_path(serial):
+  """
+  Get the path a leaf certificate is stored at
 
-  # Check the paths
-  if cert_role["paths"]:
-    found = False
-    i = 0
+  :return:
+    The sharded path, or None in the flat layout
+  """
+  if current_app.config["CERTS_LAYOUT"] == "sharded":
+    return sharded_path(serial)
 
-    while not found and i < len(cert_role["paths"]):
-      # Check of naked CN
-      if cn == cert_role["paths"][i] and not cert_role["allow_naked"]:
-        raise InvalidValueException(f"Naked CN {cn} not allowed for {role} role")
+  return None
 
-      # Check for valid path suffix
-      if cn.endswith(cert_role["paths"][i]):
-        found = True
-        break
+def _leaf_paths(serial):
+  # Certificates stored before the sharded layout stay readable until they are migrated.
+  # The sharded path is tried again last, in case the certificate was moved in between.
+  path = _leaf_path(serial)
 
-      i += 1
+  return [path, None, path] if path else [None]
+
+def _read_leaf(serial):
+  """
+  Read a stored leaf certificate
+
+  :return:
+    The certificate in PEM format
+  """
+  for path in _leaf_paths(serial):
+    try:
+      return current_app.certmanager.read_bytes(serial, path=path)
+    except FileNotFoundError:
+      pass
 
-    if not found:
-      raise InvalidValueException(f"CN {cn} not allowed for {role} role")
+  raise NotFoundException(f"Certificate {serial} not found")
 
+async def _read_leaf_async(serial):
+  for path in _leaf_paths(serial):
+    try:
+      return await current_app.async_certmanager.read_bytes(serial, path=path)
+    except FileNotFoundError:
+      pass
 
+  raise NotFoundException(f"Certificate {serial} not found")
+
+def _sign(ca, role, signing_ca, body, ttl=None):
+  """
+  Sign a CSR with a loaded CA
+
+  :param body:
+    The CSR in PEM format
+
+  :return:
+    Dict with the certificate and CA chain
+  """
+  _, _, der_bytes = pem.unarmor(body.encode('utf8') if isinstance(body, str) else body)
+  csr = CertificationRequest.load(der_bytes)
+
+  subject = csr["certification_request_info"]["subject"]
+
+  # Check against role
+  with metrics.phase("role_check"):
+    cert_role = _check_role(ca, role, subject.native)
+
+  # Create the certificate
+  certificate, _ = current_app.signer.build(ca, signing_ca, {
+    "subject": subject,
+    "public_key": csr["certification_request_info"]["subject_pk_info"],
+    "end_date": _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"]))
+  })
+
+  # Store the certificate in case it needa to be revoked
+  # We store it using the serial number as the filename
+  filename = certificate.serial_number
+  path = _leaf_path(filename)
+  with metrics.phase("store"):
+    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate), path=path)
+    current_app.inventory.add(certificate, ca, filename, path=path, role=role)
+  metrics.issued(ca, role)
+
+  with metrics.phase("chain"):
+    ca_chain = _construct_ca_chain(certificate, ca)
+
+  return {
+    "certificate": pem_armor_certificate(certificate).decode('utf8'),
+    "ca_chain": ca_chain
+  }
+
+def _issue(ca, role, signing_ca, body, ttl=None, alt_domains=None, alt_ips=None):
+  """
+  Issue a new EE certificate with a loaded CA
+
+  :param body:
+    Dict with the subject details and key type of the certificate
+
+  :return:
+    Dict with the certificate, CA chain and private key
+  """
+  subject = _construct_subject(body, parent=signing_ca.certificate_pem)
+
+  # Check against role, including any alt domains, before spending time on the key
+  with metrics.phase("role_check"):
+    cert_role = _check_role(ca, role, subject, alt_domains)
+
+  # Generate the key and create the certificate, including any alt domains and IPs
+  # The role sets the key type, unless the request asks for one
+  certificate, private_key = current_app.signer.build(ca, signing_ca, {
+    "subject": subject,
+    "key": _key_spec(body, cert_role),
+    "end_date": _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"])),
+    "alt_domains": alt_domains,
+    "alt_ips": alt_ips
+  })
+
+  # Store the certificate in case it needa to be revoked
+  # We store it using the serial number as the filename
+  filename = certificate.serial_number
+  path = _leaf_path(filename)
+  with metrics.phase("store"):
+    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate), path=path)
+    current_app.inventory.add(certificate, ca, filename, path=path, role=role)
+  metrics.issued(ca, role)
+
+  with metrics.phase("chain"):
+    ca_chain = _construct_ca_chain(certificate, ca)
+
+  return {
+    "certificate": pem_armor_certificate(certificate).decode('utf8'),
+    "ca_chain": ca_chain,
+    "private_key": private_key.decode('utf8')
+  }
 
 
 ############################
 #### API calls
 ############################
+@metrics.operation("cert.sign")
 def sign(ca, role, body, ttl=None):
-  _, _, der_bytes = pem.unarmor(body)
-  csr = CertificationRequest.load(der_bytes)
-
-  subject = csr["certification_request_info"]["subject"]
+  def _sign_admitted():
+    with admission.admit(ca, role):
+      return _sign(ca, role, _load_ca(ca), body, ttl)
 
   try:
-    signing_ca_certificate, signing_ca_private_key = _load_ca(ca)
-
-    # Create the certificate
-    builder = CertificateBuilder(
-        subject,
-        csr["certification_request_info"]["subject_pk_info"]
-    )
-
-    # Check against role
-    cert_role = _get_role(ca, role)
-    _check_role(ca, role, subject.native)
-    builder.end_date = _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"]))
-    builder.issuer = asymmetric.load_certificate(signing_ca_certificate)
-    certificate = builder.build(asymmetric.load_private_key(signing_ca_private_key, None))
-
-    # Store the certificate in case it needa to be revoked
-    # We store it using the serial number as the filename
-    filename = certificate.serial_number
-    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate))
-
-    return {
-      "certificate": pem_armor_certificate(certificate).decode('utf8'),
-      "ca_chain": _construct_ca_chain(certificate, ca)
-    }, 201
+    # Rejected before anything is looked up or recorded for the request
+    admission.check(ca, role)
+
+    def _state():
+      return _load_ca(ca).certificate_pem, _get_role_policy(ca, role).role
+
+    response, headers = idempotency.sign("cert.sign", ca, role, body, [ttl], _sign_admitted, _state)
+
+    return response, 201, headers
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+  except idempotency.ConflictException as e:
+    return str(e), 409
+  except admission.OverloadedException as e:
+    return e.response()
+
+@metrics.operation("cert.sign")
+def sign_batch(ca, role, body, ttl=None):
+  """
+  Sign many CSRs with a CA
+
+  The CA and role are loaded once, and the results are streamed as a JSON array.
+  Each item is either a CSR in PEM format, or a dict with the CSR and optionally a TTL.
+  """
+  try:
+    signing_ca = _load_ca(ca)
+    _ = _get_role_policy(ca, role)
+    admission.check(ca, role)
+
+    def _sign_item(item):
+      with admission.admit(ca, role, priority=admission.bulk):
+        if isinstance(item, dict):
+          return _sign(ca, role, signing_ca, item["csr"], item.get("ttl", ttl))
+        else:
+          return _sign(ca, role, signing_ca, item, ttl)
+
+    return batch.stream(body, _sign_item)
+  except NotFoundException as e:
+    return str(e), 404
+  except admission.OverloadedException as e:
+    return e.response()
 
+@metrics.operation("cert.issue")
 def issue(ca, role, body, ttl=None, alt_domains=None, alt_ips=None):
   try:
-    signing_ca_certificate, signing_ca_private_key = _load_ca(ca)
-
-    subject = _construct_subject(body, parent=signing_ca_certificate)
-
-    # Extract parameters
-    bit_size = int(body["size"])
-
-    # Generate and save the key and certificate for the root CA
-    public_key, private_key = asymmetric.generate_pair(encryption_schema, bit_size=bit_size)
-
-    # Create the certificate
-    builder = CertificateBuilder(
-        subject,
-        public_key
-    )
-
-    # Check and add any alt domains and IPs
-    if alt_domains:
-      for d in alt_domains:
-        _check_role(ca, role, {"common_name": d})
-      builder.subject_alt_domains = alt_domains
-    builder.subject_alt_ips = alt_ips
-
-    # Check against role
-    cert_role = _get_role(ca, role)
-    _check_role(ca, role, subject)
-    builder.end_date = _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"]))
-    builder.issuer = asymmetric.load_certificate(signing_ca_certificate)
-    certificate = builder.build(asymmetric.load_private_key(signing_ca_private_key, None))
-
-    # Store the certificate in case it needa to be revoked
-    # We store it using the serial number as the filename
-    filename = certificate.serial_number
-    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate))
-
-    return {
-      "certificate": pem_armor_certificate(certificate).decode('utf8'),
-      "ca_chain": _construct_ca_chain(certificate, ca),
-      "private_key": asymmetric.dump_private_key(private_key, None).decode('utf8')
-    }, 201
+    with admission.admit(ca, role):
+      return _issue(ca, role, _load_ca(ca), body, ttl, alt_domains, alt_ips), 201
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+  except admission.OverloadedException as e:
+    return e.response()
 
+@metrics.operation("cert.issue")
+def issue_batch(ca, role, body, ttl=None):
+  """
+  Issue many EE certificates with a CA
 
-def info(cert):
+  The CA and role are loaded once, and the results are streamed as a JSON array.
+  Each item holds the subject details, and optionally a TTL, alt domains and alt IPs.
+  """
   try:
-    certificate = current_app.certmanager.read_bytes(cert)
+    signing_ca = _load_ca(ca)
+    _ = _get_role_policy(ca, role)
+    admission.check(ca, role)
+
+    def _issue_item(item):
+      with admission.admit(ca, role, priority=admission.bulk):
+        return _issue(ca, role, signing_ca, item, item.get("ttl", ttl), item.get("alt_domains"), item.get("alt_ips"))
+
+    return batch.stream(body, _issue_item)
+  except NotFoundException as e:
+    return str(e), 404
+  except admission.OverloadedException as e:
+    return e.response()
 
-    c = crypto_keys.parse_certificate(certificate)
 
-    info = c.subject.native
-    info["serial"] = c.serial_number
-    # TODO add more details
+def _find_issuer(certificate):
+  """
+  Find the name of the CA which issued a certificate
 
-    return info
+  :return:
+    The name of the CA, or None if none of the CAs issued the certificate
+  """
+  for ca in current_app.secretmanager.list():
+    try:
+      if _load_ca(ca).certificate.asn1.subject == certificate.issuer:
+        return ca
+    except (NotFoundException, FileNotFoundError):
+      pass
+
+  return None
+
+def revoke(serial, reason=None):
+  try:
+    record = current_app.inventory.get(serial)
+
+    if record is None:
+      # Certificates issued before the inventory existed are added to it
+      certificate = crypto_keys.parse_certificate(_read_leaf(serial))
+      ca = _find_issuer(certificate)
+      if ca is None:
+        raise NotFoundException(f"Issuing CA of certificate {serial} not found")
+
+      current_app.inventory.add(certificate, ca, serial, path=_leaf_path(serial))
+      record = current_app.inventory.get(serial)
+
+    if not record["revoked"]:
+      crl.revoke(record["ca"], int(serial), datetime.fromisoformat(record["not_after"]), reason)
+      record = current_app.inventory.get(serial)
+
+    return record, 200
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+
+def list(prefix=None, cursor=None, limit=None, format=None):
+  """
+  List the serials of the stored leaf certificates
+
+  In the sharded layout the certificates are listed in storage order, which follows the serial hash.
+  The prefix filter is applied while listing, as the serials aren't stored in order.
+  """
+  if current_app.config["CERTS_LAYOUT"] == "sharded":
+    after = cursor.rpartition("/")[::2] if cursor else None
+    # Shard of each serial on the page, only kept for paged requests
+    shards = {}
+
+    def _serials():
+      for sub_path, name in current_app.certmanager.walk(leaf_dirname, after=after):
+        if prefix and not name.startswith(prefix):
+          continue
+        if limit is not None:
+          shards[name] = sub_path
+        yield name
+
+    return listing.respond(_serials(), limit, format, cursor_of=lambda name: f"{shards[name]}/{name}")
+
+  # Leaf certificates are stored next to the CA certificates, named by their serial
+  return listing.respond((name for name in current_app.certmanager.iterate(prefix=prefix, after=cursor) if name.isdigit()), limit, format)
+
+def _info(certificate):
+  c = crypto_keys.parse_certificate(certificate)
+
+  info = c.subject.native
+  info["serial"] = c.serial_number
+  # TODO add more details
+
+  return info
+
+def info(cert):
+  try:
+    certificate = _read_leaf(cert)
+
+    return _info(certificate)
+  except NotFoundException as e:
+    return str(e), 404
+  except InvalidValueException as e:
+    return str(e), 400
+
+async def info_async(cert, if_none_match=None):
+  """
+  Async variant of info, served by the ASGI app without blocking the event loop
+
+  The details aren't conditional, if_none_match is ignored.
+  """
+  try:
+    certificate = await _read_leaf_async(cert)
+  except NotFoundException as e:
+    return str(e), 404
+
+  return _info(certificate), 200
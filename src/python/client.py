@@ -1,16 +1,31 @@
 import json
 
-from oscrypto import asymmetric, keys as crypto_keys
-from certbuilder import CertificateBuilder, pem_armor_certificate
+from collections import namedtuple
+
+from oscrypto import keys as crypto_keys
+from certbuilder import pem_armor_certificate
 
 from asn1crypto import pem, x509
 from asn1crypto.csr import CertificationRequest
 
 from flask import current_app
-from ca import private_key_filename, NotFoundException, InvalidValueException, encryption_schema, _load_ca, _construct_subject, _construct_ca_chain, _calc_enddate
+from ca import private_key_filename, NotFoundException, InvalidValueException, _key_spec, _load_ca, _load_chain, _construct_subject, _construct_ca_chain, _calc_enddate
+
+import admission
+import batch
+import crl
+import httpcache
+import idempotency
+import listing
+import metrics
 
 client_filename = "client"
 
+# The resolved profile of a client role
+# cert_client and cert_role are the decoded client and client role, signing_ca the CAMaterial of the client CA
+# and parent_subject the subject of the CA certificate, which certificates inherit missing fields from
+ClientProfile = namedtuple("ClientProfile", ["cert_client", "cert_role", "ca", "signing_ca", "parent_subject"])
+
 def _check_role(client, role, subject):
   pass
 
@@ -23,11 +38,57 @@ def _get_client(client):
 def _get_client_role(client, role):
   _ = _get_client(client) # Check if client exists
 
+  return _read_client_role(client, role)
+
+def _read_client_role(client, role):
   if current_app.certmanager.exists(role, path=f"clients/{client}/roles/{role}"):
     return json.loads(current_app.certmanager.read_bytes(role, path=f"clients/{client}/roles/{role}"))
   else:
     raise NotFoundException(f"{role} client role not found")
 
+def _get_profile(client, role):
+  """
+  Get the resolved profile of a client role, with everything needed to issue or sign its certificates
+
+  The profile is kept in the profile cache until the client, the client role or the CA changes.
+
+  :return:
+    ClientProfile of the client role
+  """
+  profile = current_app.profile_cache.get((client, role))
+  if profile:
+    current_app.metrics.inc("certmanager_profile_cache_total", result="hit")
+    return profile
+
+  current_app.metrics.inc("certmanager_profile_cache_total", result="miss")
+  generation = current_app.profile_cache.generation()
+  cert_client = _get_client(client)
+  cert_role = _read_client_role(client, role)
+  signing_ca = _load_ca(cert_client["ca"])
+
+  return current_app.profile_cache.put((client, role), ClientProfile(
+    cert_client,
+    cert_role,
+    cert_client["ca"],
+    signing_ca,
+    signing_ca.certificate.asn1.subject.native
+  ), generation)
+
+def _subject(profile, body):
+  """
+  Construct the subject of a client certificate, the fields set by the client role take precedence
+  """
+  return {**_construct_subject(body, parent_subject=profile.parent_subject), **profile.cert_role["subject"]}
+
+def _drop_client(client, cert=None):
+  """
+  Drop the cached state for a client, or for one of its certificates, in this process
+  """
+  if cert is None:
+    current_app.profile_cache.pop_if(lambda key, _: key[0] == client)
+
+  httpcache.drop(client=client, cert=cert)
+
 def put_client(client, body):
   def _write_client(value):
     ca = value["ca"]
@@ -35,6 +96,7 @@ def put_client(client, body):
       raise NotFoundException(f"{ca} CA not found")
 
     current_app.certmanager.write_string(client_filename, json.dumps(value), path=f"clients/{client}")
+    current_app.invalidation.publish("client", client)
 
     return value
 
@@ -58,23 +120,28 @@ def delete_client(client):
     _ = _get_client(client)
 
     current_app.certmanager.delete(client, path=f"clients")
+    current_app.invalidation.publish("client", client)
   except NotFoundException as e:
     return str(e), 404
 
 def put_role(client, role, body):
   def _write_role(value):
     current_app.certmanager.write_string(role, json.dumps(value), f"clients/{client}/roles/{role}")
+    current_app.invalidation.publish("client", client)
 
     return value
 
   try:
     _ = _get_client(client)
+    _ = _key_spec(body) # Check the key type
     if current_app.certmanager.exists(role, path=f"clients/{client}/roles/{role}"):
       return _write_role({**_get_client_role(client, role), **body}), 200
     else:
       return _write_role(body), 201
   except NotFoundException as e:
     return str(e), 404
+  except InvalidValueException as e:
+    return str(e), 400
 
 def get_client_role(client, role):
   try:
@@ -88,124 +155,254 @@ def delete_client_role(client, role):
     cert_role = _get_client_role(client, role)
 
     current_app.certmanager.delete(role, f"clients/{client}/roles")
+    current_app.invalidation.publish("client", client)
   except NotFoundException as e:
     return str(e), 404
 
-def list_client_roles(client):
+def list_client_roles(client, prefix=None, cursor=None, limit=None, format=None):
   try:
     _ = _get_client(client)
 
-
-    return current_app.certmanager.list(path=f"clients/{client}/roles"), 200
-
-    if current_app.certmanager.exists(f"clients/{client}/roles"):
-      return current_app.certmanager.list(path=f"clients/{client}/roles"), 200
-    else:
-      return [], 200
-  except FileNotFoundError:
-    return [], 200
+    return listing.respond(current_app.certmanager.iterate(path=f"clients/{client}/roles", prefix=prefix, after=cursor), limit, format)
   except NotFoundException as e:
     return str(e), 404
 
-def list_clients():
-  return current_app.certmanager.list(path=f"clients"), 200
+def list_clients(prefix=None, cursor=None, limit=None, format=None):
+  return listing.respond(current_app.certmanager.iterate(path=f"clients", prefix=prefix, after=cursor), limit, format)
 
-def issue(client, role, body, ttl=None):
-  try:
-    cert_client = _get_client(client)
-    cert_role = _get_client_role(client, role)
+def _store_cert(client, role, ca, name, certificate):
+  """
+  Store an issued client certificate and add it to the inventory
 
-    ca = cert_client["ca"]
-    signing_ca_certificate, signing_ca_private_key = _load_ca(ca)
+  Only replacing a stored certificate is published to the other server processes,
+  a new certificate leaves nothing cached stale.
+  """
+  path = f"clients/{client}/certs"
+  replaced = current_app.certmanager.exists(name, path=path)
 
-    subject = _construct_subject(body, parent=signing_ca_certificate)
-    subject = {**subject, **cert_role["subject"]}
+  current_app.certmanager.write_bytes(name, pem_armor_certificate(certificate), path=path)
+  current_app.inventory.add(certificate, ca, name, path=path, role=role, client=client)
 
-    # Check against role
-    _check_role(client, role, subject)
+  if replaced:
+    current_app.invalidation.publish("client", client, name)
 
-    # Extract parameters
-    bit_size = int(cert_role["size"])
+def _issue(client, role, profile, body, ttl=None):
+  """
+  Issue a client certificate for a resolved client profile
 
-    # Generate and save the key and certificate for the root CA
-    public_key, private_key = asymmetric.generate_pair(encryption_schema, bit_size=bit_size)
+  :return:
+    Dict with the certificate, CA chain and private key
+  """
+  ca, cert_role = profile.ca, profile.cert_role
 
-    # Create the certificate
-    builder = CertificateBuilder(
-        subject,
-        public_key
-    )
+  subject = _subject(profile, body)
 
-    builder.end_date = _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"]))
-    builder.issuer = asymmetric.load_certificate(signing_ca_certificate)
-    builder.extended_key_usage = set(["client_auth"])
+  # Check against role
+  with metrics.phase("role_check"):
+    _check_role(client, role, subject)
 
-    certificate = builder.build(asymmetric.load_private_key(signing_ca_private_key, None))
+  # Generate the key and create the certificate
+  certificate, private_key = current_app.signer.build(ca, profile.signing_ca, {
+    "subject": subject,
+    "key": _key_spec(cert_role),
+    "end_date": _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"])),
+    "extended_key_usage": set(["client_auth"])
+  })
+
+  # Store the certificate in case it needa to be revoked
+  # We store it using the serial number as the filename
+  filename = subject["common_name"]
+  with metrics.phase("store"):
+    _store_cert(client, role, ca, filename, certificate)
+  metrics.issued(ca, role)
+
+  with metrics.phase("chain"):
+    ca_chain = _construct_ca_chain(certificate, ca)
+
+  return {
+    "certificate": pem_armor_certificate(certificate).decode('utf8'),
+    "ca_chain": ca_chain,
+    "private_key": private_key.decode('utf8')
+  }
+
+def _sign(client, role, profile, body, ttl=None, cn=None):
+  """
+  Sign a client CSR for a resolved client profile
+
+  :return:
+    Dict with the certificate and CA chain
+  """
+  ca, cert_role = profile.ca, profile.cert_role
+
+  _, _, der_bytes = pem.unarmor(body.encode('utf8') if isinstance(body, str) else body)
+  csr = CertificationRequest.load(der_bytes)
 
-    # Store the certificate in case it needa to be revoked
-    # We store it using the serial number as the filename
-    filename = subject["common_name"]
-    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate), path=f"clients/{client}/certs")
+  # Construct subject
+  csr_subject = csr["certification_request_info"]["subject"].native
+  if cn:
+    csr_subject["common_name"] = cn
+  subject = _subject(profile, csr_subject)
 
-    return {
-      "certificate": pem_armor_certificate(certificate).decode('utf8'),
-      "ca_chain": _construct_ca_chain(certificate, ca),
-      "private_key": asymmetric.dump_private_key(private_key, None).decode('utf8')
-    }, 201
+  # Check against role
+  with metrics.phase("role_check"):
+    _check_role(client, role, subject)
+
+  # Create the certificate
+  certificate, _ = current_app.signer.build(ca, profile.signing_ca, {
+    "subject": subject,
+    "public_key": csr["certification_request_info"]["subject_pk_info"],
+    "end_date": _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"])),
+    "extended_key_usage": set(["client_auth"])
+  })
+
+  # Store the certificate in case it needa to be revoked
+  # We store it using the serial number as the filename
+  filename = subject["common_name"]
+  with metrics.phase("store"):
+    _store_cert(client, role, ca, filename, certificate)
+  metrics.issued(ca, role)
+
+  with metrics.phase("chain"):
+    ca_chain = _construct_ca_chain(certificate, ca)
+
+  return {
+    "certificate": pem_armor_certificate(certificate).decode('utf8'),
+    "ca_chain": ca_chain
+  }
+
+@metrics.operation("client.renew")
+def _renew(client, role, name, serial):
+  """
+  Renew a stored client certificate ahead of its expiry
+
+  The certificate is signed again for the same subject and public key, and replaces the
+  stored certificate, so the client picks up the renewal the next time it fetches it.
+
+  :param name:
+    The name the certificate is stored with, its CN
+
+  :param serial:
+    The serial of the certificate to renew
+
+  :return:
+    The renewed asn1crypto.x509.Certificate, or None if the stored certificate was replaced since
+  """
+  profile = _get_profile(client, role)
+  ca, cert_role = profile.ca, profile.cert_role
+
+  if not current_app.certmanager.exists(name, path=f"clients/{client}/certs"):
+    return None
+
+  current = crypto_keys.parse_certificate(current_app.certmanager.read_bytes(name, path=f"clients/{client}/certs"))
+  if current.serial_number != serial:
+    return None
+
+  certificate, _ = current_app.signer.build(ca, profile.signing_ca, {
+    "subject": current.subject,
+    "public_key": current.public_key,
+    "end_date": _calc_enddate(None, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"])),
+    "extended_key_usage": set(["client_auth"])
+  })
+
+  with metrics.phase("store"):
+    current_app.certmanager.write_bytes(name, pem_armor_certificate(certificate), path=f"clients/{client}/certs")
+    current_app.inventory.add(certificate, ca, name, path=f"clients/{client}/certs", role=role, client=client)
+  current_app.invalidation.publish("client", client, name)
+  metrics.issued(ca, role)
+
+  return certificate
+
+@metrics.operation("client.issue")
+def issue(client, role, body, ttl=None):
+  try:
+    profile = _get_profile(client, role)
+
+    with admission.admit(profile.ca, role, client):
+      return _issue(client, role, profile, body, ttl), 201
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+  except admission.OverloadedException as e:
+    return e.response()
 
-def sign(client, role, body, ttl=None, cn=None):
-  cert_client = _get_client(client)
-  cert_role = _get_client_role(client, role)
-
-  _, _, der_bytes = pem.unarmor(body)
-  csr = CertificationRequest.load(der_bytes)
+@metrics.operation("client.issue")
+def issue_batch(client, role, body, ttl=None):
+  """
+  Issue many client certificates
 
+  The client profile is resolved once, and the results are streamed as a JSON array.
+  Each item holds the subject details, and optionally a TTL.
+  """
   try:
-    ca = cert_client["ca"]
-    signing_ca_certificate, signing_ca_private_key = _load_ca(ca)
+    profile = _get_profile(client, role)
+    admission.check(profile.ca, role, client)
 
-    # Construct subject
-    csr_subject = csr["certification_request_info"]["subject"].native
-    if cn:
-      csr_subject["common_name"] = cn
-    subject = _construct_subject(csr_subject, parent=signing_ca_certificate)
-    subject = {**subject, **cert_role["subject"]}
+    def _issue_item(item):
+      with admission.admit(profile.ca, role, client, admission.bulk):
+        return _issue(client, role, profile, item, item.get("ttl", ttl))
 
-    # Check against role
-    _check_role(client, role, subject)
+    return batch.stream(body, _issue_item)
+  except NotFoundException as e:
+    return str(e), 404
+  except admission.OverloadedException as e:
+    return e.response()
 
-    # Create the certificate
-    builder = CertificateBuilder(
-      subject,
-      csr["certification_request_info"]["subject_pk_info"]
-    )
+@metrics.operation("client.sign")
+def sign(client, role, body, ttl=None, cn=None):
+  def _sign_admitted():
+    profile = _get_profile(client, role)
 
-    builder.end_date = _calc_enddate(ttl, cert_role.get("max_ttl", current_app.config["CERT_MAX_TTL"]), cert_role.get("default_ttl", current_app.config["CERT_DEFAULT_TTL"]))
-    builder.issuer = asymmetric.load_certificate(signing_ca_certificate)
-    builder.extended_key_usage = set(["client_auth"])
+    with admission.admit(profile.ca, role, client):
+      return _sign(client, role, profile, body, ttl, cn)
 
-    certificate = builder.build(asymmetric.load_private_key(signing_ca_private_key, None))
+  try:
+    # Rejected before anything is looked up or recorded for the request
+    admission.check(_get_profile(client, role).ca, role, client)
 
-    # Store the certificate in case it needa to be revoked
-    # We store it using the serial number as the filename
-    filename = subject["common_name"]
-    current_app.certmanager.write_bytes(filename, pem_armor_certificate(certificate), path=f"clients/{client}/certs")
+    def _state():
+      profile = _get_profile(client, role)
+      return profile.signing_ca.certificate_pem, [profile.cert_client, profile.cert_role]
 
-    return {
-      "certificate": pem_armor_certificate(certificate).decode('utf8'),
-      "ca_chain": _construct_ca_chain(certificate, ca)
-    }, 201
+    response, headers = idempotency.sign("client.sign", client, role, body, [ttl, cn], _sign_admitted, _state)
+
+    return response, 201, headers
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
     return str(e), 400
+  except idempotency.ConflictException as e:
+    return str(e), 409
+  except admission.OverloadedException as e:
+    return e.response()
+
+@metrics.operation("client.sign")
+def sign_batch(client, role, body, ttl=None):
+  """
+  Sign many client CSRs
+
+  The client profile is resolved once, and the results are streamed as a JSON array.
+  Each item is either a CSR in PEM format, or a dict with the CSR and optionally a TTL and CN override.
+  """
+  try:
+    profile = _get_profile(client, role)
+    admission.check(profile.ca, role, client)
+
+    def _sign_item(item):
+      with admission.admit(profile.ca, role, client, admission.bulk):
+        if isinstance(item, dict):
+          return _sign(client, role, profile, item["csr"], item.get("ttl", ttl), item.get("cn"))
+        else:
+          return _sign(client, role, profile, item, ttl)
+
+    return batch.stream(body, _sign_item)
+  except NotFoundException as e:
+    return str(e), 404
+  except admission.OverloadedException as e:
+    return e.response()
 
 def get_cert(client, cert):
-  try:
+  def _load():
     cert_client = _get_client(client)
     ca = cert_client["ca"]
 
@@ -213,11 +410,38 @@ def get_cert(client, cert):
       raise NotFoundException(f"{client} client cert CN={cert} not found")
 
     certificate = current_app.certmanager.read_bytes(cert, path=f"clients/{client}/certs")
+    chain, path = _load_chain(ca)
 
     return {
       "certificate": certificate.decode('utf8'),
-      "ca_chain": _construct_ca_chain(crypto_keys.parse_certificate(certificate), ca)
-    }, 200
+      "ca_chain": pem_armor_certificate(crypto_keys.parse_certificate(certificate)).decode('utf8') + chain
+    }, path
+
+  try:
+    return httpcache.respond(("client", client, cert), _load, public=False)
+  except NotFoundException as e:
+    return str(e), 404
+  except InvalidValueException as e:
+    return str(e), 400
+
+def revoke_cert(client, cert, reason=None):
+  try:
+    cert_client = _get_client(client)
+
+    if not current_app.certmanager.exists(cert, path=f"clients/{client}/certs"):
+      raise NotFoundException(f"{client} client cert CN={cert} not found")
+
+    certificate = crypto_keys.parse_certificate(current_app.certmanager.read_bytes(cert, path=f"clients/{client}/certs"))
+    serial = certificate.serial_number
+
+    # Certificates issued before the inventory existed are added to it
+    if current_app.inventory.get(serial) is None:
+      current_app.inventory.add(certificate, cert_client["ca"], cert, path=f"clients/{client}/certs", client=client)
+
+    if not current_app.inventory.get(serial)["revoked"]:
+      crl.revoke(cert_client["ca"], serial, certificate["tbs_certificate"]["validity"]["not_after"].native, reason)
+
+    return current_app.inventory.get(serial), 200
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
@@ -231,6 +455,7 @@ def delete_cert(client, cert):
       raise NotFoundException(f"{client} client cert CN={cert} not found")
 
     current_app.certmanager.delete(cert, path=f"clients/{client}/certs")
+    current_app.invalidation.publish("client", client, cert)
 
   except NotFoundException as e:
     return str(e), 404
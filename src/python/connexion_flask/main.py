@@ -2,12 +2,36 @@ from email.mime import application
 import connexion
 
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from manager.file import FileSecretManager
 from manager.file import FileCertificateManager
+from manager.sqlite import SqliteSecretManager
+from manager.sqlite import SqliteCertificateManager
+from keypool import KeyPool
+from cache import LRUCache
+from signer import Signer
+from inventory import Inventory
+from crl import CRLCache
+from ocsp import OCSPResponder
+from invalidation import InvalidationLog
+from renewal import RenewalScheduler
+from warmup import WarmUp
+from admission import AdmissionControl
+from idempotency import IdempotencyCache
+
+import ca
+import client
+import crl
+import metrics
+import role
+import prefork
 
 class App:
-    def __init__(self, specification_dir='openapi/', spec_filename='openapi.yaml'):
+    def __init__(self, specification_dir='openapi/', spec_filename='openapi.yaml', run=True):
+        started = time.monotonic()
         self.app = connexion.App(__name__, specification_dir=specification_dir)
         self.app.add_api(
             spec_filename,
@@ -22,17 +46,113 @@ class App:
         # Set configuration
         self.application.config["SECRETS_PATH"] = os.getenv("SECRETS_PATH", "/secrets")
         self.application.config["CERTS_PATH"] = os.getenv("CERTS_PATH", "/certs")
+        self.application.config["STORAGE_BACKEND"] = os.getenv("STORAGE_BACKEND", "file")  # file or sqlite
+        self.application.config["SECRETS_DB"] = os.getenv("SECRETS_DB", f'{self.application.config["SECRETS_PATH"]}/secrets.db')
+        self.application.config["CERTS_DB"] = os.getenv("CERTS_DB", f'{self.application.config["CERTS_PATH"]}/certs.db')
+        self.application.config["FILE_SYNC"] = os.getenv("FILE_SYNC", "none")  # File backend: none leaves flushing to the OS, batch (group commit) or always flushes each write to disk
+        self.application.config["FILE_SYNC_WINDOW"] = os.getenv("FILE_SYNC_WINDOW", 2)   # File backend: milliseconds a write waits for others to flush with
+        self.application.config["FILE_SYNC_MAX_BATCH"] = os.getenv("FILE_SYNC_MAX_BATCH", 256)   # File backend: files flushed together at most
+        self.application.config["CERTS_LAYOUT"] = os.getenv("CERTS_LAYOUT", "flat")   # flat stores leaf certificates next to the CA certificates, sharded under leaf/<xx>/<yy>, run manager.shard before switching
+        self.application.config["INVENTORY_DB"] = os.getenv("INVENTORY_DB", f'{self.application.config["CERTS_PATH"]}/inventory.db')
+        self.application.config["CRL_BASE_URL"] = os.getenv("CRL_BASE_URL", f'http://{os.getenv("API_HOST", "localhost")}:{os.getenv("API_PORT", 8080)}/1.0/crl')   # CRLs are published at <base>/<CA>
+        self.application.config["CRL_VALIDITY"] = os.getenv("CRL_VALIDITY", 24)    # Hours until the next CRL update
+        self.application.config["CRL_LOCK"] = os.getenv("CRL_LOCK", f'{self.application.config["CERTS_PATH"]}/crl.lock')   # Held by the server process signing CRLs, so CRL numbers are never reused
+        self.application.config["OCSP_VALIDITY"] = os.getenv("OCSP_VALIDITY", 24)  # Hours an OCSP response is valid
+        self.application.config["OCSP_REFRESH_WINDOW"] = os.getenv("OCSP_REFRESH_WINDOW", 12)  # Hours before expiry an OCSP response is re-signed
+        self.application.config["OCSP_REFRESH_INTERVAL"] = os.getenv("OCSP_REFRESH_INTERVAL", 60)  # Seconds between checks for OCSP responses to re-sign, 0 disables re-signing
         self.application.config["CA_ROOT_TTL"] = os.getenv("CA_ROOT_TTL", 87600)    # 10 years
         self.application.config["CA_INTERMEDIATE_TTL"] = os.getenv("CA_INTERMEDIATE_TTL", 43800)    # 5 years
         self.application.config["CA_MAX_TTL"] = os.getenv("CA_MAX_TTL", 175200) # 20 years
         self.application.config["CERT_DEFAULT_TTL"] = os.getenv("CERT_DEFAULT_TTL", 720)    # 1 month
         self.application.config["CERT_MAX_TTL"] = os.getenv("CERT_MAX_TTL", 9490)   # 13 months
+        self.application.config["KEY_POOL_SIZE"] = os.getenv("KEY_POOL_SIZE", 0)    # Keys kept ready per pool, 0 disables the pool
+        self.application.config["KEY_POOL_WORKERS"] = os.getenv("KEY_POOL_WORKERS", 2)
+        self.application.config["KEY_POOL_SPECS"] = os.getenv("KEY_POOL_SPECS", "rsa:2048")  # Pools to fill at startup, as <algorithm>:<bits>,...
+        self.application.config["CA_CACHE_SIZE"] = os.getenv("CA_CACHE_SIZE", 128)  # Number of loaded CAs kept in memory
+        self.application.config["CHAIN_CACHE_SIZE"] = os.getenv("CHAIN_CACHE_SIZE", 128)    # Number of CA chains kept in memory
+        self.application.config["ROLE_CACHE_SIZE"] = os.getenv("ROLE_CACHE_SIZE", 1024) # Number of compiled roles kept in memory
+        self.application.config["PROFILE_CACHE_SIZE"] = os.getenv("PROFILE_CACHE_SIZE", 1024)   # Number of resolved client profiles kept in memory
+        self.application.config["ETAG_CACHE_SIZE"] = os.getenv("ETAG_CACHE_SIZE", 4096) # Number of certificate response ETags kept in memory, to answer If-None-Match without loading anything
+        self.application.config["HTTP_CACHE_MAX_AGE"] = os.getenv("HTTP_CACHE_MAX_AGE", 3600)   # Seconds certificate responses may be cached for at most, they are never cached past the expiry of the certificates
+        self.application.config["BATCH_WORKERS"] = os.getenv("BATCH_WORKERS", os.cpu_count() or 4)  # Threads signing batch items
+        self.application.config["SIGNING_WORKERS"] = os.getenv("SIGNING_WORKERS", 0)    # Processes signing certificates, 0 signs on the request thread
+        self.application.config["ASGI_READ_WORKERS"] = os.getenv("ASGI_READ_WORKERS", 32)  # ASGI mode: threads running read requests
+        self.application.config["ASGI_WRITE_WORKERS"] = os.getenv("ASGI_WRITE_WORKERS", os.cpu_count() or 4)  # ASGI mode: threads running write requests
+        self.application.config["ASGI_IO_WORKERS"] = os.getenv("ASGI_IO_WORKERS", 32)  # ASGI mode: threads running async storage I/O
+        self.application.config["RENEWAL_INTERVAL"] = os.getenv("RENEWAL_INTERVAL", 60)   # Seconds between checks for new client certificates to track, 0 disables the renewal scheduler
+        self.application.config["RENEWAL_BEFORE"] = os.getenv("RENEWAL_BEFORE", 168)    # Hours before expiry a client certificate is due, unless its client role sets renew_before
+        self.application.config["RENEWAL_SPREAD"] = os.getenv("RENEWAL_SPREAD", 24) # Hours the due times are spread over
+        self.application.config["RENEWAL_BATCH_SIZE"] = os.getenv("RENEWAL_BATCH_SIZE", 50)   # Due certificates handled per batch
+        self.application.config["RENEWAL_WORKERS"] = os.getenv("RENEWAL_WORKERS", 2)    # Threads renewing certificates
+        self.application.config["RENEWAL_LOCK"] = os.getenv("RENEWAL_LOCK", f'{self.application.config["CERTS_PATH"]}/renewal.lock')   # Only the server process holding this lock schedules renewals
+        self.application.config["ADMISSION_CA_CONCURRENCY"] = os.getenv("ADMISSION_CA_CONCURRENCY", 16)   # Certificates signed at once per CA, 0 for no limit
+        self.application.config["ADMISSION_ROLE_CONCURRENCY"] = os.getenv("ADMISSION_ROLE_CONCURRENCY", 8)   # Certificates signed at once per role or client role, 0 for no limit
+        self.application.config["ADMISSION_CA_RATE"] = os.getenv("ADMISSION_CA_RATE", 0)    # Certificates signed per second per CA, 0 for no limit
+        self.application.config["ADMISSION_CA_BURST"] = os.getenv("ADMISSION_CA_BURST", 0)  # Certificates a CA may sign at once over its rate, defaults to the rate
+        self.application.config["ADMISSION_ROLE_RATE"] = os.getenv("ADMISSION_ROLE_RATE", 0)    # Certificates signed per second per role or client role, 0 for no limit
+        self.application.config["ADMISSION_ROLE_BURST"] = os.getenv("ADMISSION_ROLE_BURST", 0)  # Certificates a role may sign at once over its rate, defaults to the rate
+        self.application.config["ADMISSION_QUEUE_SIZE"] = os.getenv("ADMISSION_QUEUE_SIZE", 64)    # Single requests waiting per CA or role before rejecting with a 503, 0 for no limit
+        self.application.config["ADMISSION_QUEUE_TIMEOUT"] = os.getenv("ADMISSION_QUEUE_TIMEOUT", 5000)   # Milliseconds a single request waits to be admitted before rejecting with a 503
+        self.application.config["IDEMPOTENCY_WINDOW"] = os.getenv("IDEMPOTENCY_WINDOW", 600)  # Seconds a signing request is deduplicated for, 0 turns deduplication off
+        self.application.config["IDEMPOTENCY_CSR_DEDUP"] = os.getenv("IDEMPOTENCY_CSR_DEDUP", 0)  # 1 also deduplicates signing requests without an Idempotency-Key by their CSR, 0 only by the key
+        self.application.config["IDEMPOTENCY_CACHE_SIZE"] = os.getenv("IDEMPOTENCY_CACHE_SIZE", 4096)    # Number of signing responses kept in memory for deduplication
+        self.application.config["WARMUP_WORKERS"] = os.getenv("WARMUP_WORKERS", 8)   # Threads loading the CAs, chains and roles at startup, 0 skips the warm-up
+        self.application.config["WORKERS"] = os.getenv("WORKERS", 1)  # Server processes, above 1 pre-forks the workers, and in ASGI mode set to the number of uvicorn workers
+        self.application.config["INVALIDATION_LOG"] = os.getenv("INVALIDATION_LOG", f'{self.application.config["CERTS_PATH"]}/invalidation.log')    # Changes shared between server processes
+        self.application.config["INVALIDATION_LOG_MAX_SIZE"] = os.getenv("INVALIDATION_LOG_MAX_SIZE", 1024 * 1024)  # Bytes the invalidation log grows to before it is rotated
+        self.application.config["METRICS_BUCKETS"] = os.getenv("METRICS_BUCKETS")  # Histogram buckets in seconds, as <bound>,<bound>,...
 
         # Add objects to the application context
-        self.application.secretmanager = FileSecretManager(self.application)
-        self.application.certmanager = FileCertificateManager(self.application)
+        if self.application.config["STORAGE_BACKEND"] == "sqlite":
+            self.application.secretmanager = SqliteSecretManager(self.application)
+            self.application.certmanager = SqliteCertificateManager(self.application)
+        else:
+            self.application.secretmanager = FileSecretManager(self.application)
+            self.application.certmanager = FileCertificateManager(self.application)
+        self.application.keypool = KeyPool(self.application)
+        metrics.register(self.application)    # Serves /metrics next to the API
+        self.application.ca_cache = LRUCache(self.application.config["CA_CACHE_SIZE"])
+        self.application.chain_cache = LRUCache(self.application.config["CHAIN_CACHE_SIZE"])
+        self.application.role_cache = LRUCache(self.application.config["ROLE_CACHE_SIZE"])
+        self.application.profile_cache = LRUCache(self.application.config["PROFILE_CACHE_SIZE"])
+        self.application.etag_cache = LRUCache(self.application.config["ETAG_CACHE_SIZE"])
+        self.application.batch_executor = ThreadPoolExecutor(int(self.application.config["BATCH_WORKERS"]), thread_name_prefix="batch")
+        self.application.signer = Signer(self.application)
+        self.application.inventory = Inventory(self.application)
+        self.application.crls = CRLCache(self.application)
+        self.application.ocsp = OCSPResponder(self.application)
+        self.application.renewals = RenewalScheduler(self.application)
+        self.application.warmup = WarmUp(self.application, started)
+        self.application.admission = AdmissionControl(self.application)
+        self.application.idempotency = IdempotencyCache(self.application)
+        self.application.invalidation = InvalidationLog(self.application, shared=int(self.application.config["WORKERS"]) > 1)
+        self.application.invalidation.subscribe("ca", ca._drop_ca)
+        self.application.invalidation.subscribe("role", role._drop_role)
+        self.application.invalidation.subscribe("client", client._drop_client)
+        self.application.invalidation.subscribe("revocation", crl._drop_revocations)
+        self.application.invalidation.subscribe("reset", ca._drop_all)   # Published after restoring a backup
+        self.application.invalidation.on_reset(ca._drop_all)
+        self.application.before_request(self.application.invalidation.poll)
+
+        if run:
+            self.run()
+        else:
+            self.start()
+
+    def start(self):
+        # Start the background services, in each worker when pre-forking
+        self.application.warmup.start()
+        self.application.keypool.start()
+        self.application.ocsp.start()
+        self.application.renewals.start()
 
+    def run(self):
         print(self.application.config)
 
         # Start the app
-        self.app.run(port=os.getenv('API_PORT', 8080))
+        workers = int(self.application.config["WORKERS"])
+        if workers > 1:
+            prefork.serve(self.application, '0.0.0.0', os.getenv('API_PORT', 8080), workers, after_fork=self.start)
+        else:
+            self.start()
+            self.app.run(port=os.getenv('API_PORT', 8080))
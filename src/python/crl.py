@@ -0,0 +1,373 @@
+import bisect
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from asn1crypto.crl import CertificateList
+from crlbuilder import CertificateListBuilder, pem_armor_crl
+
+from flask import current_app, request, Response
+
+from ca import _load_ca, _signature_hash, NotFoundException, InvalidValueException
+
+crl_number_filename = "crl_number"
+delta_base_filename = "delta_base"
+crl_filename = "crl"
+delta_crl_filename = "delta_crl"
+
+# The CRL state of a CA, written together by whichever server process signs its CRLs
+state_filenames = [crl_number_filename, delta_base_filename, crl_filename, delta_crl_filename]
+
+# Reasons accepted when revoking a certificate
+revocation_reasons = [
+  "key_compromise",
+  "ca_compromise",
+  "affiliation_changed",
+  "superseded",
+  "cessation_of_operation",
+  "certificate_hold",
+  "privilege_withdrawn"
+]
+
+def _blob(certificate_list):
+  """
+  Encode a signed CRL for serving
+
+  :return:
+    Dict with the DER and PEM encoding, the ETag, the CRL number and the update times
+  """
+  der = certificate_list.dump()
+
+  return {
+    "der": der,
+    "pem": pem_armor_crl(certificate_list),
+    "etag": hashlib.sha256(der).hexdigest()[:32],
+    "number": certificate_list.crl_number_value.native,
+    "this_update": certificate_list["tbs_cert_list"]["this_update"].native,
+    "next_update": certificate_list["tbs_cert_list"]["next_update"].native
+  }
+
+class RevocationList():
+  """
+  The revoked certificates of a single CA
+
+  The revoked serials are kept sorted, with a heap on expiry so expired entries are dropped
+  without scanning the list. Every generation signs a full CRL and a delta CRL holding the
+  certificates revoked since the full CRL of the previous generation, its base. Both are
+  kept as encoded blobs, so serving a CRL never signs anything.
+
+  The delta is selected by revocation time rather than tracked in memory, so revocations
+  loaded from the inventory, e.g. in another server process, are never missed. The number
+  and time of the base are stored with the CRL number, so they survive reloads.
+  """
+  def __init__(self, ca, entries):
+    self.ca = ca
+    self.number = 0
+    # The number and datetime of the last full CRL, None if none was signed yet
+    self.base_number = None
+    self.base_updated = None
+    self.base = None
+    self.delta = None
+    self.this_update = None
+    self.lock = threading.Lock()
+
+    self.load(entries)
+
+  def load(self, entries):
+    """
+    Replace the revoked certificates
+
+    :param entries:
+      List of tuples of the serial, the revocation datetime, the reason and the expiry datetime
+    """
+    self.serials = []
+    self.entries = {}
+    self.expiry = []
+
+    for serial, revoked_at, reason, not_after in entries:
+      self.add(serial, revoked_at, reason, not_after)
+
+  def add(self, serial, revoked_at, reason, not_after):
+    if serial in self.entries:
+      return
+
+    bisect.insort(self.serials, serial)
+    self.entries[serial] = (revoked_at, reason)
+    heapq.heappush(self.expiry, (not_after, serial))
+
+  def drop_expired(self, now):
+    while self.expiry and self.expiry[0][0] < now:
+      _, serial = heapq.heappop(self.expiry)
+
+      del self.entries[serial]
+      self.serials.pop(bisect.bisect_left(self.serials, serial))
+
+  def _build(self, ca_material, url, now, validity, delta_of=None, serials=None):
+    builder = CertificateListBuilder(url, ca_material.certificate, self.number)
+    builder.this_update = now
+    builder.next_update = now + validity
+    builder.hash_algo = _signature_hash(ca_material.private_key)
+
+    if delta_of is None:
+      builder.delta_crl_url = f"{url}/delta"
+    else:
+      builder.delta_of = delta_of
+
+    for serial in (self.serials if serials is None else serials):
+      if serial in self.entries:
+        revoked_at, reason = self.entries[serial]
+        builder.add_certificate(serial, revoked_at, reason)
+
+    return _blob(builder.build(ca_material.private_key))
+
+  def generate(self, ca_material, url, validity):
+    """
+    Sign a new full and delta CRL
+    """
+    now = datetime.now(timezone.utc)
+    self.drop_expired(now)
+
+    base_number, since = self.base_number, self.base_updated
+
+    self.number += 1
+    full_number = self.number
+    self.base = self._build(ca_material, url, now, validity)
+
+    if base_number is None:
+      # Without an earlier full CRL the new one is the base, and the delta gets the next number
+      base_number, since = full_number, now
+      self.number += 1
+
+    # Revocation times are stored in whole seconds, so revocations in the second of the base are repeated
+    since = since.replace(microsecond=0)
+    self.delta = self._build(
+      ca_material, url, now, validity,
+      delta_of=base_number,
+      serials=[serial for serial in self.serials if self.entries[serial][0] >= since]
+    )
+
+    self.base_number = full_number
+    self.base_updated = now
+    self.this_update = now
+
+class CRLCache():
+  """
+  The revocation lists of all CAs, loaded on first use from the inventory
+
+  The CRL number, the delta base and the signed CRLs of each CA are stored, and every server
+  process signs new CRLs under the CRL lock, a file lock shared by all of them. Under the lock
+  the stored state is read again first: if another process signed since, its revocations are
+  loaded from the inventory and its CRLs are served as they are, unless new ones are needed.
+  So CRL numbers are never reused or go backwards, and every process serves the same CRLs.
+  """
+  def __init__(self, app):
+    self.base_url = app.config["CRL_BASE_URL"].rstrip("/")
+    self.validity = timedelta(hours=int(app.config["CRL_VALIDITY"]))
+    self.lock_path = app.config["CRL_LOCK"]
+
+    self._lists = {}
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def _locked(self):
+    """
+    Hold the CRL lock, shared by all server processes
+    """
+    fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield
+    finally:
+      os.close(fd)
+
+  def _read_state(self, revocation_list):
+    """
+    Read the stored CRL state of a CA into its revocation list
+
+    :return:
+      True if it was changed by another process since it was last read
+    """
+    path = f"crl/{revocation_list.ca}"
+    try:
+      number = int(current_app.certmanager.read_string(crl_number_filename, path=path))
+    except FileNotFoundError:
+      number = 0
+
+    if number == revocation_list.number:
+      return False
+
+    revocation_list.number = number
+    revocation_list.base_number, revocation_list.base_updated = None, None
+    revocation_list.base, revocation_list.delta, revocation_list.this_update = None, None, None
+
+    try:
+      delta_base = json.loads(current_app.certmanager.read_string(delta_base_filename, path=path))
+      revocation_list.base_number = delta_base["number"]
+      revocation_list.base_updated = datetime.fromtimestamp(delta_base["updated"], tz=timezone.utc)
+
+      base = _blob(CertificateList.load(current_app.certmanager.read_bytes(crl_filename, path=path)))
+      delta = _blob(CertificateList.load(current_app.certmanager.read_bytes(delta_crl_filename, path=path)))
+    except FileNotFoundError:
+      return True
+
+    # Only served if they are the CRLs the stored number was taken by, they are signed again otherwise
+    if base["number"] == revocation_list.base_number and delta["number"] == number:
+      revocation_list.base, revocation_list.delta, revocation_list.this_update = base, delta, base["this_update"]
+
+    return True
+
+  def _get(self, ca):
+    with self._lock:
+      revocation_list = self._lists.get(ca)
+      if revocation_list is None:
+        revocation_list = self._lists[ca] = RevocationList(ca, current_app.inventory.revoked(ca, datetime.now(timezone.utc)))
+        self._read_state(revocation_list)
+
+      return revocation_list
+
+  def _stale(self, revocation_list):
+    return revocation_list.this_update is None or datetime.now(timezone.utc) > revocation_list.this_update + self.validity / 2
+
+  def _generate(self, revocation_list, force=False):
+    """
+    Sign new CRLs for a CA, unless another process signed current ones meanwhile
+
+    :param force:
+      Always sign new CRLs, e.g. after a revocation
+    """
+    with self._locked():
+      if self._read_state(revocation_list):
+        # Signed by another process since, which may have revoked certificates this one doesn't know of
+        revocation_list.load(current_app.inventory.revoked(revocation_list.ca, datetime.now(timezone.utc)))
+
+      if not force and not self._stale(revocation_list):
+        return
+
+      revocation_list.generate(_load_ca(revocation_list.ca), f"{self.base_url}/{revocation_list.ca}", self.validity)
+
+      path = f"crl/{revocation_list.ca}"
+      # The number is written last, the other files are only used once it matches them
+      current_app.certmanager.write_many([
+        (crl_filename, revocation_list.base["der"], path),
+        (delta_crl_filename, revocation_list.delta["der"], path),
+        (delta_base_filename, json.dumps({
+          "number": revocation_list.base_number,
+          "updated": revocation_list.base_updated.timestamp()
+        }).encode("utf8"), path)
+      ])
+      current_app.certmanager.write_string(crl_number_filename, str(revocation_list.number), path=path)
+
+  def revoke(self, ca, serial, revoked_at, reason, not_after):
+    """
+    Add a certificate to the revocation list of a CA and sign new CRLs
+    """
+    revocation_list = self._get(ca)
+
+    with revocation_list.lock:
+      revocation_list.add(serial, revoked_at, reason, not_after)
+      self._generate(revocation_list, force=True)
+
+  def get(self, ca, delta=False):
+    """
+    Get the current CRL of a CA
+
+    A new CRL is only signed once the current one has passed half its validity.
+
+    :return:
+      Dict with the encoded CRL, see _blob
+    """
+    revocation_list = self._get(ca)
+
+    with revocation_list.lock:
+      if self._stale(revocation_list):
+        self._generate(revocation_list)
+
+      return revocation_list.delta if delta else revocation_list.base
+
+  def invalidate(self, ca):
+    with self._lock:
+      self._lists.pop(ca, None)
+
+  def clear(self):
+    with self._lock:
+      self._lists.clear()
+
+def revoke(ca, serial, not_after, reason=None):
+  """
+  Revoke a certificate issued by a CA
+
+  :param ca:
+    The name of the issuing CA
+
+  :param serial:
+    The serial of the certificate, as an integer
+
+  :param not_after:
+    The expiry datetime of the certificate
+
+  :param reason:
+    The revocation reason, one of revocation_reasons
+
+  :return:
+    The revocation datetime
+  """
+  reason = reason or "cessation_of_operation"
+  if reason not in revocation_reasons:
+    raise InvalidValueException(f"Invalid revocation reason {reason}")
+
+  revoked_at = datetime.now(timezone.utc).replace(microsecond=0)
+
+  current_app.inventory.revoke(serial, revoked_at, reason)
+  current_app.crls.revoke(ca, serial, revoked_at, reason, not_after)
+  current_app.ocsp.revoke(ca, serial, revoked_at, reason, not_after)
+  current_app.invalidation.publish("revocation", ca, local=False)
+
+  return revoked_at
+
+def _drop_revocations(ca):
+  """
+  Drop the revocation list and certificate statuses of a CA in this process, after a revocation in another process
+  """
+  current_app.crls.invalidate(ca)
+  current_app.ocsp.invalidate(ca)
+
+def _response(blob, format=None):
+  max_age = max(0, int((blob["next_update"] - datetime.now(timezone.utc)).total_seconds()))
+  headers = {
+    "ETag": f'"{blob["etag"]}"',
+    "Cache-Control": f"public, max-age={max_age}"
+  }
+
+  if request.if_none_match.contains(blob["etag"]):
+    return Response(status=304, headers=headers)
+
+  if format == "pem":
+    return Response(blob["pem"], status=200, mimetype="application/x-pem-file", headers=headers)
+  else:
+    return Response(blob["der"], status=200, mimetype="application/pkix-crl", headers=headers)
+
+
+############################
+#### API calls
+############################
+def get_crl(ca, format=None):
+  try:
+    _ = _load_ca(ca) # Check if the CA exists
+
+    return _response(current_app.crls.get(ca), format)
+  except NotFoundException as e:
+    return str(e), 404
+
+def get_delta_crl(ca, format=None):
+  try:
+    _ = _load_ca(ca) # Check if the CA exists
+
+    return _response(current_app.crls.get(ca, delta=True), format)
+  except NotFoundException as e:
+    return str(e), 404
@@ -0,0 +1,104 @@
+import hashlib
+
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from asn1crypto import pem, x509
+from flask import current_app, request
+from werkzeug.datastructures import ETags
+
+# The validators last sent for a resource
+# cas are the CAs the response depends on, public is False for responses only meant for their client
+Validator = namedtuple("Validator", ["etag", "not_after", "cas", "public"])
+
+def _pem(body):
+  """
+  Get the PEM certificates of a response body, a PEM string or a dict of PEM strings
+  """
+  return "".join(body.values()) if isinstance(body, dict) else body
+
+def _validator(body, cas, public):
+  data = _pem(body).encode("utf8")
+  not_after = min(
+    x509.Certificate.load(der)["tbs_certificate"]["validity"]["not_after"].native
+    for _, _, der in pem.unarmor(data, multiple=True)
+  )
+
+  return Validator(hashlib.sha256(data).hexdigest()[:32], not_after, tuple(cas), public)
+
+def _headers(validator):
+  max_age = min(
+    max(0, int((validator.not_after - datetime.now(timezone.utc)).total_seconds())),
+    int(current_app.config["HTTP_CACHE_MAX_AGE"])
+  )
+
+  return {
+    "ETag": f'"{validator.etag}"',
+    "Cache-Control": f"{'public' if validator.public else 'private'}, max-age={max_age}"
+  }
+
+def _not_modified(key, if_none_match):
+  validator = current_app.etag_cache.get(key)
+  if validator and if_none_match.contains(validator.etag):
+    return "", 304, _headers(validator)
+
+  return None
+
+def _modified(key, loaded, public, if_none_match):
+  body, cas = loaded
+  validator = current_app.etag_cache.get(key) or current_app.etag_cache.put(key, _validator(body, cas, public))
+
+  if if_none_match.contains(validator.etag):
+    return "", 304, _headers(validator)
+
+  return body, 200, _headers(validator)
+
+def respond(key, load, public=True, if_none_match=None):
+  """
+  Respond with certificate material, with a strong ETag and a Cache-Control lifetime
+
+  The ETag is the hash of the PEM certificates in the response, the lifetime runs until the
+  first of them expires, capped at HTTP_CACHE_MAX_AGE. The ETag of each resource is kept in
+  the ETag cache, so a request with a matching If-None-Match is answered with a 304 before
+  anything is loaded. The entries are dropped whenever one of the CAs or the client changes.
+
+  :param key:
+    Key of the resource in the ETag cache
+
+  :param load:
+    Function returning the response body, a PEM string or a dict of PEM strings,
+    and the names of the CAs the response depends on
+
+  :param public:
+    Whether shared caches may store the response
+
+  :param if_none_match:
+    The ETags of the request, taken from the Flask request if not set
+
+  :return:
+    Tuple of the body, the status and the headers
+  """
+  if if_none_match is None:
+    if_none_match = request.if_none_match
+
+  return _not_modified(key, if_none_match) or _modified(key, load(), public, if_none_match)
+
+async def respond_async(key, load, public=True, if_none_match=None):
+  """
+  Async variant of respond, with a coroutine function loading the body
+  """
+  if if_none_match is None:
+    if_none_match = ETags()
+
+  return _not_modified(key, if_none_match) or _modified(key, await load(), public, if_none_match)
+
+def drop(ca=None, client=None, cert=None):
+  """
+  Drop the ETags of the responses depending on a CA, or on a client or one of its certificates
+  """
+  if ca:
+    current_app.etag_cache.pop_if(lambda _, validator: ca in validator.cas)
+  if client and cert:
+    current_app.etag_cache.pop(("client", client, cert))
+  elif client:
+    current_app.etag_cache.pop_if(lambda key, _: key[0] == "client" and key[1] == client)
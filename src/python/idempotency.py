@@ -0,0 +1,230 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+
+from asn1crypto import pem, x509
+from flask import current_app, request
+
+from cache import LRUCache
+
+# Request header holding the idempotency key
+key_header = "Idempotency-Key"
+
+# Response header set when a response is replayed
+replayed_header = "Idempotent-Replayed"
+
+# Path of the stored records in the certificate manager
+records_path = "idempotency"
+
+class ConflictException(Exception):
+  pass
+
+class IdempotencyCache():
+  """
+  Deduplicates repeated signing requests
+
+  A signing request is identified by its Idempotency-Key header, or if IDEMPOTENCY_CSR_DEDUP
+  is turned on, without one by the fingerprint of its CSR. The response of the first request
+  is recorded, and a repeat within IDEMPOTENCY_WINDOW seconds gets the recorded certificate
+  and chain back without signing again. Repeats arriving while the first request is still
+  signing wait for it, so a storm of duplicates is signed once.
+
+  A record is only replayed while it still matches the current state: it holds a fingerprint
+  of the CA certificate and the role it was signed with, and the serial of the certificate.
+  Once the CA or role changes, or the certificate is revoked, the request is signed again.
+
+  Records are kept in a bounded in-memory cache, and stored through the certificate manager
+  so they are shared between server processes and survive restarts. The stored records are
+  grouped by the window they were created in, and a whole group is removed once expired.
+
+  Reusing an idempotency key for a different request raises a ConflictException.
+  """
+  def __init__(self, app):
+    self.app = app
+    self.window = int(app.config["IDEMPOTENCY_WINDOW"])
+    self.csr_dedup = int(app.config["IDEMPOTENCY_CSR_DEDUP"]) > 0
+
+    self._cache = LRUCache(app.config["IDEMPOTENCY_CACHE_SIZE"])
+    self._inflight = {}
+    self._lock = threading.Lock()
+    self._swept = None
+
+    app.metrics.describe("certmanager_idempotency_total", "counter", "Deduplicated signing requests by result")
+
+  def _bucket(self, created):
+    return int(created // self.window)
+
+  def _lookup(self, key, state, now):
+    record = self._cache.get(key)
+
+    if record is None:
+      # Records of the current and the previous window may still be valid
+      bucket = self._bucket(now)
+      for path in [f"{records_path}/{bucket}", f"{records_path}/{bucket - 1}"]:
+        if current_app.certmanager.exists(key, path=path):
+          record = self._cache.put(key, json.loads(current_app.certmanager.read_bytes(key, path=path)))
+          break
+
+    if not record or now - record["created"] >= self.window:
+      return None
+
+    if record.get("state") != state() or self._revoked(record.get("serial")):
+      # Signed with a CA or role which changed since, or revoked, so it is signed again
+      self._cache.pop(key)
+      self.app.metrics.inc("certmanager_idempotency_total", result="stale")
+      return None
+
+    return record
+
+  def _revoked(self, serial):
+    inventory_record = current_app.inventory.get(serial) if serial else None
+
+    return bool(inventory_record and inventory_record["revoked"])
+
+  def _store(self, key, record):
+    self._cache.put(key, record)
+
+    bucket = self._bucket(record["created"])
+    current_app.certmanager.write_bytes(key, json.dumps(record).encode("utf8"), path=f"{records_path}/{bucket}")
+
+    if self._swept != bucket:
+      self._swept = bucket
+      self._sweep(bucket)
+
+  def _sweep(self, bucket):
+    """
+    Remove the stored records of the windows before the previous one
+    """
+    try:
+      names = current_app.certmanager.list(path=records_path)
+    except FileNotFoundError:
+      return
+
+    for name in names:
+      if name.isdigit() and int(name) < bucket - 1:
+        try:
+          current_app.certmanager.delete(name, path=records_path)
+        except FileNotFoundError:
+          # Removed by another process
+          pass
+
+  def run(self, key, fingerprint, state, func):
+    """
+    Run a signing request once per key
+
+    :param key:
+      The key identifying the request
+
+    :param fingerprint:
+      Fingerprint of the request, a repeat with the same key must have the same fingerprint
+
+    :param state:
+      Function returning the fingerprint of the CA and role signing the request, a recorded
+      response is only replayed while it matches. Only called once there is a record to compare
+      with or a request to sign
+
+    :param func:
+      Function signing the request, returning the response
+
+    :return:
+      Tuple of the response and whether it was replayed
+    """
+    while True:
+      record = self._lookup(key, state, time.time())
+      if record:
+        if record["fingerprint"] != fingerprint:
+          self.app.metrics.inc("certmanager_idempotency_total", result="conflict")
+          raise ConflictException(f"{key_header} was already used for a different request")
+
+        self.app.metrics.inc("certmanager_idempotency_total", result="replayed")
+        return record["response"], True
+
+      with self._lock:
+        inflight = self._inflight.get(key)
+        if inflight is None:
+          inflight = self._inflight[key] = threading.Event()
+          break
+
+      # Wait for the request signing the same key, then replay its response
+      inflight.wait()
+
+    try:
+      # Taken before signing, so a change while signing makes the record stale rather than current
+      signed_state = state()
+      # Nothing is recorded unless the request is signed
+      response = func()
+      self._store(key, {
+        "created": time.time(),
+        "fingerprint": fingerprint,
+        "state": signed_state,
+        "serial": _serial(response),
+        "response": response
+      })
+      self.app.metrics.inc("certmanager_idempotency_total", result="signed")
+
+      return response, False
+    finally:
+      with self._lock:
+        del self._inflight[key]
+      inflight.set()
+
+def _csr_fingerprint(csr, *params):
+  data = csr.encode("utf8") if isinstance(csr, str) else csr
+  if pem.detect(data):
+    _, _, data = pem.unarmor(data)
+
+  return hashlib.sha256(b"".join([data, *(json.dumps(param).encode("utf8") for param in params)])).hexdigest()
+
+def _state_fingerprint(ca_certificate_pem, role):
+  data = ca_certificate_pem.encode("utf8") if isinstance(ca_certificate_pem, str) else ca_certificate_pem
+
+  return hashlib.sha256(data + json.dumps(role, sort_keys=True).encode("utf8")).hexdigest()
+
+def _serial(response):
+  """
+  Get the serial of the certificate in a signing response, as a string like in the inventory
+  """
+  _, _, der = pem.unarmor(response["certificate"].encode("utf8"))
+
+  return str(x509.Certificate.load(der).serial_number)
+
+def sign(operation, scope, role, csr, params, func, state):
+  """
+  Sign a CSR at most once per idempotency key, or per CSR if no key was given and IDEMPOTENCY_CSR_DEDUP is on
+
+  :param operation:
+    The signing operation, e.g. cert.sign
+
+  :param scope:
+    The CA or client the CSR is signed for
+
+  :param params:
+    List of the request parameters besides the CSR, e.g. the TTL
+
+  :param func:
+    Function signing the CSR, returning the response
+
+  :param state:
+    Function returning the PEM certificate of the signing CA and the role, a recorded
+    response is only replayed while they are unchanged
+
+  :return:
+    Tuple of the response and the headers to add to it
+  """
+  idempotency = current_app.idempotency
+  request_key = request.headers.get(key_header)
+
+  if idempotency.window <= 0 or not (request_key or idempotency.csr_dedup):
+    return func(), {}
+
+  fingerprint = _csr_fingerprint(csr, *params)
+  if request_key:
+    key = hashlib.sha256(json.dumps(["key", operation, scope, role, request_key]).encode("utf8")).hexdigest()
+  else:
+    key = hashlib.sha256(json.dumps(["csr", operation, scope, role, fingerprint]).encode("utf8")).hexdigest()
+
+  response, replayed = idempotency.run(key, fingerprint, functools.cache(lambda: _state_fingerprint(*state())), func)
+
+  return response, {replayed_header: "true"} if replayed else {}
@@ -0,0 +1,188 @@
+import fcntl
+import json
+import os
+import threading
+
+from pathlib import Path
+
+class InvalidationLog():
+  """
+  Cache invalidation shared between server processes
+
+  Every change to a CA, role or client is appended as a line to a log file next to the
+  stored certificates. Each process keeps its offset in the log and, before handling a
+  request, replays the lines appended by other processes since, dropping the matching
+  cached state. Checking for new lines is a single stat of the log file.
+
+  Lines are written with a single append, which is atomic for lines this short, so
+  processes never see each other's lines interleaved.
+
+  Once the log grows past INVALIDATION_LOG_MAX_SIZE it is rotated, replaced by an empty file.
+  Processes notice the new file on their next poll and drop all their cached state, as they
+  may have missed the last changes of the old one. Appends hold a shared lock on the log and
+  rotating an exclusive one, so no change is written to a log once it was replaced.
+
+  With a single server process there is nobody to tell, changes are only applied locally.
+  The log is still polled, for the changes published by the command line tools.
+  """
+  def __init__(self, app, shared=True):
+    """
+    :param shared:
+      Whether other server processes serve from the same storage, and changes are written to the log
+    """
+    self.path = app.config["INVALIDATION_LOG"]
+    self.max_size = int(app.config.get("INVALIDATION_LOG_MAX_SIZE", 1024 * 1024))
+    self.shared = shared
+
+    Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+    Path(self.path).touch()
+
+    self._handlers = {}
+    self._reset_handlers = []
+    self._lock = threading.Lock()
+
+    # Changes made before this process started are already reflected in storage
+    stat = os.stat(self.path)
+    self._inode, self._offset = stat.st_ino, stat.st_size
+
+  def subscribe(self, kind, handler):
+    """
+    Register the function dropping the cached state for a kind of change
+
+    :param kind:
+      The kind of change, e.g. ca, role or client
+
+    :param handler:
+      Function called with the arguments of the change
+    """
+    self._handlers.setdefault(kind, []).append(handler)
+
+  def on_reset(self, handler):
+    """
+    Register a function dropping all cached state, called if the log is truncated
+    """
+    self._reset_handlers.append(handler)
+
+  def publish(self, kind, *args, local=True):
+    """
+    Record a change for all processes
+
+    :param kind:
+      The kind of change
+
+    :param args:
+      The arguments passed to the handlers, must be JSON serializable
+
+    :param local:
+      Set to False if this process has already updated its own cached state
+    """
+    if self.shared:
+      line = json.dumps({"pid": os.getpid(), "kind": kind, "args": args}, separators=(",", ":")) + "\n"
+      size = self._append(line.encode("utf8"))
+
+      if size > self.max_size:
+        self._rotate()
+
+    if local:
+      self._apply(kind, args)
+
+  def _open_current(self, flags, lock):
+    """
+    Open the current log file and lock it
+
+    :return:
+      The file descriptor, of a file which wasn't rotated since it was opened
+    """
+    while True:
+      fd = os.open(self.path, flags | os.O_CREAT, 0o644)
+      fcntl.flock(fd, lock)
+
+      try:
+        if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+          return fd
+      except FileNotFoundError:
+        pass
+
+      # Rotated while waiting for the lock
+      os.close(fd)
+
+  def _append(self, data):
+    fd = self._open_current(os.O_WRONLY | os.O_APPEND, fcntl.LOCK_SH)
+    try:
+      os.write(fd, data)
+      return os.fstat(fd).st_size
+    finally:
+      os.close(fd)
+
+  def _rotate(self):
+    """
+    Replace the log with an empty file, unless another process already did
+    """
+    fd = self._open_current(os.O_RDONLY, fcntl.LOCK_EX)
+    try:
+      if os.fstat(fd).st_size <= self.max_size:
+        return
+
+      temp_path = f"{self.path}.{os.getpid()}"
+      Path(temp_path).touch()
+      os.replace(temp_path, self.path)
+    finally:
+      os.close(fd)
+
+  def _stat(self):
+    try:
+      stat = os.stat(self.path)
+      return stat.st_ino, stat.st_size
+    except FileNotFoundError:
+      return self._inode, 0
+
+  def pending(self):
+    """
+    Check if changes were published since the last poll, a single stat of the log file
+    """
+    return self._stat() != (self._inode, self._offset)
+
+  def poll(self):
+    """
+    Apply the changes published by other processes since the last poll
+    """
+    inode, size = self._stat()
+
+    if inode == self._inode and size == self._offset:
+      return
+
+    with self._lock:
+      if inode != self._inode or size < self._offset:
+        # The log was rotated or truncated, changes may have been missed
+        self._inode, self._offset = inode, 0
+        for handler in self._reset_handlers:
+          handler()
+
+      try:
+        with open(self.path, "rb") as f:
+          if os.fstat(f.fileno()).st_ino != self._inode:
+            # Rotated again since, handled by the next poll
+            return
+
+          f.seek(self._offset)
+          data = f.read()
+      except FileNotFoundError:
+        return
+
+      # Only consume complete lines, a line may still be being written
+      end = data.rfind(b"\n") + 1
+      self._offset += end
+
+      pid = os.getpid()
+      for line in data[:end].splitlines():
+        try:
+          change = json.loads(line)
+        except ValueError:
+          continue
+
+        if change.get("pid") != pid:
+          self._apply(change["kind"], change["args"])
+
+  def _apply(self, kind, args):
+    for handler in self._handlers.get(kind, []):
+      handler(*args)
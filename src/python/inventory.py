@@ -0,0 +1,352 @@
+import json
+import os
+import threading
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+from flask import current_app
+
+from manager.sqlite import connect
+
+_schema = [
+  """
+  CREATE TABLE IF NOT EXISTS certs (
+    serial TEXT NOT NULL PRIMARY KEY,
+    ca TEXT NOT NULL,
+    role TEXT,
+    client TEXT,
+    common_name TEXT,
+    sans TEXT NOT NULL,
+    not_before REAL NOT NULL,
+    not_after REAL NOT NULL,
+    revoked_at REAL,
+    revocation_reason TEXT,
+    path TEXT,
+    name TEXT NOT NULL
+  )
+  """,
+  "CREATE INDEX IF NOT EXISTS certs_expiry ON certs (not_after, serial)",
+  "CREATE INDEX IF NOT EXISTS certs_common_name ON certs (common_name, not_after, serial)",
+  "CREATE INDEX IF NOT EXISTS certs_ca ON certs (ca, not_after, serial)"
+]
+
+_columns = ["serial", "ca", "role", "client", "common_name", "sans", "not_before", "not_after", "revoked_at", "revocation_reason", "path", "name"]
+
+_add_sql = f"INSERT OR REPLACE INTO certs ({', '.join(_columns)}) VALUES ({', '.join('?' * len(_columns))})"
+_get_sql = f"SELECT {', '.join(_columns)} FROM certs WHERE serial = ?"
+_relocate_sql = "UPDATE certs SET path = ? WHERE serial = ?"
+_revoke_sql = "UPDATE certs SET revoked_at = ?, revocation_reason = ? WHERE serial = ?"
+_revoked_sql = "SELECT serial, revoked_at, revocation_reason, not_after FROM certs WHERE ca = ? AND not_after >= ? AND revoked_at IS NOT NULL"
+_client_certs_sql = "SELECT rowid, serial, client, role, name, not_before, not_after FROM certs WHERE rowid > ? AND client IS NOT NULL AND revoked_at IS NULL AND not_after >= ? ORDER BY rowid LIMIT ?"
+_position_sql = "SELECT COALESCE(MAX(rowid), 0) FROM certs"
+_export_sql = f"SELECT rowid, {', '.join(_columns)} FROM certs WHERE rowid > ? AND (rowid > ? OR revoked_at >= ?) ORDER BY rowid LIMIT ?"
+_statuses_sql = "SELECT serial, not_after, revoked_at, revocation_reason FROM certs WHERE ca = ? AND not_after >= ?"
+
+def _timestamp(value):
+  if value is None:
+    return None
+
+  # Datetimes without a timezone are taken as UTC
+  return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+def _isoformat(timestamp):
+  return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat() if timestamp is not None else None
+
+def _record(row):
+  """
+  Convert a row of the certs table to the API representation
+  """
+  record = dict(zip(_columns, row))
+  record["sans"] = json.loads(record["sans"])
+  record["revoked"] = record["revoked_at"] is not None
+  for c in ["not_before", "not_after", "revoked_at"]:
+    record[c] = _isoformat(record[c])
+
+  return record
+
+class Inventory():
+  """
+  Index of issued certificates
+
+  Every issued certificate is recorded when it is written, so certificates can be
+  looked up by serial, CN, CA or expiry without reading the stored certificates.
+  The index is kept in a SQLite database, separate from the storage managers.
+  """
+  def __init__(self, app):
+    self.db_path = app.config["INVENTORY_DB"]
+
+    Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+    self._local = threading.local()
+
+    # Connections can't be shared with forked processes
+    os.register_at_fork(after_in_child=self._after_fork)
+
+    db = self._connection()
+    for statement in _schema:
+      db.execute(statement)
+
+  def _after_fork(self):
+    self._local = threading.local()
+
+  def _connection(self):
+    db = getattr(self._local, "db", None)
+    if db is None:
+      db = self._local.db = connect(self.db_path)
+
+    return db
+
+  def add(self, certificate, ca, name, path=None, role=None, client=None):
+    """
+    Record an issued certificate
+
+    :param certificate:
+      The asn1crypto.x509.Certificate
+
+    :param ca:
+      The name of the issuing CA
+
+    :param name:
+      The name the certificate is stored with in the certificate manager
+
+    :param path:
+      The path the certificate is stored with in the certificate manager
+    """
+    validity = certificate["tbs_certificate"]["validity"]
+    sans = certificate.subject_alt_name_value
+
+    self._connection().execute(_add_sql, (
+      str(certificate.serial_number),
+      ca,
+      role,
+      client,
+      certificate.subject.native.get("common_name"),
+      json.dumps(sans.native if sans else []),
+      _timestamp(validity["not_before"].native),
+      _timestamp(validity["not_after"].native),
+      None,
+      None,
+      path,
+      str(name)
+    ))
+
+  def get(self, serial):
+    """
+    Get the record of a certificate
+
+    :return:
+      Dict with the certificate details, or None if the serial is unknown
+    """
+    row = self._connection().execute(_get_sql, (str(serial),)).fetchone()
+
+    return _record(row) if row else None
+
+  def relocate(self, serial, path):
+    """
+    Record the new path of a stored certificate
+    """
+    self._connection().execute(_relocate_sql, (path, str(serial)))
+
+  def revoke(self, serial, revoked_at, reason):
+    """
+    Mark a certificate as revoked
+
+    :return:
+      True if the certificate is known
+    """
+    cursor = self._connection().execute(_revoke_sql, (_timestamp(revoked_at), reason, str(serial)))
+
+    return cursor.rowcount > 0
+
+  def revoked(self, ca, expires_after):
+    """
+    Get the revoked certificates of a CA
+
+    :param expires_after:
+      Only include certificates expiring at or after this datetime
+
+    :return:
+      List of tuples of serial, revocation datetime, revocation reason and expiry datetime
+    """
+    rows = self._connection().execute(_revoked_sql, (ca, _timestamp(expires_after))).fetchall()
+
+    return [
+      (int(serial), datetime.fromtimestamp(revoked_at, tz=timezone.utc), reason, datetime.fromtimestamp(not_after, tz=timezone.utc))
+      for serial, revoked_at, reason, not_after in rows
+    ]
+
+  def statuses(self, ca, expires_after):
+    """
+    Get the status of every certificate of a CA
+
+    :param expires_after:
+      Only include certificates expiring at or after this datetime
+
+    :return:
+      Generator of tuples of serial, expiry datetime, revocation datetime (None if not revoked) and revocation reason
+    """
+    rows = self._connection().execute(_statuses_sql, (ca, _timestamp(expires_after)))
+
+    for serial, not_after, revoked_at, reason in rows:
+      yield (
+        int(serial),
+        datetime.fromtimestamp(not_after, tz=timezone.utc),
+        datetime.fromtimestamp(revoked_at, tz=timezone.utc) if revoked_at is not None else None,
+        reason
+      )
+
+  def client_certs(self, after, expires_after, limit=1000):
+    """
+    Get the client certificates recorded since a previous call
+
+    Records are returned in the order they were written, so the position of the last one
+    can be passed back to only get newer records.
+
+    :param after:
+      The position of the last record seen, 0 for all records
+
+    :param expires_after:
+      Only include certificates expiring at or after this datetime
+
+    :return:
+      List of tuples of position, serial, client, role, name, start and expiry datetime
+    """
+    rows = self._connection().execute(_client_certs_sql, (after, _timestamp(expires_after), limit)).fetchall()
+
+    return [
+      (rowid, int(serial), client, role, name, datetime.fromtimestamp(not_before, tz=timezone.utc), datetime.fromtimestamp(not_after, tz=timezone.utc))
+      for rowid, serial, client, role, name, not_before, not_after in rows
+    ]
+
+  def position(self):
+    """
+    Get the position of the last record written, see export
+    """
+    return self._connection().execute(_position_sql).fetchone()[0]
+
+  def export(self, after=0, revoked_since=None, limit=1000):
+    """
+    Export the records, a page at a time
+
+    :param after:
+      Only include records written after this position, 0 for all records
+
+    :param revoked_since:
+      Also include older records revoked at or after this timestamp
+
+    :return:
+      Generator of lists of records, as dicts of the stored columns
+    """
+    db = self._connection()
+    last = 0
+
+    while True:
+      rows = db.execute(_export_sql, (last, after, revoked_since if revoked_since is not None else float("inf"), limit)).fetchall()
+      if rows:
+        yield [dict(zip(_columns, row[1:])) for row in rows]
+
+      if len(rows) < limit:
+        return
+      last = rows[-1][0]
+
+  def load(self, records):
+    """
+    Write exported records, replacing the records with the same serials
+    """
+    db = self._connection()
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      db.executemany(_add_sql, (tuple(record[c] for c in _columns) for record in records))
+    except BaseException:
+      db.execute("ROLLBACK")
+      raise
+    db.execute("COMMIT")
+
+  def search(self, ca=None, role=None, client=None, common_name=None, expires_after=None, expires_before=None, revoked=None, limit=100, cursor=None):
+    """
+    Find certificates, ordered by expiry
+
+    Results are paginated with a cursor, so each page is a range scan on the expiry index.
+
+    :param expires_after:
+      Only include certificates expiring at or after this datetime
+
+    :param expires_before:
+      Only include certificates expiring before this datetime
+
+    :param cursor:
+      The cursor returned with the previous page
+
+    :return:
+      Tuple of the list of records and the cursor of the next page, or None for the last page
+    """
+    conditions = []
+    args = []
+
+    for column, value in [("ca", ca), ("role", role), ("client", client), ("common_name", common_name)]:
+      if value is not None:
+        conditions.append(f"{column} = ?")
+        args.append(value)
+
+    if expires_after is not None:
+      conditions.append("not_after >= ?")
+      args.append(_timestamp(expires_after))
+
+    if expires_before is not None:
+      conditions.append("not_after < ?")
+      args.append(_timestamp(expires_before))
+
+    if revoked is not None:
+      conditions.append("revoked_at IS NOT NULL" if revoked else "revoked_at IS NULL")
+
+    if cursor:
+      not_after, serial = cursor.split(":", 1)
+      conditions.append("(not_after, serial) > (?, ?)")
+      args.extend([float(not_after), serial])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = self._connection().execute(
+      f"SELECT {', '.join(_columns)} FROM certs {where} ORDER BY not_after, serial LIMIT ?",
+      (*args, limit + 1)
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+      rows = rows[:limit]
+      next_cursor = f"{rows[-1][_columns.index('not_after')]!r}:{rows[-1][0]}"
+
+    return [_record(row) for row in rows], next_cursor
+
+
+############################
+#### API calls
+############################
+def search(ca=None, role=None, client=None, common_name=None, expires_after=None, expires_before=None, revoked=None, limit=100, cursor=None):
+  try:
+    items, next_cursor = current_app.inventory.search(
+      ca=ca,
+      role=role,
+      client=client,
+      common_name=common_name,
+      expires_after=datetime.fromisoformat(expires_after) if expires_after else None,
+      expires_before=datetime.fromisoformat(expires_before) if expires_before else None,
+      revoked=revoked,
+      limit=min(int(limit), 1000),
+      cursor=cursor
+    )
+
+    return {
+      "items": items,
+      "next_cursor": next_cursor
+    }, 200
+  except ValueError as e:
+    return str(e), 400
+
+def get_cert(serial):
+  record = current_app.inventory.get(serial)
+
+  if record is None:
+    return f"Certificate {serial} not found", 404
+
+  return record, 200
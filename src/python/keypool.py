@@ -0,0 +1,212 @@
+import threading
+import time
+
+from collections import deque
+
+from oscrypto import asymmetric
+
+from flask import current_app
+
+from ca import ec_curves, rsa_sizes
+
+def generate_pair(algorithm, size):
+  """
+  Generate a key pair
+
+  :param algorithm:
+    The key algorithm, "rsa" or "ec"
+
+  :param size:
+    The key size in bits for RSA keys, or the curve name for EC keys
+
+  :return:
+    Tuple of the public and private key
+  """
+  if algorithm == "ec":
+    return asymmetric.generate_pair(algorithm, curve=size)
+  else:
+    return asymmetric.generate_pair(algorithm, bit_size=int(size))
+
+def _supported(algorithm, size):
+  """
+  Check a key type can be pooled, so requests can't add pools for key types which can't be generated
+  """
+  if algorithm == "ec":
+    return size in ec_curves
+
+  return algorithm == "rsa" and size in rsa_sizes
+
+class KeyPool():
+  """
+  Pool of pre-generated key pairs
+
+  Key pairs are kept in one pool per (algorithm, size), where the size is the bit size
+  of RSA keys or the curve of EC keys. Background worker
+  threads keep every pool filled up to the high-water mark, so issuing a
+  certificate can take a ready key instead of generating one inline.
+  The key generation itself happens inside OpenSSL, which releases the GIL,
+  so the workers don't block the request threads.
+  """
+  def __init__(self, app):
+    self.high_water = int(app.config["KEY_POOL_SIZE"])
+    self.workers = int(app.config["KEY_POOL_WORKERS"])
+    self.logger = app.logger
+
+    self._pools = {}
+    self._stats = {}
+    self._lock = threading.Lock()
+    self._refill = threading.Condition(self._lock)
+    self._threads = []
+    # Key pairs being generated for each pool, so the workers don't fill a pool past the high-water mark
+    self._generating = {}
+
+    for spec in str(app.config["KEY_POOL_SPECS"]).split(","):
+      if spec.strip():
+        algorithm, size = spec.strip().split(":")
+        size = int(size) if size.isdigit() else size
+        if not _supported(algorithm, size):
+          raise ValueError(f"Unsupported key pool {spec.strip()}")
+
+        self._add_pool(algorithm, size)
+
+  def _add_pool(self, algorithm, size):
+    key = (algorithm, size)
+    if key not in self._pools:
+      self._pools[key] = deque()
+      self._stats[key] = {
+        "hits": 0,
+        "misses": 0,
+        "generated": 0,
+        "refill_times": deque(maxlen=100)
+      }
+
+    return key
+
+  @property
+  def enabled(self):
+    return self.high_water > 0 and self.workers > 0
+
+  def start(self):
+    """
+    Start the background workers filling the pools
+    """
+    if not self.enabled or self._threads:
+      return
+
+    for i in range(self.workers):
+      t = threading.Thread(target=self._worker, name=f"keypool-{i}", daemon=True)
+      t.start()
+      self._threads.append(t)
+
+  def _next_empty(self):
+    # Pick the pool with the lowest depth below the high-water mark
+    depths = [(len(pool) + self._generating.get(key, 0), key) for key, pool in self._pools.items()]
+    candidates = [(depth, key) for depth, key in depths if depth < self.high_water]
+
+    return min(candidates)[1] if candidates else None
+
+  def _worker(self):
+    while True:
+      with self._refill:
+        key = self._next_empty()
+        while key is None:
+          self._refill.wait()
+          key = self._next_empty()
+        self._generating[key] = self._generating.get(key, 0) + 1
+
+      try:
+        pair = generate_pair(*key)
+      except Exception as e:
+        # Stop filling a pool which can't be filled, rather than losing the worker
+        self.logger.exception(e)
+        with self._lock:
+          self._generating[key] -= 1
+          self._pools.pop(key, None)
+          self._stats.pop(key, None)
+        continue
+
+      with self._lock:
+        self._generating[key] -= 1
+        if key not in self._pools:
+          continue
+        self._pools[key].append(pair)
+        self._stats[key]["generated"] += 1
+        self._stats[key]["refill_times"].append(time.monotonic())
+
+  def take(self, algorithm, size, generate=True):
+    """
+    Take a key pair from the pool
+
+    Falls back to generating the key pair inline if the pool is empty, or if the key type
+    isn't one of the supported ones, which are never pooled.
+
+    :param algorithm:
+      The key algorithm, "rsa" or "ec"
+
+    :param size:
+      The key size in bits for RSA keys, or the curve name for EC keys
+
+    :param generate:
+      Set to False to return None rather than generating the key pair inline
+
+    :return:
+      Tuple of the public and private key
+    """
+    with self._lock:
+      key = self._add_pool(algorithm, size) if self.enabled and _supported(algorithm, size) else (algorithm, size)
+      pool = self._pools.get(key)
+
+      if pool:
+        self._stats[key]["hits"] += 1
+        pair = pool.popleft()
+      else:
+        if key in self._stats:
+          self._stats[key]["misses"] += 1
+        pair = None
+
+      self._refill.notify()
+
+    if pair is None and generate:
+      pair = generate_pair(algorithm, size)
+
+    return pair
+
+  def stats(self):
+    """
+    Get the depth, hit/miss counters and refill rate of each pool
+
+    :return:
+      List of dicts, one per pool
+    """
+    result = []
+
+    with self._lock:
+      for (algorithm, size), pool in self._pools.items():
+        stats = self._stats[(algorithm, size)]
+        refill_times = stats["refill_times"]
+
+        if len(refill_times) > 1 and refill_times[-1] > refill_times[0]:
+          refill_rate = (len(refill_times) - 1) / (refill_times[-1] - refill_times[0])
+        else:
+          refill_rate = 0.0
+
+        result.append({
+          "algorithm": algorithm,
+          "size": size if algorithm != "ec" else None,
+          "curve": size if algorithm == "ec" else None,
+          "depth": len(pool),
+          "high_water": self.high_water,
+          "hits": stats["hits"],
+          "misses": stats["misses"],
+          "generated": stats["generated"],
+          "refill_rate": round(refill_rate, 3)
+        })
+
+    return result
+
+
+############################
+#### API calls
+############################
+def stats():
+  return current_app.keypool.stats(), 200
@@ -0,0 +1,64 @@
+import json
+
+from itertools import islice
+
+from flask import Response, stream_with_context
+
+# Largest page size
+max_limit = 1000
+
+# Header holding the cursor of the next page
+cursor_header = "X-Next-Cursor"
+
+ndjson_mimetype = "application/x-ndjson"
+
+def respond(items, limit=None, format=None, cursor_of=str):
+  """
+  Respond with a listing
+
+  Without a limit every item is streamed, as a JSON array or as newline delimited JSON,
+  so the listing is never held in memory. With a limit a single page is returned, as a
+  dict with the items and the cursor of the next page for JSON. The cursor is also set
+  in the X-Next-Cursor header, and is left out on the last page.
+
+  :param items:
+    Iterator of the items, starting after the cursor of the request
+
+  :param limit:
+    The page size, or None for all items
+
+  :param format:
+    json or ndjson
+
+  :param cursor_of:
+    Function returning the cursor following an item
+
+  :return:
+    The response
+  """
+  if limit is None:
+    if format == "ndjson":
+      return Response(stream_with_context(json.dumps(item) + "\n" for item in items), status=200, mimetype=ndjson_mimetype)
+
+    def _array():
+      yield "["
+      for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(item)
+      yield "]\n"
+
+    return Response(stream_with_context(_array()), status=200, mimetype="application/json")
+
+  limit = max(1, min(int(limit), max_limit))
+  page = list(islice(items, limit + 1))
+
+  next_cursor = None
+  if len(page) > limit:
+    page = page[:limit]
+    next_cursor = cursor_of(page[-1])
+
+  headers = {cursor_header: next_cursor} if next_cursor else {}
+
+  if format == "ndjson":
+    return Response("".join(json.dumps(item) + "\n" for item in page), status=200, mimetype=ndjson_mimetype, headers=headers)
+
+  return Response(json.dumps({"items": page, "next_cursor": next_cursor}) + "\n", status=200, mimetype="application/json", headers=headers)
@@ -1,3 +1,4 @@
 from connexion_flask.main import App
 
-App(specification_dir="/usr/local/app/api")
+if __name__ == "__main__":
+  App(specification_dir="/usr/local/app/api")
@@ -0,0 +1,48 @@
+import asyncio
+
+from functools import partial
+
+class AsyncManager():
+  """
+  Async variant of a storage manager
+
+  Wraps a storage manager, running every blocking call in an executor so the event loop
+  is never blocked on storage I/O. Works with both the file and the SQLite managers.
+  """
+  def __init__(self, manager, executor):
+    self.manager = manager
+    self.executor = executor
+
+  async def _run(self, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+  async def write(self, name, value, path=None, kind="wb"):
+    return await self._run(self.manager.write, name, value, path=path, kind=kind)
+
+  async def write_many(self, items):
+    return await self._run(self.manager.write_many, list(items))
+
+  async def write_bytes(self, name, value, path=None):
+    return await self._run(self.manager.write_bytes, name, value, path=path)
+
+  async def write_string(self, name, value, path=None):
+    return await self._run(self.manager.write_string, name, value, path=path)
+
+  async def read(self, name, path=None, kind="rb"):
+    return await self._run(self.manager.read, name, path=path, kind=kind)
+
+  async def read_bytes(self, name, path=None):
+    return await self._run(self.manager.read_bytes, name, path=path)
+
+  async def read_string(self, name, path=None):
+    return await self._run(self.manager.read_string, name, path=path)
+
+  async def exists(self, name, path=None):
+    return await self._run(self.manager.exists, name, path=path)
+
+  async def delete(self, name, path=None):
+    return await self._run(self.manager.delete, name, path=path)
+
+  async def list(self, *args, **kwargs):
+    # The secret manager lists without a path
+    return await self._run(self.manager.list, *args, **kwargs)
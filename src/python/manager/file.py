@@ -1,12 +1,176 @@
+import ctypes
+import hashlib
 import os
+import threading
+import uuid
 
+from contextlib import contextmanager
 from pathlib import Path
 from shutil import rmtree
 
-class FileManager():
+# Prefix of the temporary files written before they are renamed into place
+temp_prefix = ".tmp-"
+
+# When written files are flushed to disk
+sync_modes = ["none", "batch", "always"]
+
+# Directory holding the leaf certificates in the sharded layout
+leaf_dirname = "leaf"
+
+def sharded_path(name):
+  """
+  Get the sharded path of a leaf certificate
+
+  The certificates are spread over leaf/<xx>/<yy>, taken from a hash of the name, so
+  each directory stays small even with tens of millions of certificates.
+
+  :param name:
+    The name of the certificate, its serial number
+
+  :return:
+    The path, relative to the base path of the certificate manager
+  """
+  digest = hashlib.sha256(str(name).encode("utf8")).hexdigest()
+
+  return f"{leaf_dirname}/{digest[0:2]}/{digest[2:4]}"
+
+# syncfs flushes a whole file system in one call, where available (Linux)
+try:
+  _libc_syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError):
+  _libc_syncfs = None
+
+def _fsync(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def _syncfs(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    if _libc_syncfs(fd) != 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+  finally:
+    os.close(fd)
+
+def _commit(files, sync=True, base_path=None):
+  """
+  Move written temporary files into place
+
+  :param files:
+    List of tuples of the temporary path and the target path
+
+  :param sync:
+    Flush the files and the directory entries to disk
+
+  :param base_path:
+    Directory on the file system of the files. If set, several files are flushed with a
+    single syncfs before and after they are renamed, rather than an fsync per file and directory
+  """
+  if sync and base_path and _libc_syncfs and len(files) > 1:
+    _syncfs(base_path)
+    for temp_path, target_path in files:
+      os.replace(temp_path, target_path)
+    _syncfs(base_path)
+
+    return
+
+  if sync:
+    for temp_path, _ in files:
+      _fsync(temp_path)
+
+  for temp_path, target_path in files:
+    os.replace(temp_path, target_path)
+
+  if sync:
+    for dir_path in set(os.path.dirname(target_path) for _, target_path in files):
+      _fsync(dir_path)
+
+def _modified(entry):
+  """
+  Get the modification time of a directory entry, None if it was removed since the directory was read
+  """
+  try:
+    return entry.stat(follow_symlinks=False).st_mtime
+  except FileNotFoundError:
+    return None
+
+class _Batch():
   def __init__(self):
+    self.files = []
+    self.done = threading.Event()
+    self.error = None
+
+class GroupCommit():
+  """
+  Flushes the files written by concurrent requests to disk together
+
+  The first writer to arrive waits for the batch window, collecting the files written
+  meanwhile, then flushes and renames them all into place while the other writers wait.
+  The file system is then flushed about once per batch, rather than once per file.
+  Every writer still only returns once its files are on disk.
+  """
+  def __init__(self, base_path, window, max_batch):
+    self.base_path = base_path
+    self.window = window
+    self.max_batch = max_batch
+
+    self._batch = None
+    self._full = threading.Condition()
+
+  def commit(self, files):
+    with self._full:
+      batch = self._batch
+      # A full batch is left to its leader, which may not have taken it yet
+      leader = batch is None or len(batch.files) >= self.max_batch
+      if leader:
+        batch = self._batch = _Batch()
+
+      batch.files.extend(files)
+
+      if leader:
+        self._full.wait_for(lambda: len(batch.files) >= self.max_batch, timeout=self.window)
+        if self._batch is batch:
+          self._batch = None
+      elif len(batch.files) >= self.max_batch:
+        self._full.notify_all()
+
+    if leader:
+      # Any error fails the whole batch, so no writer reports files which never reached the disk
+      try:
+        _commit(batch.files, base_path=self.base_path)
+      except BaseException as e:
+        batch.error = e
+      finally:
+        batch.done.set()
+    else:
+      batch.done.wait()
+
+    if batch.error:
+      raise batch.error
+
+class FileManager():
+  """
+  Storage manager keeping every object as a file
+
+  Files are written to a temporary file and renamed into place, so readers and crashes never
+  see a partly written file. How the files are flushed to disk depends on the sync mode:
+    none - left to the operating system, the default
+    batch - flushed together with the files of concurrent writes, see GroupCommit
+    always - flushed one by one
+  """
+  def __init__(self, sync="none", sync_window=2, sync_max_batch=256):
+    if sync not in sync_modes:
+      raise ValueError(f"Unknown sync mode {sync}")
+
     Path(self.base_path).mkdir(parents=True, exist_ok=True)
 
+    self.sync = sync
+    self._group_commit = GroupCommit(self.base_path, float(sync_window) / 1000, int(sync_max_batch))
+
   @classmethod
   def _rmdir_force(cls, pth):
     for sub in pth.iterdir():
@@ -28,14 +192,61 @@ class FileManager():
 
     return file_path
 
+  def _write_temp(self, file_path, name, value, kind):
+    """
+    Write a value to a temporary file next to its target
+
+    :return:
+      Tuple of the temporary path and the target path
+    """
+    temp_path = f"{file_path}/{temp_prefix}{uuid.uuid4().hex}"
+
+    with open(temp_path, kind.replace("w", "x")) as f:
+      f.write(value)
+
+    return temp_path, f"{file_path}/{name}"
+
+  def _commit(self, files, group=True):
+    try:
+      if self.sync == "batch" and group:
+        self._group_commit.commit(files)
+      else:
+        # Files written together by write_many are flushed together
+        _commit(files, sync=self.sync != "none", base_path=None if group else self.base_path)
+    except OSError:
+      for temp_path, _ in files:
+        Path(temp_path).unlink(missing_ok=True)
+      raise
+
   def write(self, name, value, path=None, kind="wb"):
     file_path = self.get_file_path(path, create=True)
 
-    with open(f"{file_path}/{name}", kind) as f:
-      f.write(value)
+    self._commit([self._write_temp(file_path, name, value, kind)])
 
     return file_path
 
+  @contextmanager
+  def batch(self):
+    """
+    Group writes together
+
+    Each file is written as soon as write is called, so this only exists to match the other storage managers.
+    Use write_many to flush many files together.
+    """
+    yield self
+
+  def write_many(self, items):
+    """
+    Write many objects, flushed to disk together
+
+    :param items:
+      Iterable of tuples of name, value (bytes) and path
+    """
+    files = [self._write_temp(self.get_file_path(path, create=True), name, value, "wb") for name, value, path in items]
+
+    # Already a batch, so no need to wait for other writes
+    self._commit(files, group=False)
+
   def write_bytes(self, name, value, path=None):
     return self.write(name, value, path=path, kind="wb")
 
@@ -62,6 +273,72 @@ class FileManager():
 
     return my_file.is_file()
 
+  def iterate(self, path=None, prefix=None, after=None):
+    """
+    Iterate over the files and directories directly below a path, in order
+
+    A directory can only be read whole, so the names of a single directory are sorted in memory.
+
+    :param prefix:
+      Only include names starting with this prefix
+
+    :param after:
+      Only include names after this name, e.g. the last name of the previous page
+
+    :return:
+      Generator of names
+    """
+    try:
+      with os.scandir(self.get_file_path(path)) as entries:
+        names = sorted(
+          entry.name for entry in entries
+          if not entry.name.startswith(temp_prefix) and (not prefix or entry.name.startswith(prefix)) and (after is None or entry.name > after)
+        )
+    except FileNotFoundError:
+      return
+
+    yield from names
+
+  def walk(self, path, after=None, since=None):
+    """
+    Iterate over all files below a path, depth first in order of their names
+
+    Only one directory per level is read at a time, so memory use is bounded by the size of the directories.
+
+    :param after:
+      Only include files after this tuple of sub-path and name, e.g. the last file of the previous page
+
+    :param since:
+      Only include files modified at or after this timestamp
+
+    :return:
+      Generator of tuples of the sub-path, relative to the path, and the name
+    """
+    position = [*after[0].split("/"), after[1]] if after else None
+
+    def _walk(parts):
+      try:
+        with os.scandir(self.get_file_path("/".join([path, *parts]))) as entries:
+          children = sorted(
+            (entry.name, entry.is_dir(follow_symlinks=False), _modified(entry) if since is not None else None)
+            for entry in entries if not entry.name.startswith(temp_prefix)
+          )
+      except FileNotFoundError:
+        return
+
+      for name, is_dir, modified in children:
+        current = [*parts, name]
+        # Skip everything up to the position, entering only the directories leading to it
+        if position and current < position[:len(current)]:
+          continue
+
+        if is_dir:
+          yield from _walk(current)
+        elif (not position or current > position) and (since is None or (modified is not None and modified >= since)):
+          yield "/".join(parts), name
+
+    yield from _walk([])
+
   def delete(self, name, path=None):
     file_path = self.get_file_path(path)
     my_file = Path(f"{file_path}/{name}")
@@ -78,10 +355,13 @@ class FileSecretManager(FileManager):
   def __init__(self, app):
     self.base_path = app.config["SECRETS_PATH"]
 
-    super(FileSecretManager, self).__init__()
+    super(FileSecretManager, self).__init__(app.config["FILE_SYNC"], app.config["FILE_SYNC_WINDOW"], app.config["FILE_SYNC_MAX_BATCH"])
 
   def list(self):
-    return os.listdir(self.base_path)
+    return [name for name in os.listdir(self.base_path) if not name.startswith(temp_prefix)]
+
+  def iterate(self, prefix=None, after=None):
+    return super(FileSecretManager, self).iterate(prefix=prefix, after=after)
 
   def delete(self, name, path=None):
     dir_path = self.get_file_path(path)
@@ -92,9 +372,9 @@ class FileCertificateManager(FileManager):
   def __init__(self, app):
     self.base_path = app.config["CERTS_PATH"]
 
-    super(FileCertificateManager, self).__init__()
+    super(FileCertificateManager, self).__init__(app.config["FILE_SYNC"], app.config["FILE_SYNC_WINDOW"], app.config["FILE_SYNC_MAX_BATCH"])
 
   def list(self, path=None):
     dir_path = self.get_file_path(path)
 
-    return os.listdir(dir_path)
+    return [name for name in os.listdir(dir_path) if not name.startswith(temp_prefix)]
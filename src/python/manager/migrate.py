@@ -0,0 +1,91 @@
+"""
+Import an existing file storage tree into the SQLite storage managers
+
+  python -m manager.migrate --secrets-path /secrets --certs-path /certs
+
+The databases default to secrets.db and certs.db inside the respective trees,
+matching the defaults of the API. Existing objects in the databases are overwritten.
+"""
+import argparse
+import os
+
+from types import SimpleNamespace
+
+from manager.sqlite import SqliteSecretManager, SqliteCertificateManager
+
+def _walk(base_path, skip_prefix):
+  """
+  Walk a file storage tree
+
+  :param base_path:
+    The base path of the file storage manager
+
+  :param skip_prefix:
+    Files starting with this path are skipped, i.e. the database and its WAL files
+
+  :return:
+    Generator of tuples of name, value and path, in the form used by the storage managers
+  """
+  for dir_path, dir_names, file_names in os.walk(base_path):
+    dir_names.sort()
+
+    rel_path = os.path.relpath(dir_path, base_path)
+    path = None if rel_path == "." else rel_path.replace(os.sep, "/")
+
+    for name in sorted(file_names):
+      file_path = os.path.join(dir_path, name)
+      if os.path.abspath(file_path).startswith(skip_prefix):
+        continue
+
+      with open(file_path, "rb") as f:
+        yield name, f.read(), path
+
+def import_tree(base_path, manager, batch_size=1000):
+  """
+  Import all the objects of a file storage tree into a storage manager
+
+  :param batch_size:
+    Number of objects written per transaction
+
+  :return:
+    The number of imported objects
+  """
+  count = 0
+  items = []
+
+  for item in _walk(base_path, os.path.abspath(manager.db_path)):
+    items.append(item)
+
+    if len(items) >= batch_size:
+      manager.write_many(items)
+      count += len(items)
+      items = []
+
+  if items:
+    manager.write_many(items)
+    count += len(items)
+
+  return count
+
+def main():
+  parser = argparse.ArgumentParser(description="Import a file storage tree into the SQLite storage managers")
+  parser.add_argument("--secrets-path", default=os.getenv("SECRETS_PATH", "/secrets"))
+  parser.add_argument("--certs-path", default=os.getenv("CERTS_PATH", "/certs"))
+  parser.add_argument("--secrets-db", default=None)
+  parser.add_argument("--certs-db", default=None)
+  parser.add_argument("--batch-size", type=int, default=1000)
+  args = parser.parse_args()
+
+  app = SimpleNamespace(config={
+    "SECRETS_DB": args.secrets_db or os.getenv("SECRETS_DB", f"{args.secrets_path}/secrets.db"),
+    "CERTS_DB": args.certs_db or os.getenv("CERTS_DB", f"{args.certs_path}/certs.db")
+  })
+
+  secrets = import_tree(args.secrets_path, SqliteSecretManager(app), args.batch_size)
+  print(f"Imported {secrets} secrets from {args.secrets_path} into {app.config['SECRETS_DB']}")
+
+  certs = import_tree(args.certs_path, SqliteCertificateManager(app), args.batch_size)
+  print(f"Imported {certs} certificates from {args.certs_path} into {app.config['CERTS_DB']}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,89 @@
+"""
+Move the leaf certificates of a file storage tree into the sharded layout
+
+  python -m manager.shard --secrets-path /secrets --certs-path /certs
+
+Leaf certificates stored flat in the certificate tree, named by their serial number, are
+moved to leaf/<xx>/<yy>/<serial>. The migration can run while the API is serving: every
+certificate is hard linked at its new path before the flat file is removed, and the API
+reads certificates from either layout. Running it again only moves what is left.
+
+New certificates are only written to the sharded layout once the API runs with
+CERTS_LAYOUT=sharded. Run the migration before switching, and once more after, to move the
+certificates written flat in between.
+"""
+import argparse
+import os
+
+from types import SimpleNamespace
+
+from inventory import Inventory
+from manager.file import sharded_path
+
+def _leaf_names(base_path, cas):
+  """
+  Get the names of the leaf certificates stored flat in a certificate tree
+
+  Leaf certificates are named by their serial, anything else is CA material, roles or clients.
+  """
+  with os.scandir(base_path) as entries:
+    for entry in entries:
+      if entry.name.isdigit() and entry.name not in cas and entry.is_file(follow_symlinks=False):
+        yield entry.name
+
+def shard_tree(base_path, cas, inventory=None):
+  """
+  Move the flat leaf certificates of a certificate tree into the sharded layout
+
+  :param cas:
+    The names of the CAs, whose certificates are never moved
+
+  :param inventory:
+    Inventory to record the new paths in, optional
+
+  :return:
+    The number of moved certificates
+  """
+  count = 0
+
+  for name in _leaf_names(base_path, cas):
+    path = sharded_path(name)
+    source = os.path.join(base_path, name)
+    target = os.path.join(base_path, path, name)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+      os.link(source, target)
+    except FileExistsError:
+      # Moved by an earlier, interrupted run
+      pass
+    except FileNotFoundError:
+      # Deleted since the scan
+      continue
+
+    os.unlink(source)
+
+    if inventory:
+      inventory.relocate(name, path)
+
+    count += 1
+
+  return count
+
+def main():
+  parser = argparse.ArgumentParser(description="Move the leaf certificates of a file storage tree into the sharded layout")
+  parser.add_argument("--secrets-path", default=os.getenv("SECRETS_PATH", "/secrets"))
+  parser.add_argument("--certs-path", default=os.getenv("CERTS_PATH", "/certs"))
+  parser.add_argument("--inventory-db", default=None)
+  args = parser.parse_args()
+
+  inventory_db = args.inventory_db or os.getenv("INVENTORY_DB", f"{args.certs_path}/inventory.db")
+  inventory = Inventory(SimpleNamespace(config={"INVENTORY_DB": inventory_db})) if os.path.exists(inventory_db) else None
+
+  cas = set(os.listdir(args.secrets_path)) if os.path.isdir(args.secrets_path) else set()
+
+  certs = shard_tree(args.certs_path, cas, inventory)
+  print(f"Moved {certs} certificates in {args.certs_path} to the sharded layout")
+
+if __name__ == "__main__":
+  main()
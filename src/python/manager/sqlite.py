@@ -0,0 +1,311 @@
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+_schema = """
+CREATE TABLE IF NOT EXISTS objects (
+  path TEXT NOT NULL,
+  name TEXT NOT NULL,
+  value BLOB NOT NULL,
+  updated REAL NOT NULL,
+  PRIMARY KEY (path, name)
+) WITHOUT ROWID
+"""
+
+# Statements are kept constant, so sqlite3 reuses the prepared statements from its statement cache
+_write_sql = "INSERT OR REPLACE INTO objects (path, name, value, updated) VALUES (?, ?, ?, ?)"
+_read_sql = "SELECT value FROM objects WHERE path = ? AND name = ?"
+_exists_sql = "SELECT 1 FROM objects WHERE path = ? AND name = ?"
+_delete_sql = "DELETE FROM objects WHERE (path = ? AND name = ?) OR path = ? OR (path > ? AND path < ?)"
+_list_names_sql = "SELECT name FROM objects WHERE path = ? ORDER BY name"
+_list_paths_sql = "SELECT DISTINCT path FROM objects WHERE path > ? AND path < ? ORDER BY path"
+_iterate_names_sql = "SELECT name FROM objects WHERE path = ? AND name > ? AND name < ? ORDER BY name LIMIT ?"
+_first_path_sql = "SELECT path FROM objects WHERE path > ? AND path < ? ORDER BY path LIMIT 1"
+_first_path_from_sql = "SELECT path FROM objects WHERE path >= ? AND path < ? ORDER BY path LIMIT 1"
+_walk_sql = "SELECT path, name FROM objects WHERE path >= ? AND path < ? AND (path, name) > (?, ?) ORDER BY path, name LIMIT ?"
+_walk_since_sql = "SELECT path, name, updated >= ? FROM objects WHERE path >= ? AND path < ? AND (path, name) > (?, ?) ORDER BY path, name LIMIT ?"
+
+# Number of rows read per query when iterating
+_page_size = 256
+
+# Sorts after any name
+_max_name = "\U0010ffff"
+
+def _subpath_range(path):
+  """
+  Get the key range of all paths below a path
+
+  '0' is the character following '/', so the range covers every path starting with '<path>/'
+  """
+  if path:
+    return f"{path}/", f"{path}0"
+  else:
+    return "", "\U0010ffff"
+
+def connect(db_path):
+  """
+  Open a connection to a SQLite database in WAL mode
+
+  The connection is in autocommit mode, transactions must be started explicitly.
+  """
+  db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=64)
+  db.execute("PRAGMA journal_mode=WAL")
+  db.execute("PRAGMA synchronous=NORMAL")
+  db.execute("PRAGMA busy_timeout=5000")
+
+  return db
+
+class SqliteManager():
+  """
+  Storage manager keeping every object as a row in a SQLite database
+
+  The database runs in WAL mode, so reads are not blocked by writes.
+  Each thread uses its own connection. Writes are committed one at a time,
+  unless they are grouped with batch(), which commits them together.
+  """
+  def __init__(self):
+    Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+
+    self._local = threading.local()
+    # Connections can't be shared with forked processes
+    os.register_at_fork(after_in_child=self._after_fork)
+
+    db = self._connection()
+    db.execute(_schema)
+
+  def _after_fork(self):
+    self._local = threading.local()
+
+  def _connection(self):
+    db = getattr(self._local, "db", None)
+    if db is None:
+      db = connect(self.db_path)
+
+      self._local.db = db
+      self._local.batch = 0
+
+    return db
+
+  @contextmanager
+  def batch(self):
+    """
+    Group writes into a single transaction, committed when the block ends
+    """
+    db = self._connection()
+
+    if self._local.batch == 0:
+      db.execute("BEGIN IMMEDIATE")
+    self._local.batch += 1
+
+    try:
+      yield self
+    except BaseException:
+      self._local.batch -= 1
+      if self._local.batch == 0:
+        db.execute("ROLLBACK")
+      raise
+    else:
+      self._local.batch -= 1
+      if self._local.batch == 0:
+        db.execute("COMMIT")
+
+  def write(self, name, value, path=None, kind="wb"):
+    if kind == "w":
+      value = value.encode("utf8")
+
+    self._connection().execute(_write_sql, (path or "", str(name), value, time.time()))
+
+    return path
+
+  def write_many(self, items):
+    """
+    Write many objects in a single statement
+
+    :param items:
+      Iterable of tuples of name, value (bytes) and path
+    """
+    now = time.time()
+
+    with self.batch():
+      self._connection().executemany(_write_sql, ((path or "", str(name), value, now) for name, value, path in items))
+
+  def write_bytes(self, name, value, path=None):
+    return self.write(name, value, path=path, kind="wb")
+
+  def write_string(self, name, value, path=None):
+    return self.write(name, value, path=path, kind="w")
+
+  def read(self, name, path=None, kind="rb"):
+    row = self._connection().execute(_read_sql, (path or "", str(name))).fetchone()
+    if row is None:
+      raise FileNotFoundError(f"{path}/{name}" if path else str(name))
+
+    return row[0].decode("utf8") if kind == "r" else bytes(row[0])
+
+  def read_bytes(self, name, path=None):
+    return self.read(name, path=path, kind="rb")
+
+  def read_string(self, name, path=None):
+    return self.read(name, path=path, kind="r")
+
+  def exists(self, name, path=None):
+    return self._connection().execute(_exists_sql, (path or "", str(name))).fetchone() is not None
+
+  def delete(self, name, path=None):
+    # Deletes the object, or everything below it when it's used as a path
+    sub_path = f"{path}/{name}" if path else str(name)
+    start, end = _subpath_range(sub_path)
+
+    self._connection().execute(_delete_sql, (path or "", str(name), sub_path, start, end))
+
+  def list(self, path=None):
+    """
+    List the objects and sub-paths directly below a path, like os.listdir
+
+    :return:
+      Sorted list of names
+    """
+    db = self._connection()
+    start, end = _subpath_range(path)
+
+    names = set(row[0] for row in db.execute(_list_names_sql, (path or "",)))
+    for (sub_path,) in db.execute(_list_paths_sql, (start, end)):
+      names.add(sub_path[len(start):].split("/", 1)[0])
+
+    return sorted(names)
+
+  def _iterate_names(self, path, prefix, after):
+    # Objects directly at the path, read a page at a time
+    db = self._connection()
+    last = max(after or "", prefix or "")
+    end = f"{prefix}{_max_name}" if prefix else _max_name
+
+    if prefix and (after is None or after < prefix) and db.execute(_exists_sql, (path or "", prefix)).fetchone():
+      yield prefix
+
+    while True:
+      names = [row[0] for row in db.execute(_iterate_names_sql, (path or "", last, end, _page_size))]
+      yield from names
+
+      if len(names) < _page_size:
+        return
+      last = names[-1]
+
+  def _iterate_sub_paths(self, path, prefix, after):
+    # The first component of the sub-paths below the path, each found with an index seek.
+    # Paths are ordered as strings, so <name>-x/.. sorts before <name>/.., and a shorter name
+    # may sort after the first path found. Those are looked up separately.
+    db = self._connection()
+    start, end = _subpath_range(path)
+    last = after if after is not None and after >= (prefix or "") else None
+    lower = start + (last if last is not None else (prefix or ""))
+    # A path equal to the prefix belongs to the first name
+    inclusive = last is None and bool(prefix)
+
+    while True:
+      row = db.execute(_first_path_from_sql if inclusive else _first_path_sql, (lower, end)).fetchone()
+      inclusive = False
+      if row is None:
+        return
+
+      name = row[0][len(start):].split("/", 1)[0]
+      if last is not None and name <= last:
+        # A name already passed, the rest of its paths sort before <name>/<max>
+        lower = f"{start}{name}/{_max_name}"
+        continue
+
+      for i in range(1, len(name)):
+        shorter = name[:i]
+        if name[i] < "/" and (last is None or shorter > last) and (not prefix or shorter.startswith(prefix)):
+          sub_start, sub_end = _subpath_range(start + shorter)
+          if db.execute(_first_path_sql, (sub_start, sub_end)).fetchone():
+            name = shorter
+            break
+
+      if prefix and not name.startswith(prefix):
+        return
+
+      yield name
+
+      last = name
+      lower = start + name
+
+  def iterate(self, path=None, prefix=None, after=None):
+    """
+    Iterate over the objects and sub-paths directly below a path, in order
+
+    Unlike list, the names are read a page at a time, so memory use doesn't grow with the number of names.
+
+    :param prefix:
+      Only include names starting with this prefix
+
+    :param after:
+      Only include names after this name, e.g. the last name of the previous page
+
+    :return:
+      Generator of names
+    """
+    previous = None
+
+    for name in heapq.merge(self._iterate_names(path, prefix, after), self._iterate_sub_paths(path, prefix, after)):
+      if name != previous:
+        yield name
+      previous = name
+
+  def walk(self, path, after=None, since=None):
+    """
+    Iterate over all objects below a path, in order of their path and name
+
+    :param after:
+      Only include objects after this tuple of sub-path and name, e.g. the last object of the previous page
+
+    :param since:
+      Only include objects written at or after this timestamp
+
+    :return:
+      Generator of tuples of the sub-path, relative to the path, and the name
+    """
+    db = self._connection()
+    start, end = _subpath_range(path)
+    last_path, last_name = (f"{start}{after[0]}", after[1]) if after else (start, "")
+
+    while True:
+      if since is None:
+        rows = [(sub_path, name, True) for sub_path, name in db.execute(_walk_sql, (start, end, last_path, last_name, _page_size))]
+      else:
+        # Pages are read over all objects, so a page without a match doesn't end the walk
+        rows = db.execute(_walk_since_sql, (since, start, end, last_path, last_name, _page_size)).fetchall()
+
+      for sub_path, name, included in rows:
+        if included:
+          yield sub_path[len(start):], name
+
+      if len(rows) < _page_size:
+        return
+      last_path, last_name = rows[-1][:2]
+
+
+
+
+class SqliteSecretManager(SqliteManager):
+  def __init__(self, app):
+    self.db_path = app.config["SECRETS_DB"]
+
+    super(SqliteSecretManager, self).__init__()
+
+  def list(self):
+    return super(SqliteSecretManager, self).list()
+
+  def iterate(self, prefix=None, after=None):
+    return super(SqliteSecretManager, self).iterate(prefix=prefix, after=after)
+
+class SqliteCertificateManager(SqliteManager):
+  def __init__(self, app):
+    self.db_path = app.config["CERTS_DB"]
+
+    super(SqliteCertificateManager, self).__init__()
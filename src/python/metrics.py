@@ -0,0 +1,250 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+from flask import current_app, g, request, Response
+
+# Latency buckets in seconds
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request header enabling the phase breakdown in the Server-Timing response header
+profile_header = "X-Profile"
+
+# The operation running on the current thread, used to label the phases
+_local = threading.local()
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels, extra=None):
+  pairs = [*labels, *(extra or [])]
+  if not pairs:
+    return ""
+
+  return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics():
+  """
+  Counters, histograms and gauges, rendered in the Prometheus text format
+
+  Metrics are created on first use. Every sample is identified by the metric name and its
+  labels, which are kept as a sorted tuple so label order doesn't matter.
+  """
+  def __init__(self, app):
+    self.buckets = tuple(float(b) for b in str(app.config["METRICS_BUCKETS"]).split(",")) if app.config.get("METRICS_BUCKETS") else default_buckets
+
+    self._help = {}
+    self._counters = {}
+    self._histograms = {}
+    self._gauges = {}
+    self._lock = threading.Lock()
+
+  def describe(self, name, kind, help):
+    self._help[name] = (kind, help)
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          histogram[0][i] += 1
+          break
+      histogram[1] += value
+      histogram[2] += 1
+
+  def gauge(self, name, collect):
+    """
+    Add a gauge, read when the metrics are rendered
+
+    :param collect:
+      Function returning a list of tuples of a labels dict and the value
+    """
+    self._gauges[name] = collect
+
+  def render(self):
+    """
+    Render all metrics in the Prometheus text format
+    """
+    with self._lock:
+      counters = dict(self._counters)
+      histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self._histograms.items()}
+
+    samples = {}
+    for (name, labels), value in sorted(counters.items()):
+      samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+      lines = samples.setdefault(name, [])
+
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, buckets):
+        cumulative += bucket_count
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {cumulative}")
+      lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+      lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+      lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for name, collect in self._gauges.items():
+      samples[name] = sorted(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}" for labels, value in collect())
+
+    output = []
+    for name in sorted(samples):
+      if name in self._help:
+        kind, help = self._help[name]
+        output.append(f"# HELP {name} {help}")
+        output.append(f"# TYPE {name} {kind}")
+      output.extend(samples[name])
+
+    return "\n".join(output) + "\n"
+
+class InstrumentedManager():
+  """
+  Storage manager wrapper recording the latency and count of every storage operation
+  """
+  timed = ["write", "write_bytes", "write_string", "write_many", "read", "read_bytes", "read_string", "exists", "delete", "list"]
+
+  def __init__(self, manager, name, metrics):
+    self._manager = manager
+    self._name = name
+    self._metrics = metrics
+
+  def __getattr__(self, attr):
+    value = getattr(self._manager, attr)
+    if attr not in self.timed:
+      return value
+
+    def _timed(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return value(*args, **kwargs)
+      finally:
+        self._metrics.observe("certmanager_storage_seconds", time.perf_counter() - start, manager=self._name, operation=attr)
+
+    # Keep the wrapper, so the lookup only happens once
+    setattr(self, attr, _timed)
+
+    return _timed
+
+def register(app):
+  """
+  Set up the metrics of an application
+
+  Adds the /metrics endpoint, request metrics, the per-request profiling header
+  and wraps the storage managers.
+  """
+  metrics = app.metrics = Metrics(app)
+
+  metrics.describe("certmanager_requests_total", "counter", "API requests by endpoint and status")
+  metrics.describe("certmanager_request_seconds", "histogram", "API request latency by endpoint")
+  metrics.describe("certmanager_phase_seconds", "histogram", "Latency of the phases of issuing and signing")
+  metrics.describe("certmanager_certificates_total", "counter", "Certificates issued or signed, by operation, CA and role")
+  metrics.describe("certmanager_ca_cache_total", "counter", "CA cache lookups by result")
+  metrics.describe("certmanager_profile_cache_total", "counter", "Client profile cache lookups by result")
+  metrics.describe("certmanager_storage_seconds", "histogram", "Storage operation latency by manager and operation")
+  metrics.describe("certmanager_keypool_depth", "gauge", "Key pairs ready in each key pool")
+
+  metrics.gauge("certmanager_keypool_depth", lambda: [
+    ({"algorithm": s["algorithm"], "size": s["size"] if s["size"] is not None else s["curve"]}, s["depth"]) for s in app.keypool.stats()
+  ])
+
+  app.secretmanager = InstrumentedManager(app.secretmanager, "secrets", metrics)
+  app.certmanager = InstrumentedManager(app.certmanager, "certs", metrics)
+
+  @app.before_request
+  def _start_request():
+    g.request_start = time.perf_counter()
+    if request.headers.get(profile_header, "").lower() in ["1", "true", "yes"]:
+      g.profile = []
+
+  @app.after_request
+  def _end_request(response):
+    start = g.get("request_start")
+    if start is None:
+      return response
+
+    elapsed = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+
+    metrics.inc("certmanager_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe("certmanager_request_seconds", elapsed, endpoint=endpoint, method=request.method)
+
+    profile = g.get("profile")
+    if profile is not None:
+      timings = [f"{name};dur={duration * 1000:.3f}" for name, duration in profile]
+      timings.append(f"total;dur={elapsed * 1000:.3f}")
+      response.headers["Server-Timing"] = ", ".join(timings)
+
+    return response
+
+  app.add_url_rule("/metrics", "metrics", render)
+
+  return metrics
+
+@contextmanager
+def operation(name):
+  """
+  Label the phases timed on this thread with an operation, e.g. cert.issue
+
+  Can be used as a decorator.
+  """
+  previous = getattr(_local, "operation", None)
+  _local.operation = name
+  try:
+    yield
+  finally:
+    _local.operation = previous
+
+def current_operation():
+  """
+  Get the operation running on this thread, to carry it over to worker threads
+  """
+  return getattr(_local, "operation", None)
+
+@contextmanager
+def phase(name):
+  """
+  Time a phase of the current operation
+
+  The time is recorded in the phase histogram, and in the profile of the request if it asked for one.
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    current_app.metrics.observe("certmanager_phase_seconds", elapsed, operation=current_operation() or "unknown", phase=name)
+
+    profile = g.get("profile")
+    if profile is not None:
+      profile.append((name, elapsed))
+
+def issued(ca, role):
+  """
+  Count a certificate issued or signed by the current operation
+  """
+  current_app.metrics.inc("certmanager_certificates_total", operation=current_operation() or "unknown", ca=ca, role=role)
+
+
+############################
+#### API calls
+############################
+def render():
+  return Response(current_app.metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,344 @@
+import base64
+import hashlib
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from asn1crypto import ocsp
+from oscrypto import asymmetric
+
+from flask import current_app, request, Response
+
+from ca import _load_ca, _signature_hash, NotFoundException
+
+# Hash algorithms accepted in the CertID of a request
+cert_id_hash_algorithms = ["sha1", "sha256"]
+
+def _unsigned(response_status):
+  """
+  Encode an OCSP response without a body, e.g. for malformed or unauthorized requests
+  """
+  return ocsp.OCSPResponse({"response_status": response_status}).dump()
+
+def _sign(private_key, data):
+  """
+  Sign the response data with the CA private key
+
+  :return:
+    Tuple of the signature and the signature algorithm
+  """
+  hash_algorithm = _signature_hash(private_key)
+
+  if private_key.algorithm == "ec":
+    return asymmetric.ecdsa_sign(private_key, data, hash_algorithm), f"{hash_algorithm}_ecdsa"
+  else:
+    return asymmetric.rsa_pkcs1v15_sign(private_key, data, hash_algorithm), f"{hash_algorithm}_rsa"
+
+def _cert_id(ca_material, serial, hash_algorithm):
+  """
+  Construct the CertID of a certificate issued by a CA
+  """
+  issuer = ca_material.certificate.asn1
+
+  return {
+    "hash_algorithm": {"algorithm": hash_algorithm},
+    "issuer_name_hash": getattr(issuer.subject, hash_algorithm),
+    "issuer_key_hash": getattr(issuer.public_key, hash_algorithm),
+    "serial_number": serial
+  }
+
+def _build_response(ca_material, cert_id, status, now, validity):
+  """
+  Build and sign the OCSP response for a single certificate
+
+  :param cert_id:
+    Dict with the CertID of the request
+
+  :param status:
+    Tuple of expiry datetime, revocation datetime (None if not revoked) and revocation reason
+
+  :return:
+    Dict with the DER encoding, the ETag, the production time and the next update time
+  """
+  _, revoked_at, reason = status
+
+  if revoked_at is None:
+    cert_status = ocsp.CertStatus(name="good", value=None)
+  else:
+    cert_status = ocsp.CertStatus(name="revoked", value={
+      "revocation_time": revoked_at,
+      "revocation_reason": reason or "unspecified"
+    })
+
+  issuer = ca_material.certificate.asn1
+  response_data = ocsp.ResponseData({
+    "responder_id": ocsp.ResponderId(name="by_key", value=issuer.public_key.sha1),
+    "produced_at": now,
+    "responses": [{
+      "cert_id": cert_id,
+      "cert_status": cert_status,
+      "this_update": now,
+      "next_update": now + validity
+    }]
+  })
+
+  signature, signature_algorithm = _sign(ca_material.private_key, response_data.dump())
+  der = ocsp.OCSPResponse({
+    "response_status": "successful",
+    "response_bytes": {
+      "response_type": "basic_ocsp_response",
+      "response": ocsp.BasicOCSPResponse({
+        "tbs_response_data": response_data,
+        "signature_algorithm": {"algorithm": signature_algorithm},
+        "signature": signature
+      })
+    }
+  }).dump()
+
+  return {
+    "der": der,
+    "etag": hashlib.sha256(der).hexdigest()[:32],
+    "this_update": now,
+    "next_update": now + validity,
+    "served": False
+  }
+
+class CertificateStatuses():
+  """
+  The certificate statuses and signed OCSP responses of a single CA
+
+  The statuses are keyed on serial. The responses are keyed on serial and the hash algorithm
+  of the request CertID, as the CertID is echoed in the signed response. Both are only changed
+  while holding the lock, as they are shared by the request threads and the refresh thread.
+  """
+  def __init__(self, ca, statuses):
+    self.ca = ca
+    self.statuses = {serial: (not_after, revoked_at, reason) for serial, not_after, revoked_at, reason in statuses}
+    self.responses = {}
+    self.lock = threading.Lock()
+
+class OCSPResponder():
+  """
+  OCSP responder answering from pre-signed responses
+
+  The status of every certificate of a CA is loaded from the inventory on first use.
+  A response is signed the first time a serial is requested and kept until it is close to
+  its next update. A background thread re-signs the responses that are still being requested
+  before they expire, and drops the others, so only the first request for a serial signs.
+  Signing every status up front isn't worth it, most certificates are never checked.
+  As the responses are pre-signed, nonces in requests are ignored.
+  """
+  def __init__(self, app):
+    self.app = app
+    self.validity = timedelta(hours=int(app.config["OCSP_VALIDITY"]))
+    self.refresh_window = timedelta(hours=int(app.config["OCSP_REFRESH_WINDOW"]))
+    self.refresh_interval = int(app.config["OCSP_REFRESH_INTERVAL"])
+
+    self._cas = {}
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def start(self):
+    """
+    Start the background thread re-signing responses
+    """
+    if self._thread or self.refresh_interval <= 0:
+      return
+
+    self._thread = threading.Thread(target=self._refresher, name="ocsp-refresh", daemon=True)
+    self._thread.start()
+
+  def _refresher(self):
+    while True:
+      time.sleep(self.refresh_interval)
+
+      with self.app.app_context():
+        self.refresh()
+
+  def _get(self, ca):
+    with self._lock:
+      statuses = self._cas.get(ca)
+      if statuses is None:
+        statuses = self._cas[ca] = CertificateStatuses(ca, current_app.inventory.statuses(ca, datetime.now(timezone.utc)))
+
+      return statuses
+
+  def _status(self, statuses, serial):
+    with statuses.lock:
+      status = statuses.statuses.get(serial)
+    if status is None:
+      # Certificates issued since the statuses were loaded are picked up from the inventory
+      record = current_app.inventory.get(serial)
+      if record and record["ca"] == statuses.ca:
+        with statuses.lock:
+          status = statuses.statuses.setdefault(serial, (
+            datetime.fromisoformat(record["not_after"]),
+            datetime.fromisoformat(record["revoked_at"]) if record["revoked_at"] else None,
+            record["revocation_reason"]
+          ))
+
+    return status
+
+  def _sign(self, statuses, ca_material, key, status, now):
+    """
+    Sign the response for a certificate status and cache it
+
+    The response is signed without holding the lock, and only cached if the status didn't change
+    meanwhile, as a revocation re-signs the cached responses itself.
+    """
+    response = _build_response(ca_material, _cert_id(ca_material, *key), status, now, self.validity)
+
+    with statuses.lock:
+      if statuses.statuses.get(key[0]) is status:
+        statuses.responses[key] = response
+
+    return response
+
+  def respond(self, ca, request_der):
+    """
+    Answer an OCSP request
+
+    :param ca:
+      The name of the CA the request was sent to
+
+    :param request_der:
+      The DER encoded OCSP request
+
+    :return:
+      Dict with the encoded response, see _build_response, or the DER of an unsigned response
+    """
+    try:
+      ocsp_request = ocsp.OCSPRequest.load(request_der)
+      requests = ocsp_request["tbs_request"]["request_list"]
+      if len(requests) != 1:
+        return _unsigned("malformed_request")
+
+      cert_id = requests[0]["req_cert"]
+      hash_algorithm = cert_id["hash_algorithm"]["algorithm"].native
+      serial = cert_id["serial_number"].native
+    except ValueError:
+      return _unsigned("malformed_request")
+
+    try:
+      ca_material = _load_ca(ca)
+    except NotFoundException:
+      return _unsigned("unauthorized")
+
+    if hash_algorithm not in cert_id_hash_algorithms:
+      return _unsigned("unauthorized")
+
+    expected = _cert_id(ca_material, serial, hash_algorithm)
+    if cert_id["issuer_name_hash"].native != expected["issuer_name_hash"] or cert_id["issuer_key_hash"].native != expected["issuer_key_hash"]:
+      return _unsigned("unauthorized")
+
+    statuses = self._get(ca)
+    key = (serial, hash_algorithm)
+    now = datetime.now(timezone.utc)
+
+    with statuses.lock:
+      response = statuses.responses.get(key)
+      if response is not None and response["next_update"] > now:
+        response["served"] = True
+        return response
+
+    status = self._status(statuses, serial)
+    if status is None:
+      return _unsigned("unauthorized")
+
+    response = self._sign(statuses, ca_material, key, status, now)
+    with statuses.lock:
+      response["served"] = True
+
+    return response
+
+  def revoke(self, ca, serial, revoked_at, reason, not_after):
+    """
+    Mark a certificate as revoked and re-sign its cached responses
+    """
+    statuses = self._get(ca)
+    with statuses.lock:
+      statuses.statuses[serial] = (not_after, revoked_at, reason)
+
+    self._resign(statuses, [(serial, hash_algorithm) for hash_algorithm in cert_id_hash_algorithms])
+
+  def _resign(self, statuses, keys):
+    ca_material = _load_ca(statuses.ca)
+    now = datetime.now(timezone.utc)
+
+    for key in keys:
+      with statuses.lock:
+        response = statuses.responses.get(key)
+        status = statuses.statuses.get(key[0])
+      if response is None or status is None:
+        continue
+
+      self._sign(statuses, ca_material, key, status, now)
+
+  def refresh(self):
+    """
+    Re-sign the responses nearing their next update
+
+    Responses which haven't been served since they were signed are dropped instead.
+    """
+    now = datetime.now(timezone.utc)
+
+    with self._lock:
+      cas = list(self._cas.values())
+
+    for statuses in cas:
+      due = []
+      with statuses.lock:
+        for key, response in list(statuses.responses.items()):
+          if response["next_update"] - now > self.refresh_window:
+            continue
+
+          if response["served"]:
+            due.append(key)
+          else:
+            statuses.responses.pop(key, None)
+
+      try:
+        self._resign(statuses, due)
+      except NotFoundException:
+        self.invalidate(statuses.ca)
+
+  def invalidate(self, ca):
+    with self._lock:
+      self._cas.pop(ca, None)
+
+  def clear(self):
+    with self._lock:
+      self._cas.clear()
+
+def _response(response):
+  if isinstance(response, bytes):
+    return Response(response, status=200, mimetype="application/ocsp-response")
+
+  max_age = max(0, int((response["next_update"] - datetime.now(timezone.utc)).total_seconds()))
+  headers = {
+    "ETag": f'"{response["etag"]}"',
+    "Cache-Control": f"public, max-age={max_age}, no-transform, must-revalidate",
+    "Last-Modified": response["this_update"].strftime("%a, %d %b %Y %H:%M:%S GMT"),
+    "Expires": response["next_update"].strftime("%a, %d %b %Y %H:%M:%S GMT")
+  }
+
+  if request.if_none_match.contains(response["etag"]):
+    return Response(status=304, headers=headers)
+
+  return Response(response["der"], status=200, mimetype="application/ocsp-response", headers=headers)
+
+
+############################
+#### API calls
+############################
+def post_ocsp(ca, body=None):
+  return _response(current_app.ocsp.respond(ca, request.get_data()))
+
+def get_ocsp(ca, ocsp_request):
+  try:
+    request_der = base64.b64decode(ocsp_request.replace("-", "+").replace("_", "/"), validate=True)
+  except ValueError:
+    return _response(_unsigned("malformed_request"))
+
+  return _response(current_app.ocsp.respond(ca, request_der))
@@ -0,0 +1,104 @@
+"""
+Pre-forking server
+
+Used when WORKERS is above 1. The app is created and warmed up once in the master process,
+then the listening socket is shared with WORKERS forked processes, each
+serving requests on its own threads. This scales past a single core, as every worker has
+its own interpreter.
+
+Workers which exit are restarted. SIGTERM or SIGINT stop the workers, which finish the
+requests in flight before exiting.
+
+Changes to CAs, roles and clients are passed between the workers through the invalidation log.
+"""
+import os
+import signal
+import threading
+
+from werkzeug.serving import make_server
+
+def _serve(server, after_fork):
+  """
+  Serve requests in a worker process until it is told to stop
+  """
+  after_fork()
+
+  # Let the requests in flight finish when stopping
+  server.daemon_threads = False
+
+  def _stop(signum, frame):
+    threading.Thread(target=server.shutdown, daemon=True).start()
+
+  signal.signal(signal.SIGTERM, _stop)
+  signal.signal(signal.SIGINT, _stop)
+
+  server.serve_forever()
+  server.server_close()
+
+def serve(app, host, port, workers, after_fork):
+  """
+  Run the server with a number of pre-forked worker processes
+
+  :param app:
+    The Flask application
+
+  :param workers:
+    The number of worker processes
+
+  :param after_fork:
+    Function called in each worker once it is forked, starting the background services
+  """
+  # Warm up before forking, so the workers share the loaded CAs and start out ready
+  app.warmup.run()
+
+  server = make_server(host, int(port), app, threaded=True)
+  app.logger.info(f"Serving on {host}:{port} with {workers} workers")
+
+  children = set()
+  stopping = False
+
+  def _spawn():
+    pid = os.fork()
+    if pid == 0:
+      code = 0
+      try:
+        _serve(server, after_fork)
+      except BaseException as e:
+        app.logger.exception(e)
+        code = 1
+      finally:
+        os._exit(code)
+
+    children.add(pid)
+
+  def _stop(signum, frame):
+    nonlocal stopping
+    stopping = True
+
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+
+  signal.signal(signal.SIGTERM, _stop)
+  signal.signal(signal.SIGINT, _stop)
+
+  for _ in range(workers):
+    _spawn()
+
+  while children:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    except InterruptedError:
+      continue
+
+    children.discard(pid)
+
+    if not stopping:
+      app.logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+      _spawn()
+
+  server.server_close()
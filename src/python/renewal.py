@@ -0,0 +1,233 @@
+import fcntl
+import hashlib
+import heapq
+import os
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+
+from ca import NotFoundException
+
+import client as clients
+
+class RenewalScheduler():
+  """
+  Tracks the expiry of client certificates and renews them ahead of time
+
+  Client certificates are kept in a min-heap on the time they are due. The heap is filled
+  from the inventory, only reading the records written since the previous poll, so the
+  certificate tree is never scanned.
+
+  A certificate is due RENEWAL_BEFORE hours before it expires, or renew_before hours if its
+  client role sets it, moved forward by up to RENEWAL_SPREAD hours. The offset is taken from
+  the serial, so certificates issued together don't all come due at once. A certificate is
+  never due before half its lifetime has passed.
+
+  When a certificate is due an expiring event is recorded, and if its client role sets
+  auto_renew the certificate is renewed, see client._renew. Due certificates are handled in
+  batches of RENEWAL_BATCH_SIZE, RENEWAL_WORKERS at a time.
+
+  With several server processes only one of them runs the scheduler, the one holding the lock
+  on RENEWAL_LOCK.
+  """
+  def __init__(self, app):
+    self.app = app
+    self.interval = int(app.config["RENEWAL_INTERVAL"])
+    self.before = timedelta(hours=float(app.config["RENEWAL_BEFORE"]))
+    self.spread = int(float(app.config["RENEWAL_SPREAD"]) * 3600)
+    self.batch_size = int(app.config["RENEWAL_BATCH_SIZE"])
+    self.workers = int(app.config["RENEWAL_WORKERS"])
+    self.lock_path = app.config["RENEWAL_LOCK"]
+
+    self._heap = []
+    self._scheduled = set()
+    self._position = 0
+    self._events = deque(maxlen=1000)
+    self._lock = threading.Lock()
+    self._lock_fd = None
+    self._thread = None
+    self._executor = None
+
+    app.metrics.describe("certmanager_renewal_events_total", "counter", "Client certificate expiry and renewal events")
+
+  def start(self):
+    """
+    Start the background thread scheduling renewals
+    """
+    if self._thread or self.interval <= 0:
+      return
+
+    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="renewal")
+    self._thread = threading.Thread(target=self._run, name="renewal", daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    next_poll = 0
+
+    while True:
+      now = time.time()
+
+      with self.app.app_context():
+        if now >= next_poll:
+          next_poll = now + self.interval
+          try:
+            self.poll()
+          except Exception as e:
+            self.app.logger.exception(e)
+
+        due = self._pop_due(now)
+        if due:
+          list(self._executor.map(self._handle, due))
+          continue
+
+      with self._lock:
+        wake = min(next_poll, self._heap[0][0]) if self._heap else next_poll
+
+      time.sleep(max(0, wake - time.time()))
+
+  def _leader(self):
+    """
+    Take the scheduler lock, shared by all server processes
+
+    :return:
+      True if this process holds the lock
+    """
+    if self._lock_fd is None:
+      fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        os.close(fd)
+        return False
+
+      self._lock_fd = fd
+
+    return True
+
+  def _due(self, serial, not_before, not_after, cert_role):
+    before = timedelta(hours=float(cert_role["renew_before"])) if cert_role and cert_role.get("renew_before") is not None else self.before
+    offset = int(hashlib.sha256(str(serial).encode("utf8")).hexdigest()[:8], 16) % self.spread if self.spread > 0 else 0
+
+    # Never before half the lifetime, so a renewal isn't due again straight away
+    return max((not_after - before).timestamp() - offset, (not_before + (not_after - not_before) / 2).timestamp())
+
+  def poll(self):
+    """
+    Add the client certificates written since the previous poll to the heap
+    """
+    if not self._leader():
+      return
+
+    now = datetime.now(timezone.utc)
+    roles = {}
+
+    while True:
+      records = current_app.inventory.client_certs(self._position, now)
+      if not records:
+        return
+
+      for position, serial, client, role, name, not_before, not_after in records:
+        self._position = position
+
+        if (client, role) not in roles:
+          try:
+            roles[(client, role)] = clients._get_profile(client, role).cert_role if role else None
+          except NotFoundException:
+            roles[(client, role)] = None
+
+        with self._lock:
+          if serial not in self._scheduled:
+            self._scheduled.add(serial)
+            heapq.heappush(self._heap, (self._due(serial, not_before, not_after, roles[(client, role)]), serial, client, role, name, not_after))
+
+  def _pop_due(self, now):
+    due = []
+
+    with self._lock:
+      while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+        entry = heapq.heappop(self._heap)
+        self._scheduled.discard(entry[1])
+        due.append(entry)
+
+    return due
+
+  def _event(self, event, serial, client, role, name, not_after, **details):
+    self._events.append({
+      "event": event,
+      "time": datetime.now(timezone.utc).isoformat(),
+      "client": client,
+      "role": role,
+      "name": name,
+      "serial": str(serial),
+      "not_after": not_after.isoformat(),
+      **details
+    })
+    self.app.metrics.inc("certmanager_renewal_events_total", event=event)
+
+  def _handle(self, entry):
+    _, serial, client, role, name, not_after = entry
+
+    with self.app.app_context():
+      record = current_app.inventory.get(serial)
+      if record is None or record["revoked"]:
+        return
+
+      self._event("expiring", serial, client, role, name, not_after)
+
+      try:
+        cert_role = clients._get_profile(client, role).cert_role if role else None
+      except NotFoundException:
+        cert_role = None
+
+      if not cert_role or not cert_role.get("auto_renew"):
+        return
+
+      try:
+        certificate = clients._renew(client, role, name, serial)
+      except Exception as e:
+        self.app.logger.exception(e)
+        self._event("renewal_failed", serial, client, role, name, not_after, error=str(e))
+        return
+
+      if certificate:
+        self._event("renewed", serial, client, role, name, not_after,
+          renewed_serial=str(certificate.serial_number),
+          renewed_not_after=certificate["tbs_certificate"]["validity"]["not_after"].native.isoformat()
+        )
+
+  def status(self):
+    """
+    Get the upcoming renewals and the recent events
+
+    :return:
+      Dict with the number of scheduled certificates, the next ones due and the recent events, newest first
+    """
+    with self._lock:
+      upcoming = heapq.nsmallest(20, self._heap)
+      scheduled = len(self._heap)
+
+    return {
+      "leader": self._lock_fd is not None,
+      "scheduled": scheduled,
+      "upcoming": [{
+        "due": datetime.fromtimestamp(due, tz=timezone.utc).isoformat(),
+        "client": client,
+        "role": role,
+        "name": name,
+        "serial": str(serial),
+        "not_after": not_after.isoformat()
+      } for due, serial, client, role, name, not_after in upcoming],
+      "events": [*reversed(self._events)][:100]
+    }
+
+
+############################
+#### API calls
+############################
+def status():
+  return current_app.renewals.status(), 200
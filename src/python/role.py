@@ -1,9 +1,80 @@
 from flask import current_app
 
-from ca import private_key_filename, NotFoundException, InvalidValueException
+from ca import private_key_filename, NotFoundException, InvalidValueException, _key_spec
 
 import json
 
+import listing
+
+# Marks the end of a path in the path suffix trie
+_path_end = None
+
+class RolePolicy():
+  """
+  A role compiled for validating certificate names
+
+  The allowed paths are stored in a trie of their reversed characters,
+  so finding all the paths a name ends with is a single walk over the name,
+  independent of the number of paths in the role.
+  """
+  def __init__(self, name, role):
+    self.name = name
+    self.role = role
+    self.allow_wildcards = role.get("allow_wildcards", False)
+    self.allow_naked = role.get("allow_naked", False)
+    self.has_paths = bool(role.get("paths"))
+
+    # Each path end holds the index of the path in the role, as the first matching path wins
+    self._trie = {}
+    for i, path in enumerate(role.get("paths") or []):
+      node = self._trie
+      for c in reversed(path):
+        node = node.setdefault(c, {})
+      node.setdefault(_path_end, i)
+
+  def _match(self, name):
+    """
+    Find the first path the name ends with
+
+    :return:
+      Tuple of the index of the first matching path, and the index of the path equal to the name
+    """
+    node = self._trie
+    first = node.get(_path_end)
+
+    for c in reversed(name):
+      node = node.get(c)
+      if node is None:
+        return first, None
+
+      if _path_end in node and (first is None or node[_path_end] < first):
+        first = node[_path_end]
+
+    return first, node.get(_path_end)
+
+  def check(self, names):
+    """
+    Validate that certificate names conform to the rules of the role
+
+    :param names:
+      List of names, i.e. the CN and any alternative domains
+    """
+    for name in names:
+      # Check wildcard
+      if name.startswith("*") and not self.allow_wildcards:
+        raise InvalidValueException(f"Wildcards not allowed for {self.name} role")
+
+      # Check the paths
+      if self.has_paths:
+        first, naked = self._match(name)
+
+        if first is None:
+          raise InvalidValueException(f"CN {name} not allowed for {self.name} role")
+
+        # Check of naked CN
+        if first == naked and not self.allow_naked:
+          raise InvalidValueException(f"Naked CN {name} not allowed for {self.name} role")
+
 def _get_role(ca, role):
   if not current_app.secretmanager.exists(private_key_filename, path=ca):
     raise NotFoundException(f"{ca} CA not found")
@@ -13,7 +84,34 @@ def _get_role(ca, role):
   else:
     raise NotFoundException(f"{role} role not found")
 
+def _get_role_policy(ca, role):
+  """
+  Get the compiled policy for a role
+
+  The policy is kept in the role cache until the role is changed or removed.
+
+  :param ca:
+    The name of the CA the role belongs to
+
+  :param role:
+    The name of the role
+
+  :return:
+    RolePolicy for the role
+  """
+  policy = current_app.role_cache.get((ca, role))
+  if policy:
+    return policy
+
+  generation = current_app.role_cache.generation()
+
+  return current_app.role_cache.put((ca, role), RolePolicy(role, _get_role(ca, role)), generation)
 
+def _drop_role(ca, role):
+  """
+  Drop the compiled policy of a role in this process
+  """
+  current_app.role_cache.pop((ca, role))
 
 
 ############################
@@ -23,17 +121,20 @@ def put_role(ca, role, body):
   try:
     if not current_app.secretmanager.exists(private_key_filename, path=ca):
       raise NotFoundException(f"CA {ca} doesn't exist")
+    _ = _key_spec(body) # Check the key type
 
     if current_app.certmanager.exists(role, path=f"roles/{ca}"):
       # Role already exists
       value = {**_get_role(ca, role), **body}
       current_app.certmanager.write_string(role, json.dumps(value), path=f"roles/{ca}")
+      current_app.invalidation.publish("role", ca, role)
 
       return value, 200
     else:
       # Role doesn't exist, so create it
       value = json.dumps(body)
       current_app.certmanager.write_string(role, value, path=f"roles/{ca}")
+      current_app.invalidation.publish("role", ca, role)
 
       return body, 201
   except NotFoundException as e:
@@ -49,12 +150,12 @@ def get_role(ca, role):
   except InvalidValueException as e:
     return str(e), 400
 
-def list_roles(ca):
+def list_roles(ca, prefix=None, cursor=None, limit=None, format=None):
   try:
     if not current_app.secretmanager.exists(private_key_filename, path=ca):
       raise NotFoundException(f"CA {ca} doesn't exist")
 
-    return current_app.certmanager.list(path=f"roles/{ca}"), 200
+    return listing.respond(current_app.certmanager.iterate(path=f"roles/{ca}", prefix=prefix, after=cursor), limit, format)
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
@@ -69,6 +170,7 @@ def delete_role(ca, role):
       raise NotFoundException(f"{role} role not found")
 
     current_app.certmanager.delete(role, path=f"roles/{ca}"), 200
+    current_app.invalidation.publish("role", ca, role)
   except NotFoundException as e:
     return str(e), 404
   except InvalidValueException as e:
@@ -0,0 +1,220 @@
+import hashlib
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+from oscrypto import asymmetric
+from certbuilder import CertificateBuilder
+
+from asn1crypto import keys, x509
+
+from ca import _signature_hash
+from keypool import generate_pair
+
+import metrics
+
+# CA versions, certificates and private keys loaded in a signing worker process, by CA name
+_worker_cas = {}
+
+def _build_certificate(issuer, issuer_private_key, spec):
+  """
+  Build and sign a certificate
+
+  :param issuer:
+    The certificate of the signing CA
+
+  :param issuer_private_key:
+    The private key of the signing CA
+
+  :param spec:
+    Dict describing the certificate, see Signer.build
+
+  :return:
+    Tuple of the certificate, and the private key in PEM format if a key pair was generated
+  """
+  private_key_pem = None
+
+  public_key = spec.get("public_key")
+  if public_key is None:
+    public_key, private_key = generate_pair(*spec["key"])
+    private_key_pem = asymmetric.dump_private_key(private_key, None)
+  elif spec.get("private_key_pem"):
+    private_key_pem = spec["private_key_pem"]
+
+  builder = CertificateBuilder(spec["subject"], public_key)
+  builder.end_date = spec["end_date"]
+  builder.issuer = issuer
+  builder.hash_algo = _signature_hash(issuer_private_key)
+
+  # Key encipherment only applies to RSA keys
+  if public_key.algorithm != "rsa":
+    builder.key_usage = set(["digital_signature"])
+
+  if spec.get("alt_domains"):
+    builder.subject_alt_domains = spec["alt_domains"]
+  if spec.get("alt_ips"):
+    builder.subject_alt_ips = spec["alt_ips"]
+  if spec.get("extended_key_usage"):
+    builder.extended_key_usage = spec["extended_key_usage"]
+  if spec.get("crl_url"):
+    # Must match the issuing distribution point of the CRLs of the CA, see crl.RevocationList
+    builder.crl_url = spec["crl_url"]
+
+  return builder.build(issuer_private_key), private_key_pem
+
+def _worker_ca(ca, material):
+  """
+  Get the loaded CA material in a signing worker process
+
+  Each worker only loads a CA the first time it signs with it, and again once its version changes.
+
+  :param material:
+    Tuple of the version, the certificate and the private key in PEM format
+  """
+  version, certificate_pem, private_key_pem = material
+
+  loaded = _worker_cas.get(ca)
+  if loaded is None or loaded[0] != version:
+    loaded = _worker_cas[ca] = (version, asymmetric.load_certificate(certificate_pem), asymmetric.load_private_key(private_key_pem, None))
+
+  return loaded[1], loaded[2]
+
+def _build_in_worker(ca, material, spec):
+  """
+  Build and sign a certificate in a signing worker process
+
+  The spec holds the subject and public key as DER, as the ASN.1 objects can't be pickled.
+
+  :param material:
+    The CA material, see _worker_ca
+
+  :return:
+    Tuple of the certificate as DER, and the private key in PEM format if a key pair was generated
+  """
+  issuer, issuer_private_key = _worker_ca(ca, material)
+
+  spec = dict(spec)
+  if isinstance(spec["subject"], bytes):
+    spec["subject"] = x509.Name.load(spec["subject"])
+  if spec.get("public_key") is not None:
+    spec["public_key"] = keys.PublicKeyInfo.load(spec["public_key"])
+
+  certificate, private_key_pem = _build_certificate(issuer, issuer_private_key, spec)
+
+  return certificate.dump(), private_key_pem
+
+class Signer():
+  """
+  Builds and signs certificates
+
+  By default certificates are signed on the calling thread. When SIGNING_WORKERS is set,
+  key generation and signing run in a pool of worker processes instead, so signing
+  scales across cores rather than being bound by the GIL.
+  The pool is started once. The CA material is passed along with each task, tagged with a
+  version, and each worker loads a CA the first time it signs with it and keeps it until its
+  version changes. Creating, changing or removing a CA never restarts the pool.
+  """
+  def __init__(self, app):
+    self.app = app
+    self.workers = int(app.config["SIGNING_WORKERS"])
+    self.crl_base_url = app.config["CRL_BASE_URL"].rstrip("/")
+
+    self._executor = None
+    self._materials = {}
+    self._lock = threading.Lock()
+
+  def _get_executor(self):
+    with self._lock:
+      if self._executor is None:
+        self._executor = ProcessPoolExecutor(
+          max_workers=self.workers,
+          mp_context=multiprocessing.get_context("spawn")
+        )
+
+      return self._executor
+
+  def _material(self, ca, signing_ca):
+    """
+    Get the CA material passed to the signing workers, kept until the CA changes
+
+    :return:
+      Tuple of the version, the certificate and the private key in PEM format
+    """
+    with self._lock:
+      material = self._materials.get(ca)
+
+    if material is None or material[1] != signing_ca.certificate_pem:
+      private_key_pem = asymmetric.dump_private_key(signing_ca.private_key, None)
+      version = hashlib.sha256(signing_ca.certificate_pem + private_key_pem).hexdigest()
+      material = (version, signing_ca.certificate_pem, private_key_pem)
+
+      with self._lock:
+        self._materials[ca] = material
+
+    return material
+
+  def invalidate(self, ca):
+    """
+    Drop the material of a changed CA, so the signing workers load the current one the next time it is used
+    """
+    with self._lock:
+      self._materials.pop(ca, None)
+
+  def clear(self):
+    """
+    Drop the material of every CA
+    """
+    with self._lock:
+      self._materials.clear()
+
+  def build(self, ca, signing_ca, spec):
+    """
+    Build and sign a certificate
+
+    :param ca:
+      The name of the signing CA
+
+    :param signing_ca:
+      The CAMaterial of the signing CA
+
+    :param spec:
+      Dict describing the certificate:
+        subject - dict or asn1crypto.x509.Name
+        public_key - the public key to certify, or None to generate a key pair
+        private_key_pem - the private key matching the public key, if it was taken from the key pool
+        key - tuple of the algorithm and size of the key pair to generate, see ca._key_spec
+        end_date - the end date of the certificate
+        alt_domains, alt_ips, extended_key_usage - optional extensions
+
+      The CRL distribution point of the CA is always added.
+
+    :return:
+      Tuple of the asn1crypto.x509.Certificate, and the private key in PEM format if the key pair was generated
+    """
+    spec = {**spec, "crl_url": f"{self.crl_base_url}/{ca}"}
+
+    if spec.get("public_key") is None:
+      # Prefer a ready key pair from the key pool, only generating inline when signing on this thread
+      algorithm, size = spec["key"]
+      with metrics.phase("keygen"):
+        pair = self.app.keypool.take(algorithm, size, generate=self.workers <= 0)
+      if pair:
+        spec = {**spec, "public_key": pair[0], "private_key_pem": asymmetric.dump_private_key(pair[1], None)}
+
+    if self.workers <= 0:
+      with metrics.phase("sign"):
+        return _build_certificate(signing_ca.certificate, signing_ca.private_key, spec)
+
+    spec = dict(spec)
+    if isinstance(spec["subject"], x509.Name):
+      spec["subject"] = spec["subject"].dump()
+    if spec.get("public_key") is not None:
+      public_key = spec["public_key"]
+      spec["public_key"] = (public_key.asn1 if isinstance(public_key, asymmetric.PublicKey) else public_key).dump()
+
+    # Any key generation happens in the worker, and is included in the sign phase
+    with metrics.phase("sign"):
+      certificate_der, private_key_pem = self._get_executor().submit(_build_in_worker, ca, self._material(ca, signing_ca), spec).result()
+
+    return x509.Certificate.load(certificate_der), private_key_pem
@@ -0,0 +1,136 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from ca import NotFoundException, _load_ca, _load_chain
+from role import _get_role_policy
+
+class WarmUp():
+  """
+  Loads the CA material into the in-process caches before the API reports itself ready
+
+  Every CA listed by the secret manager is loaded, together with its chain and the
+  compiled policies of its roles, on WARMUP_WORKERS threads. Loading a CA also loads the
+  crypto backend, so the first requests after a deploy don't pay for any of it.
+
+  The readiness endpoint answers 503 until the warm-up has finished. A CA which fails to
+  load is logged and counted, and doesn't hold back readiness.
+  """
+  def __init__(self, app, started=None):
+    """
+    :param started:
+      time.monotonic() when the app started being created, startup is timed from it
+    """
+    self.app = app
+    self.workers = int(app.config["WARMUP_WORKERS"])
+
+    self.started = started if started is not None else time.monotonic()
+    self.startup_seconds = None
+    self.warmup_seconds = None
+    self.cas = 0
+    self.roles = 0
+    self.errors = 0
+
+    self._ready = threading.Event()
+    self._lock = threading.Lock()
+    self._thread = None
+
+    app.metrics.describe("certmanager_startup_seconds", "gauge", "Seconds from creating the app until the warm-up finished")
+    app.metrics.gauge("certmanager_startup_seconds", lambda: [({}, self.startup_seconds)] if self.startup_seconds is not None else [])
+
+  def start(self):
+    """
+    Start the warm-up in the background, unless it already ran
+    """
+    with self._lock:
+      if self._thread or self._ready.is_set():
+        return
+
+      self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+      self._thread.start()
+
+  def run(self):
+    """
+    Warm up the caches, returning once done
+    """
+    start = time.monotonic()
+
+    if self.workers > 0:
+      with self.app.app_context():
+        cas = [*current_app.secretmanager.list()]
+
+      with ThreadPoolExecutor(self.workers, thread_name_prefix="warmup") as executor:
+        for _ in executor.map(self._warm_ca, cas):
+          pass
+
+    self.warmup_seconds = time.monotonic() - start
+    self.startup_seconds = time.monotonic() - self.started
+    self._ready.set()
+
+    self.app.logger.info(
+      f"Warm-up loaded {self.cas} CAs and {self.roles} roles in {self.warmup_seconds:.3f}s, "
+      f"{self.errors} failed, ready {self.startup_seconds:.3f}s after start"
+    )
+
+  def _warm_ca(self, ca):
+    with self.app.app_context():
+      try:
+        _load_ca(ca)
+        _load_chain(ca)
+        roles = [*current_app.certmanager.iterate(path=f"roles/{ca}")]
+      except NotFoundException:
+        # Not a CA, or removed since it was listed
+        return
+      except Exception as e:
+        self.app.logger.exception(e)
+        with self._lock:
+          self.errors += 1
+        return
+
+      loaded = 0
+      for role in roles:
+        try:
+          _get_role_policy(ca, role)
+          loaded += 1
+        except NotFoundException:
+          pass
+        except Exception as e:
+          self.app.logger.exception(e)
+          with self._lock:
+            self.errors += 1
+
+      with self._lock:
+        self.cas += 1
+        self.roles += loaded
+
+  def ready(self):
+    return self._ready.is_set()
+
+  def status(self):
+    """
+    Get the readiness of the process and what the warm-up loaded
+
+    :return:
+      Dict with the readiness, the CA and role counts and the timings
+    """
+    with self._lock:
+      return {
+        "ready": self.ready(),
+        "cas": self.cas,
+        "roles": self.roles,
+        "errors": self.errors,
+        "warmup_seconds": self.warmup_seconds,
+        "startup_seconds": self.startup_seconds
+      }
+
+
+############################
+#### API calls
+############################
+def ready():
+  status = current_app.warmup.status()
+
+  return status, 200 if status["ready"] else 503
@@ -0,0 +1,48 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(base_dir, "src", "python"))
+
+api_dir = os.path.join(base_dir, "src", "api")
+
+# Background services which would otherwise run during the tests
+quiet_config = {
+  "RENEWAL_INTERVAL": "0",
+  "OCSP_REFRESH_INTERVAL": "0",
+  "WARMUP_WORKERS": "0",
+  "BATCH_WORKERS": "2"
+}
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+  """
+  Create API applications on a temporary storage tree, configured through the environment like the service
+
+  Every application created by a test shares the same storage tree.
+  """
+  monkeypatch.setenv("SECRETS_PATH", str(tmp_path / "secrets"))
+  monkeypatch.setenv("CERTS_PATH", str(tmp_path / "certs"))
+
+  def _make_app(**config):
+    for key, value in {**quiet_config, **config}.items():
+      monkeypatch.setenv(key, str(value))
+
+    from connexion_flask.main import App
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      return App(specification_dir=api_dir, run=False).application
+
+  return _make_app
+
+@pytest.fixture
+def app(make_app):
+  return make_app()
+
+@pytest.fixture
+def client(app):
+  return app.test_client()
@@ -0,0 +1,54 @@
+from asn1crypto import pem, x509
+from csrbuilder import CSRBuilder, pem_armor_csr
+from oscrypto import asymmetric
+
+def create_root(client, name="root", **fields):
+  response = client.post("/1.0/ca/root", data={
+    "name": name,
+    "common_name": name.capitalize(),
+    "organization_name": "Org",
+    "country_name": "GB",
+    "key_type": "ec",
+    **fields
+  })
+  assert response.status_code == 201, response.get_data(as_text=True)
+
+  return response.get_json()
+
+def create_intermediate(client, parent, name, **fields):
+  response = client.post(f"/1.0/ca/intermediate/{parent}", data={
+    "name": name,
+    "common_name": name.capitalize(),
+    "organization_name": "Org",
+    "country_name": "GB",
+    "key_type": "ec",
+    **fields
+  })
+  assert response.status_code == 201, response.get_data(as_text=True)
+
+  return response.get_json()
+
+def put_role(client, ca, role, **fields):
+  response = client.put(f"/1.0/ca/roles/{ca}/{role}", json={"paths": ["example.com"], "key_type": "ec", **fields})
+  assert response.status_code in [200, 201], response.get_data(as_text=True)
+
+  return response.get_json()
+
+def issue(client, ca="root", role="server", common_name="www.example.com", **fields):
+  return client.post(f"/1.0/cert/issue/{ca}/{role}", data={"common_name": common_name, "key_type": "ec", **fields})
+
+def sign(client, csr=None, ca="root", role="server", **kwargs):
+  return client.post(f"/1.0/cert/sign/{ca}/{role}", data=csr or make_csr(), content_type="text/plain", **kwargs)
+
+def make_csr(common_name="www.example.com"):
+  public_key, private_key = asymmetric.generate_pair("ec", curve="secp256r1")
+
+  return pem_armor_csr(CSRBuilder({"common_name": common_name}, public_key).build(private_key))
+
+def load_certificate(certificate_pem):
+  _, _, der = pem.unarmor(certificate_pem.encode("utf8") if isinstance(certificate_pem, str) else certificate_pem)
+
+  return x509.Certificate.load(der)
+
+def serial(response):
+  return load_certificate(response.get_json()["certificate"]).serial_number
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from admission import Limiter, bulk, interactive
+
+from helpers import create_root, put_role, issue, sign
+
+def _setup(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+class _Holder():
+  """
+  Holds admission slots of a role from other threads, until released
+  """
+  def __init__(self, app):
+    self.app = app
+    self.release = threading.Event()
+    self.threads = []
+
+  def hold(self, ca="root", role="server"):
+    admitted = threading.Event()
+
+    def _hold():
+      with self.app.app_context(), self.app.admission.admit(ca, role):
+        admitted.set()
+        self.release.wait()
+
+    t = threading.Thread(target=_hold, daemon=True)
+    t.start()
+    self.threads.append(t)
+
+    return admitted
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.release.set()
+    for t in self.threads:
+      t.join()
+
+def _wait_for(condition, timeout=5):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    assert time.monotonic() < deadline, "timed out"
+    time.sleep(0.01)
+
+def test_over_the_rate_is_rejected_with_a_429(make_app):
+  client = make_app(ADMISSION_ROLE_RATE="0.1", ADMISSION_ROLE_BURST="1").test_client()
+  _setup(client)
+
+  assert issue(client).status_code == 201
+
+  for response in [issue(client), sign(client), client.post("/1.0/cert/issue/root/server/batch", json=[{"common_name": "a.example.com"}])]:
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 10
+
+  # Other roles have their own rate
+  put_role(client, "root", "other")
+  assert issue(client, role="other").status_code == 201
+
+def test_full_queue_is_rejected_with_a_503(make_app):
+  app = make_app(ADMISSION_ROLE_CONCURRENCY="1", ADMISSION_QUEUE_SIZE="1")
+  client = app.test_client()
+  _setup(client)
+
+  with _Holder(app) as holder:
+    assert holder.hold().wait(5)
+    # Queued behind the first
+    holder.hold()
+    _wait_for(lambda: app.admission._limiters[("role", "root", "server")].depth() == 1)
+
+    for response in [issue(client), sign(client)]:
+      assert response.status_code == 503
+      assert int(response.headers["Retry-After"]) >= 1
+
+  assert issue(client).status_code == 201
+
+def test_waiting_past_the_queue_timeout_is_rejected_with_a_503(make_app):
+  app = make_app(ADMISSION_ROLE_CONCURRENCY="1", ADMISSION_QUEUE_TIMEOUT="100")
+  client = app.test_client()
+  _setup(client)
+
+  with _Holder(app) as holder:
+    assert holder.hold().wait(5)
+
+    start = time.monotonic()
+    response = issue(client)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert time.monotonic() - start >= 0.1
+
+def test_batch_items_are_paced_rather_than_rejected(make_app):
+  client = make_app(ADMISSION_ROLE_RATE="10", ADMISSION_ROLE_BURST="1").test_client()
+  _setup(client)
+
+  start = time.monotonic()
+  response = client.post("/1.0/cert/issue/root/server/batch", json=[{"common_name": f"{i}.example.com", "key_type": "ec"} for i in range(4)])
+
+  assert [result["status"] for result in response.get_json()] == [201] * 4
+  # The first item takes the burst, the rest wait for their tokens
+  assert time.monotonic() - start >= 0.25
+
+def test_limiter_admits_interactive_work_first():
+  lock = threading.Lock()
+  limiter = Limiter(1, 0)
+  order = []
+
+  with lock:
+    assert limiter.acquire(lock, interactive, None)
+
+  def _acquire(name, priority):
+    with lock:
+      limiter.acquire(lock, priority, None)
+      order.append(name)
+    with lock:
+      limiter.release(0.01)
+
+  threads = [threading.Thread(target=_acquire, args=args) for args in [("bulk-1", bulk), ("bulk-2", bulk), ("interactive", interactive)]]
+  for t in threads:
+    t.start()
+    _wait_for(lambda: limiter.depth() == threads.index(t) + 1)
+
+  with lock:
+    limiter.release(0.01)
+  for t in threads:
+    t.join()
+
+  assert order == ["interactive", "bulk-1", "bulk-2"]
+
+def test_limiter_timeout():
+  lock = threading.Lock()
+  limiter = Limiter(1, 0)
+
+  with lock:
+    assert limiter.acquire(lock, interactive, None)
+    assert not limiter.acquire(lock, interactive, 0.05)
+    assert limiter.depth() == 0
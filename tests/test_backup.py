@@ -0,0 +1,131 @@
+import io
+import tarfile
+
+from types import SimpleNamespace
+
+import pytest
+
+from asn1crypto.crl import CertificateList
+
+from backup import export_archive, restore_archive, manifest_name, InvalidArchiveException, _cli_app
+
+from helpers import create_root, create_intermediate, put_role, issue, serial
+
+def _export(app, since=None):
+  marker, chunks = export_archive(app, since)
+
+  return marker, io.BytesIO(b"".join(chunks))
+
+def _target(tmp_path, backend="file"):
+  return _cli_app(SimpleNamespace(secrets_path=str(tmp_path / "restored-secrets"), certs_path=str(tmp_path / "restored-certs"), backend=backend))
+
+def _serve(make_app, tmp_path, backend="file"):
+  return make_app(SECRETS_PATH=tmp_path / "restored-secrets", CERTS_PATH=tmp_path / "restored-certs", STORAGE_BACKEND=backend).test_client()
+
+def _crl_number(client, ca):
+  return CertificateList.load(client.get(f"/1.0/crl/{ca}").data).crl_number_value.native
+
+def _populate(client):
+  create_root(client)
+  create_intermediate(client, "root", "inter")
+  put_role(client, "inter", "server")
+
+  serials = [str(serial(issue(client, "inter"))) for _ in range(3)]
+  assert client.post(f"/1.0/cert/revoke/{serials[0]}").status_code == 200
+
+  return serials
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_export_import_round_trip(app, client, make_app, tmp_path, backend):
+  serials = _populate(client)
+  crl_number = _crl_number(client, "inter")
+
+  _, archive = _export(app)
+  manifest, counts = restore_archive(_target(tmp_path, backend), archive)
+  assert manifest["version"] == 1
+  assert counts["inventory"] == 3
+
+  restored = _serve(make_app, tmp_path, backend)
+  assert restored.get("/1.0/ca").get_json() == ["inter", "root"]
+  assert restored.get("/1.0/ca/roles/inter").get_json() == ["server"]
+  assert restored.get("/1.0/ca/ca-chain/inter").data == client.get("/1.0/ca/ca-chain/inter").data
+  assert sorted(restored.get("/1.0/cert").get_json()) == sorted(serials)
+
+  for name in serials:
+    assert restored.get(f"/1.0/cert/info/{name}").get_json() == client.get(f"/1.0/cert/info/{name}").get_json()
+
+  # The revocations and the CRL numbering carry over
+  crl = CertificateList.load(restored.get("/1.0/crl/inter").data)
+  assert [entry["user_certificate"].native for entry in crl["tbs_cert_list"]["revoked_certificates"]] == [int(serials[0])]
+  assert crl.crl_number_value.native >= crl_number
+
+  assert restored.post(f"/1.0/cert/revoke/{serials[1]}").status_code == 200
+  assert _crl_number(restored, "inter") > crl_number
+
+  # The restored CAs keep signing
+  assert issue(restored, "inter").status_code == 201
+
+def test_incremental_exports(app, client, make_app, tmp_path):
+  serials = _populate(client)
+
+  marker, full = _export(app)
+  serials.append(str(serial(issue(client, "inter"))))
+  assert client.post(f"/1.0/cert/revoke/{serials[1]}").status_code == 200
+  _, incremental = _export(app, marker)
+
+  # An incremental archive starts with its manifest too, pointing at the previous export
+  with tarfile.open(fileobj=io.BytesIO(incremental.getvalue()), mode="r|gz") as archive:
+    names = [member.name for member in archive]
+  assert names[0] == manifest_name
+
+  target = _target(tmp_path)
+  restore_archive(target, full)
+  manifest, _ = restore_archive(target, incremental)
+  assert manifest["since"] == marker
+
+  restored = _serve(make_app, tmp_path)
+  assert sorted(restored.get("/1.0/cert").get_json()) == sorted(serials)
+  assert [record["revoked"] for record in map(target.inventory.get, serials)] == [True, True, False, False]
+
+def test_restoring_never_moves_crl_numbers_back(app, client, make_app, tmp_path):
+  serials = _populate(client)
+  _, archive = _export(app)
+
+  target = _target(tmp_path)
+  restore_archive(target, io.BytesIO(archive.getvalue()))
+
+  # The restored CA revokes more certificates, then the same archive is restored again
+  restored = _serve(make_app, tmp_path)
+  for name in serials[1:]:
+    assert restored.post(f"/1.0/cert/revoke/{name}").status_code == 200
+  crl_number = _crl_number(restored, "inter")
+
+  restore_archive(target, archive)
+
+  restored = _serve(make_app, tmp_path)
+  assert _crl_number(restored, "inter") >= crl_number
+
+def test_invalid_archives(app, tmp_path):
+  with pytest.raises(InvalidArchiveException):
+    restore_archive(_target(tmp_path), io.BytesIO(b"not an archive"))
+
+  data = io.BytesIO()
+  with tarfile.open(fileobj=data, mode="w|gz") as archive:
+    info = tarfile.TarInfo("secrets/root/ca.crt")
+    info.size = 1
+    archive.addfile(info, io.BytesIO(b"x"))
+
+  with pytest.raises(InvalidArchiveException):
+    restore_archive(_target(tmp_path), io.BytesIO(data.getvalue()))
+
+  # Names escaping the storage tree are refused
+  data = io.BytesIO()
+  with tarfile.open(fileobj=data, mode="w|gz") as archive:
+    for name, value in [(manifest_name, b'{"version": 1}'), ("certs/../escape", b"x")]:
+      info = tarfile.TarInfo(name)
+      info.size = len(value)
+      archive.addfile(info, io.BytesIO(value))
+
+  with pytest.raises(InvalidArchiveException):
+    restore_archive(_target(tmp_path), io.BytesIO(data.getvalue()))
+  assert not (tmp_path / "escape").exists()
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from helpers import create_root, put_role, make_csr, load_certificate
+
+def _setup(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+def test_sign_batch_reports_the_status_of_each_item(client):
+  _setup(client)
+
+  response = client.post("/1.0/cert/sign/root/server/batch", json=[
+    make_csr("a.example.com").decode("utf8"),
+    {"csr": make_csr("b.example.com").decode("utf8"), "ttl": 24},
+    make_csr("c.example.org").decode("utf8"),
+    "not a CSR"
+  ])
+  assert response.status_code == 200
+
+  results = response.get_json()
+  assert [(r["index"], r["status"]) for r in results] == [(0, 201), (1, 201), (2, 400), (3, 400)]
+
+  certificates = [load_certificate(r["certificate"]) for r in results[:2]]
+  assert [c.subject.native["common_name"] for c in certificates] == ["a.example.com", "b.example.com"]
+  assert all(r["ca_chain"] for r in results[:2])
+  assert "c.example.org" in results[2]["error"]
+
+  # The TTL of an item wins over the batch TTL
+  validity = certificates[1]["tbs_certificate"]["validity"]
+  assert (validity["not_after"].native - validity["not_before"].native)== timedelta(hours=24)
+
+def test_issue_batch_reports_the_status_of_each_item(client):
+  _setup(client)
+
+  response = client.post("/1.0/cert/issue/root/server/batch", json=[
+    {"common_name": "a.example.com", "key_type": "ec"},
+    {"common_name": "a.example.org", "key_type": "ec"},
+    {"common_name": "b.example.com", "key_type": "ec", "alt_domains": ["c.example.com"]},
+    {"common_name": "d.example.com", "key_type": "ec", "alt_domains": ["d.example.org"]}
+  ])
+  assert response.status_code == 200
+
+  results = response.get_json()
+  assert [(r["index"], r["status"]) for r in results] == [(0, 201), (1, 400), (2, 201), (3, 400)]
+  assert all("private_key" in r for r in results if r["status"] == 201)
+  assert all("certificate" not in r for r in results if r["status"] != 201)
+
+def test_batch_results_keep_the_order_of_the_items(client):
+  _setup(client)
+
+  # More items than are in flight at once
+  names = [f"host{i}.example.com" for i in range(20)]
+  response = client.post("/1.0/cert/issue/root/server/batch", json=[{"common_name": name, "key_type": "ec"} for name in names])
+
+  results = response.get_json()
+  assert [r["index"] for r in results] == list(range(20))
+  assert [load_certificate(r["certificate"]).subject.native["common_name"] for r in results] == names
+
+def test_batch_against_a_missing_ca_or_role_fails_as_a_whole(client):
+  _setup(client)
+
+  assert client.post("/1.0/cert/issue/missing/server/batch", json=[{"common_name": "a.example.com"}]).status_code == 404
+  assert client.post("/1.0/cert/issue/root/missing/batch", json=[{"common_name": "a.example.com"}]).status_code == 404
+  assert client.post("/1.0/cert/sign/root/missing/batch", json=[make_csr().decode("utf8")]).status_code == 404
+
+def test_empty_batch(client):
+  _setup(client)
+
+  response = client.post("/1.0/cert/issue/root/server/batch", json=[])
+  assert (response.status_code, response.get_json()) == (200, [])
@@ -0,0 +1,135 @@
+import shutil
+import subprocess
+
+import pytest
+
+from asn1crypto.crl import CertificateList
+
+from helpers import create_root, create_intermediate, put_role, issue, load_certificate, serial
+
+def _openssl_verify(tmp_path, chain, certificate, crl_pem):
+  (tmp_path / "chain.pem").write_text(chain)
+  (tmp_path / "leaf.pem").write_text(certificate)
+  (tmp_path / "crl.pem").write_bytes(crl_pem)
+
+  return subprocess.run(
+    ["openssl", "verify", "-crl_check", "-CAfile", str(tmp_path / "chain.pem"), "-CRLfile", str(tmp_path / "crl.pem"), str(tmp_path / "leaf.pem")],
+    capture_output=True, text=True
+  )
+
+def test_certificates_point_at_the_crl_of_their_ca(app, client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  certificate = load_certificate(issue(client).get_json()["certificate"])
+
+  assert certificate.crl_distribution_points[0]["distribution_point"].native == [f"{app.config['CRL_BASE_URL']}/root"]
+
+@pytest.mark.skipif(shutil.which("openssl") is None, reason="needs the openssl command")
+def test_issue_revoke_verify(tmp_path, client):
+  create_root(client)
+  create_intermediate(client, "root", "inter")
+  put_role(client, "inter", "server")
+
+  response = issue(client, "inter")
+  body = response.get_json()
+
+  result = _openssl_verify(tmp_path, body["ca_chain"], body["certificate"], client.get("/1.0/crl/inter?format=pem").data)
+  assert result.returncode == 0, result.stderr
+
+  assert client.post(f"/1.0/cert/revoke/{serial(response)}").status_code == 200
+
+  result = _openssl_verify(tmp_path, body["ca_chain"], body["certificate"], client.get("/1.0/crl/inter?format=pem").data)
+  assert result.returncode != 0
+  assert "certificate revoked" in result.stderr
+
+def _crl(client, ca="root", delta=False):
+  response = client.get(f"/1.0/crl/{ca}/delta" if delta else f"/1.0/crl/{ca}")
+  assert response.status_code == 200
+
+  return CertificateList.load(response.data)
+
+def _revoked(certificate_list):
+  return {entry["user_certificate"].native: entry.crl_reason_value.native for entry in certificate_list["tbs_cert_list"]["revoked_certificates"]}
+
+def _revoke(client, response, reason=None):
+  assert client.post(f"/1.0/cert/revoke/{serial(response)}", query_string={"reason": reason} if reason else {}).status_code == 200
+
+  return serial(response)
+
+def test_crls_list_the_revoked_certificates(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  first, second, kept = issue(client), issue(client), issue(client)
+
+  assert _revoked(_crl(client)) == {}
+
+  _revoke(client, first, "key_compromise")
+  _revoke(client, second)
+
+  full = _crl(client)
+  assert _revoked(full) == {serial(first): "key_compromise", serial(second): "cessation_of_operation"}
+  assert serial(kept) not in _revoked(full)
+  assert full.freshest_crl_value is not None
+
+  # The delta holds the latest revocation, on top of the previous full CRL
+  delta = _crl(client, delta=True)
+  assert serial(second) in _revoked(delta)
+  assert delta.delta_crl_indicator_value.native < full.crl_number_value.native
+
+def test_crl_numbers_increase_with_every_revocation(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  numbers = [_crl(client).crl_number_value.native]
+  for _ in range(3):
+    _revoke(client, issue(client))
+    numbers.append(_crl(client).crl_number_value.native)
+
+  assert numbers == sorted(set(numbers))
+
+  # Serving the CRL again doesn't sign a new one
+  assert _crl(client).crl_number_value.native == numbers[-1]
+
+def test_crl_etag(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  response = client.get("/1.0/crl/root")
+  etag = response.headers["ETag"]
+  assert "max-age" in response.headers["Cache-Control"]
+  assert client.get("/1.0/crl/root", headers={"If-None-Match": etag}).status_code == 304
+
+  _revoke(client, issue(client))
+  assert client.get("/1.0/crl/root", headers={"If-None-Match": etag}).status_code == 200
+
+def test_server_processes_share_the_crl_numbering(make_app):
+  # Two server processes on the same storage
+  first_app = make_app()
+  first, second = first_app.test_client(), make_app().test_client()
+
+  create_root(first)
+  put_role(first, "root", "server")
+
+  revoked = [_revoke(first, issue(first))]
+  number = _crl(first).crl_number_value.native
+  assert _crl(second).crl_number_value.native == number
+
+  # A revocation in the second process continues the numbering and keeps the revocations of the first
+  revoked.append(_revoke(second, issue(second)))
+  assert _crl(second).crl_number_value.native > number
+  assert set(_revoked(_crl(second))) == set(revoked)
+
+  # The first process picks up the CRL signed by the second, rather than signing its own, once told of the revocation.
+  # Both applications run in the same process here, so the invalidation log wouldn't tell it.
+  first_app.crls.invalidate("root")
+  assert _crl(first).dump() == _crl(second).dump()
+
+  revoked.append(_revoke(first, issue(first)))
+  assert set(_revoked(_crl(first))) == set(revoked)
+  assert _crl(first).crl_number_value.native > _crl(second, delta=True).delta_crl_indicator_value.native
+
+def test_crl_of_a_missing_ca(client):
+  assert client.get("/1.0/crl/missing").status_code == 404
+  assert client.get("/1.0/crl/missing/delta").status_code == 404
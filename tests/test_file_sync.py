@@ -0,0 +1,124 @@
+import os
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+import manager.file
+
+from manager.file import FileCertificateManager, GroupCommit, temp_prefix
+
+def _manager(tmp_path, sync="none", window=2, max_batch=256):
+  return FileCertificateManager(SimpleNamespace(config={
+    "CERTS_PATH": str(tmp_path),
+    "FILE_SYNC": sync,
+    "FILE_SYNC_WINDOW": window,
+    "FILE_SYNC_MAX_BATCH": max_batch
+  }))
+
+def _temp_files(tmp_path):
+  return [path for path in tmp_path.rglob("*") if path.name.startswith(temp_prefix)]
+
+@pytest.mark.parametrize("sync", ["none", "batch", "always"])
+def test_writes_replace_files_whole(tmp_path, sync):
+  certmanager = _manager(tmp_path, sync)
+
+  certmanager.write_bytes("1", b"first")
+  certmanager.write_bytes("1", b"second")
+  certmanager.write_string("2", "text", path="a/b")
+  certmanager.write_many([("3", b"x", None), ("4", b"y", "a")])
+
+  assert certmanager.read_bytes("1") == b"second"
+  assert certmanager.read_string("2", path="a/b") == "text"
+  assert (certmanager.read_bytes("3"), certmanager.read_bytes("4", path="a")) == (b"x", b"y")
+  assert _temp_files(tmp_path) == []
+
+def test_unknown_sync_mode(tmp_path):
+  with pytest.raises(ValueError):
+    _manager(tmp_path, "sometimes")
+
+def test_temporary_files_are_never_listed(tmp_path):
+  certmanager = _manager(tmp_path)
+  certmanager.write_bytes("1", b"value")
+  (tmp_path / f"{temp_prefix}leftover").write_bytes(b"partial")
+
+  assert certmanager.list() == ["1"]
+  assert list(certmanager.iterate()) == ["1"]
+  assert list(certmanager.walk("")) == [("", "1")]
+
+def test_failed_writes_leave_no_temporary_files(tmp_path, monkeypatch):
+  certmanager = _manager(tmp_path, "always")
+  certmanager.write_bytes("1", b"first")
+
+  def _fail(*args, **kwargs):
+    raise OSError("disk full")
+
+  monkeypatch.setattr(manager.file, "_commit", _fail)
+
+  with pytest.raises(OSError):
+    certmanager.write_bytes("1", b"second")
+  with pytest.raises(OSError):
+    certmanager.write_many([("2", b"x", None), ("3", b"y", None)])
+
+  assert certmanager.read_bytes("1") == b"first"
+  assert not certmanager.exists("2")
+  assert _temp_files(tmp_path) == []
+
+def _concurrently(count, func):
+  results = [None] * count
+
+  def _run(i):
+    try:
+      results[i] = func(i)
+    except BaseException as e:
+      results[i] = e
+
+  threads = [threading.Thread(target=_run, args=(i,)) for i in range(count)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  return results
+
+def test_concurrent_writes_are_flushed_together(tmp_path, monkeypatch):
+  commits = []
+  commit = manager.file._commit
+
+  def _record(files, **kwargs):
+    commits.append(len(files))
+    commit(files, **kwargs)
+
+  monkeypatch.setattr(manager.file, "_commit", _record)
+
+  # A long window and a small batch, so the batches fill up
+  certmanager = _manager(tmp_path, "batch", window=5000, max_batch=4)
+  _concurrently(8, lambda i: certmanager.write_bytes(str(i), str(i).encode("utf8")))
+
+  assert commits == [4, 4]
+  assert sorted(os.listdir(tmp_path)) == sorted(str(i) for i in range(8))
+
+def test_batch_errors_reach_every_writer(tmp_path, monkeypatch):
+  def _fail(files, **kwargs):
+    raise OSError("disk full")
+
+  monkeypatch.setattr(manager.file, "_commit", _fail)
+
+  certmanager = _manager(tmp_path, "batch", window=5000, max_batch=4)
+  results = _concurrently(4, lambda i: certmanager.write_bytes(str(i), b"value"))
+
+  assert all(isinstance(result, OSError) for result in results)
+  assert os.listdir(tmp_path) == []
+
+def test_group_commit_fails_the_batch_on_any_error(monkeypatch):
+  # Not only OSErrors, or the other writers would wait forever
+  def _fail(files, **kwargs):
+    raise KeyboardInterrupt()
+
+  monkeypatch.setattr(manager.file, "_commit", _fail)
+
+  group_commit = GroupCommit(None, 5, 2)
+  results = _concurrently(2, lambda i: group_commit.commit([(f"temp{i}", f"target{i}")]))
+
+  assert all(isinstance(result, KeyboardInterrupt) for result in results)
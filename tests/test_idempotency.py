@@ -0,0 +1,122 @@
+import threading
+
+from helpers import create_root, put_role, sign, make_csr, serial
+
+def _setup(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+def _key(key):
+  return {"headers": {"Idempotency-Key": key}}
+
+def test_repeats_with_the_same_key_are_replayed(client):
+  _setup(client)
+  csr = make_csr()
+
+  first = sign(client, csr, **_key("k1"))
+  assert first.status_code == 201
+  assert "Idempotent-Replayed" not in first.headers
+
+  repeat = sign(client, csr, **_key("k1"))
+  assert repeat.status_code == 201
+  assert repeat.headers["Idempotent-Replayed"] == "true"
+  assert repeat.get_json() == first.get_json()
+
+  # Another key signs the same CSR again
+  assert serial(sign(client, csr, **_key("k2"))) != serial(first)
+
+def test_reusing_a_key_for_another_request_is_a_conflict(client):
+  _setup(client)
+  csr = make_csr()
+
+  assert sign(client, csr, **_key("k1")).status_code == 201
+  assert sign(client, make_csr(), **_key("k1")).status_code == 409
+  assert sign(client, csr, query_string={"ttl": 24}, **_key("k1")).status_code == 409
+
+  # Keys are scoped to the role
+  put_role(client, "root", "other")
+  assert sign(client, make_csr(), role="other", **_key("k1")).status_code == 201
+
+def test_stale_records_are_signed_again(client):
+  _setup(client)
+  csr = make_csr()
+
+  first = sign(client, csr, **_key("k1"))
+
+  # Once the certificate is revoked
+  assert client.post(f"/1.0/cert/revoke/{serial(first)}").status_code == 200
+  second = sign(client, csr, **_key("k1"))
+  assert "Idempotent-Replayed" not in second.headers
+  assert serial(second) != serial(first)
+  assert sign(client, csr, **_key("k1")).headers["Idempotent-Replayed"] == "true"
+
+  # Once the role changes
+  put_role(client, "root", "server", max_ttl=48)
+  third = sign(client, csr, **_key("k1"))
+  assert "Idempotent-Replayed" not in third.headers
+  assert serial(third) != serial(second)
+
+def test_without_a_key_requests_are_only_deduplicated_by_csr_when_turned_on(make_app):
+  client = make_app().test_client()
+  _setup(client)
+  csr = make_csr()
+
+  assert serial(sign(client, csr)) != serial(sign(client, csr))
+
+  client = make_app(IDEMPOTENCY_CSR_DEDUP=1).test_client()
+  first = sign(client, csr)
+  repeat = sign(client, csr)
+  assert repeat.headers["Idempotent-Replayed"] == "true"
+  assert serial(repeat) == serial(first)
+
+def test_deduplication_can_be_turned_off(make_app):
+  client = make_app(IDEMPOTENCY_WINDOW=0).test_client()
+  _setup(client)
+  csr = make_csr()
+
+  assert serial(sign(client, csr, **_key("k1"))) != serial(sign(client, csr, **_key("k1")))
+
+def test_records_are_shared_by_server_processes(make_app):
+  client = make_app().test_client()
+  _setup(client)
+  csr = make_csr()
+
+  first = sign(client, csr, **_key("k1"))
+
+  repeat = sign(make_app().test_client(), csr, **_key("k1"))
+  assert repeat.headers["Idempotent-Replayed"] == "true"
+  assert serial(repeat) == serial(first)
+
+def test_concurrent_repeats_are_signed_once(app):
+  client = app.test_client()
+  _setup(client)
+  csr = make_csr()
+  responses = [None] * 8
+
+  def _sign(i):
+    responses[i] = sign(app.test_client(), csr, **_key("k1"))
+
+  threads = [threading.Thread(target=_sign, args=(i,)) for i in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  assert all(response.status_code == 201 for response in responses)
+  assert len({serial(response) for response in responses}) == 1
+  assert sum("Idempotent-Replayed" not in response.headers for response in responses) == 1
+
+def test_rejected_requests_are_not_recorded(make_app):
+  app = make_app(ADMISSION_ROLE_RATE="0.1", ADMISSION_ROLE_BURST="1")
+  client = app.test_client()
+  _setup(client)
+  csr = make_csr()
+
+  assert sign(client, make_csr(), **_key("k1")).status_code == 201
+  assert sign(client, csr, **_key("k2")).status_code == 429
+
+  # Once the rate allows it, the request is signed rather than replayed
+  app.admission._buckets.clear()
+  response = sign(client, csr, **_key("k2"))
+  assert response.status_code == 201
+  assert "Idempotent-Replayed" not in response.headers
@@ -0,0 +1,103 @@
+import logging
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+import keypool
+
+from keypool import KeyPool
+
+def _pool(size=2, workers=1, specs="ec:secp256r1"):
+  return KeyPool(SimpleNamespace(
+    config={"KEY_POOL_SIZE": size, "KEY_POOL_WORKERS": workers, "KEY_POOL_SPECS": specs},
+    logger=logging.getLogger("keypool-test")
+  ))
+
+def _wait_for(condition, timeout=10):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    assert time.monotonic() < deadline, "timed out"
+    time.sleep(0.01)
+
+def _stats(pool, algorithm, size):
+  return next((s for s in pool.stats() if s["algorithm"] == algorithm and size in [s["size"], s["curve"]]), None)
+
+def test_workers_fill_pools_to_the_high_water_mark():
+  pool = _pool(size=3)
+  pool.start()
+
+  _wait_for(lambda: _stats(pool, "ec", "secp256r1")["depth"] == 3)
+
+  public_key, private_key = pool.take("ec", "secp256r1")
+  assert public_key.algorithm == "ec"
+
+  stats = _stats(pool, "ec", "secp256r1")
+  assert stats["hits"] == 1
+  assert stats["generated"] >= 3
+
+def test_workers_dont_fill_pools_past_the_high_water_mark():
+  pool = _pool(size=2, workers=4)
+  pool.start()
+
+  _wait_for(lambda: _stats(pool, "ec", "secp256r1")["depth"] == 2)
+  time.sleep(0.2)
+
+  stats = _stats(pool, "ec", "secp256r1")
+  assert (stats["depth"], stats["generated"]) == (2, 2)
+
+def test_empty_pool_generates_inline_and_counts_a_miss():
+  # Not started, so the pool stays empty
+  pool = _pool(size=1)
+
+  assert pool.take("ec", "secp256r1", generate=False) is None
+  public_key, _ = pool.take("ec", "secp256r1")
+  assert public_key.curve == "secp256r1"
+
+  stats = _stats(pool, "ec", "secp256r1")
+  assert (stats["hits"], stats["misses"], stats["generated"]) == (0, 2, 0)
+
+def test_unsupported_key_types_are_never_pooled():
+  pool = _pool()
+
+  assert pool.take("rsa", 1000, generate=False) is None
+  assert pool.take("ec", "secp999r1", generate=False) is None
+  assert [(s["algorithm"], s["size"] or s["curve"]) for s in pool.stats()] == [("ec", "secp256r1")]
+
+@pytest.mark.parametrize("specs", ["rsa:1000", "ec:secp999r1", "dsa:2048"])
+def test_invalid_pool_specs_are_rejected(specs):
+  with pytest.raises(ValueError):
+    _pool(specs=specs)
+
+def test_workers_survive_key_generation_errors(monkeypatch):
+  generate_pair = keypool.generate_pair
+
+  def _generate_pair(algorithm, size):
+    if size == "secp384r1":
+      raise OSError("broken")
+    return generate_pair(algorithm, size)
+
+  monkeypatch.setattr(keypool, "generate_pair", _generate_pair)
+
+  pool = _pool(size=2, specs="ec:secp384r1,ec:secp256r1")
+  pool.start()
+
+  # The broken pool is dropped, and the worker goes on filling the other one
+  _wait_for(lambda: _stats(pool, "ec", "secp384r1") is None and _stats(pool, "ec", "secp256r1")["depth"] == 2)
+  assert all(t.is_alive() for t in pool._threads)
+
+def test_issuing_takes_keys_from_the_pool(make_app):
+  from helpers import create_root, put_role, issue
+
+  app = make_app(KEY_POOL_SIZE=2, KEY_POOL_SPECS="ec:secp256r1")
+  client = app.test_client()
+  create_root(client)
+  put_role(client, "root", "server")
+  _wait_for(lambda: _stats(app.keypool, "ec", "secp256r1")["depth"] == 2)
+
+  assert issue(client).status_code == 201
+  assert _stats(app.keypool, "ec", "secp256r1")["hits"] >= 1
+
+  stats = client.get("/1.0/keypool").get_json()
+  assert {"algorithm": "ec", "curve": "secp256r1"}.items() <= next(s for s in stats if s["algorithm"] == "ec").items()
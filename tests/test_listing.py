@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from helpers import create_root, put_role, issue, serial
+
+def _pages(client, url, limit, **params):
+  """
+  Follow the cursors of a listing to its last page
+
+  :return:
+    List of the pages
+  """
+  pages = []
+  cursor = None
+
+  while True:
+    response = client.get(url, query_string={"limit": limit, **params, **({"cursor": cursor} if cursor else {})})
+    assert response.status_code == 200
+
+    body = response.get_json()
+    assert response.headers.get("X-Next-Cursor") == body["next_cursor"]
+    pages.append(body["items"])
+
+    cursor = body["next_cursor"]
+    if cursor is None:
+      return pages
+
+@pytest.mark.parametrize("layout", ["flat", "sharded"])
+def test_paging_through_certificates(make_app, layout):
+  client = make_app(CERTS_LAYOUT=layout).test_client()
+  create_root(client)
+  put_role(client, "root", "server")
+
+  serials = {str(serial(issue(client))) for _ in range(7)}
+
+  pages = _pages(client, "/1.0/cert", 3)
+  assert [len(page) for page in pages] == [3, 3, 1]
+  assert [name for page in pages for name in page] == client.get("/1.0/cert").get_json()
+  assert {name for page in pages for name in page} == serials
+
+  # A page size which divides the listing ends with a page without a cursor
+  assert [len(page) for page in _pages(client, "/1.0/cert", 7)] == [7]
+
+@pytest.mark.parametrize("layout", ["flat", "sharded"])
+def test_certificates_written_between_pages(make_app, layout):
+  client = make_app(CERTS_LAYOUT=layout).test_client()
+  create_root(client)
+  put_role(client, "root", "server")
+
+  serials = {str(serial(issue(client))) for _ in range(6)}
+
+  first = client.get("/1.0/cert", query_string={"limit": 3}).get_json()
+  added = str(serial(issue(client)))
+  rest = [name for page in _pages(client, "/1.0/cert", 3, cursor=first["next_cursor"]) for name in page]
+
+  # Nothing is listed twice or skipped, the new certificate may or may not be listed
+  listed = first["items"] + rest
+  assert len(listed) == len(set(listed))
+  assert set(listed) - {added} == serials
+
+def test_prefix_filter(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  serials = [str(serial(issue(client))) for _ in range(10)]
+  prefix = serials[0][0]
+  expected = sorted(name for name in serials if name.startswith(prefix))
+
+  assert sorted(client.get("/1.0/cert", query_string={"prefix": prefix}).get_json()) == expected
+  assert sorted(name for page in _pages(client, "/1.0/cert", 1, prefix=prefix) for name in page) == expected
+
+def test_ndjson(client):
+  for name in ["a", "b", "c"]:
+    create_root(client, name=name)
+
+  response = client.get("/1.0/ca", query_string={"format": "ndjson"})
+  assert response.mimetype == "application/x-ndjson"
+  assert [json.loads(line) for line in response.data.splitlines()] == ["a", "b", "c"]
+
+  response = client.get("/1.0/ca", query_string={"format": "ndjson", "limit": 2})
+  assert [json.loads(line) for line in response.data.splitlines()] == ["a", "b"]
+
+  response = client.get("/1.0/ca", query_string={"format": "ndjson", "limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+  assert [json.loads(line) for line in response.data.splitlines()] == ["c"]
+  assert "X-Next-Cursor" not in response.headers
+
+def test_paging_through_cas_and_roles(client):
+  for name in ["a", "b", "c", "d", "e"]:
+    create_root(client, name=name)
+    put_role(client, "a", f"role-{name}")
+
+  assert _pages(client, "/1.0/ca", 2) == [["a", "b"], ["c", "d"], ["e"]]
+  assert _pages(client, "/1.0/ca/roles/a", 4) == [["role-a", "role-b", "role-c", "role-d"], ["role-e"]]
+
+def test_page_size_is_bounded(client):
+  create_root(client)
+
+  assert client.get("/1.0/ca", query_string={"limit": 0}).status_code == 400
+  assert client.get("/1.0/ca", query_string={"limit": 1001}).status_code == 400
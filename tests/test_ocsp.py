@@ -0,0 +1,87 @@
+import base64
+
+from asn1crypto import ocsp, pem, x509
+from ocspbuilder import OCSPRequestBuilder
+from oscrypto import asymmetric
+
+from helpers import create_root, put_role, issue, load_certificate, serial
+
+def _setup(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  response = issue(client)
+  body = response.get_json()
+  certificate = load_certificate(body["certificate"])
+  issuer = next(x509.Certificate.load(der) for _, _, der in pem.unarmor(body["ca_chain"].encode("utf8"), multiple=True) if x509.Certificate.load(der).subject == certificate.issuer)
+
+  return response, asymmetric.load_certificate(certificate), asymmetric.load_certificate(issuer)
+
+def _request(certificate, issuer, hash_algorithm="sha1"):
+  builder = OCSPRequestBuilder(certificate, issuer)
+  builder.key_hash_algo = hash_algorithm
+
+  return builder.build().dump()
+
+def _basic_response(response, issuer):
+  assert response.status_code == 200
+  assert response.mimetype == "application/ocsp-response"
+
+  ocsp_response = ocsp.OCSPResponse.load(response.data)
+  assert ocsp_response["response_status"].native == "successful"
+
+  basic = ocsp_response.basic_ocsp_response
+  asymmetric.ecdsa_verify(issuer.public_key, basic["signature"].native, basic["tbs_response_data"].dump(), "sha256")
+
+  return basic["tbs_response_data"]["responses"][0]
+
+def _status(client, certificate, issuer, **kwargs):
+  return client.post("/1.0/ocsp/root", data=_request(certificate, issuer, **kwargs), content_type="application/ocsp-request")
+
+def test_good_and_revoked_responses(client):
+  issued, certificate, issuer = _setup(client)
+
+  single = _basic_response(_status(client, certificate, issuer), issuer)
+  assert single["cert_id"]["serial_number"].native == serial(issued)
+  assert single["cert_status"].name == "good"
+
+  assert client.post(f"/1.0/cert/revoke/{serial(issued)}", query_string={"reason": "key_compromise"}).status_code == 200
+
+  # The cached response is signed again on revocation
+  single = _basic_response(_status(client, certificate, issuer), issuer)
+  assert single["cert_status"].name == "revoked"
+  assert single["cert_status"].chosen["revocation_reason"].native == "key_compromise"
+
+def test_sha256_cert_ids(client):
+  _, certificate, issuer = _setup(client)
+
+  single = _basic_response(_status(client, certificate, issuer, hash_algorithm="sha256"), issuer)
+  assert single["cert_id"]["hash_algorithm"]["algorithm"].native == "sha256"
+  assert single["cert_status"].name == "good"
+
+def test_get_requests_and_caching(client):
+  _, certificate, issuer = _setup(client)
+
+  encoded = base64.urlsafe_b64encode(_request(certificate, issuer)).decode("ascii")
+  response = client.get(f"/1.0/ocsp/root/{encoded}")
+  assert _basic_response(response, issuer)["cert_status"].name == "good"
+  assert "max-age" in response.headers["Cache-Control"]
+
+  # Responses are pre-signed, so the same one is served until it is re-signed
+  assert client.get(f"/1.0/ocsp/root/{encoded}").data == response.data
+  assert client.get(f"/1.0/ocsp/root/{encoded}", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+def test_unknown_requests_are_refused(client):
+  _, certificate, issuer = _setup(client)
+
+  def _response_status(response):
+    return ocsp.OCSPResponse.load(response.data)["response_status"].native
+
+  assert _response_status(client.post("/1.0/ocsp/missing", data=_request(certificate, issuer), content_type="application/ocsp-request")) == "unauthorized"
+  assert _response_status(client.post("/1.0/ocsp/root", data=b"garbage", content_type="application/ocsp-request")) == "malformed_request"
+  assert _response_status(client.get("/1.0/ocsp/root/not-base64!")) == "malformed_request"
+
+  # A certificate the CA didn't issue
+  request = ocsp.OCSPRequest.load(_request(certificate, issuer))
+  request["tbs_request"]["request_list"][0]["req_cert"]["serial_number"] = 12345
+  assert _response_status(client.post("/1.0/ocsp/root", data=request.dump(), content_type="application/ocsp-request")) == "unauthorized"
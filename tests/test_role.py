@@ -0,0 +1,98 @@
+import itertools
+import random
+
+import pytest
+
+from ca import InvalidValueException
+from role import RolePolicy
+
+from helpers import create_root, put_role, issue
+
+def _linear_check(role, cn):
+  """
+  The path matching of roles as it was before the policies were compiled, one path after the other
+  """
+  if cn.startswith("*") and not role.get("allow_wildcards", False):
+    raise InvalidValueException("wildcard")
+
+  if role.get("paths"):
+    for path in role["paths"]:
+      if cn == path and not role.get("allow_naked", False):
+        raise InvalidValueException("naked")
+
+      if cn.endswith(path):
+        return
+
+    raise InvalidValueException("path")
+
+def _outcome(check, *args):
+  try:
+    check(*args)
+    return "allowed"
+  except InvalidValueException:
+    return "rejected"
+
+_paths = [
+  [],
+  ["example.com"],
+  ["example.com", "www.example.com"],
+  ["www.example.com", "example.com"],
+  ["com", "example.com"],
+  ["example.com", "example.org", "sub.example.org", ".internal"],
+  [""]
+]
+
+_names = [
+  "example.com", "www.example.com", "a.www.example.com", "notexample.com", "example.org",
+  "sub.example.org", "x.sub.example.org", "com", "host.internal", ".internal", "internal",
+  "*.example.com", "*.example.org", "*", "", "example.com.evil"
+]
+
+@pytest.mark.parametrize("paths,allow_naked,allow_wildcards", itertools.product(_paths, [False, True], [False, True]))
+def test_policy_matches_the_linear_scan(paths, allow_naked, allow_wildcards):
+  role = {"paths": paths, "allow_naked": allow_naked, "allow_wildcards": allow_wildcards}
+  policy = RolePolicy("server", role)
+
+  for name in _names:
+    assert _outcome(policy.check, [name]) == _outcome(_linear_check, role, name), name
+
+def test_policy_matches_the_linear_scan_on_random_roles():
+  rng = random.Random(4)
+  labels = ["a", "b", "ab", "ba", "example", "com", ""]
+
+  def _name():
+    return ".".join(rng.choice(labels) for _ in range(rng.randint(1, 4)))
+
+  for _ in range(200):
+    role = {"paths": [_name() for _ in range(rng.randint(1, 6))], "allow_naked": rng.random() < 0.5, "allow_wildcards": rng.random() < 0.5}
+    policy = RolePolicy("server", role)
+
+    for name in [_name() for _ in range(20)] + role["paths"]:
+      assert _outcome(policy.check, [name]) == _outcome(_linear_check, role, name), (role, name)
+
+def test_policy_checks_every_name():
+  policy = RolePolicy("server", {"paths": ["example.com"]})
+
+  policy.check(["a.example.com", "b.example.com"])
+  with pytest.raises(InvalidValueException):
+    policy.check(["a.example.com", "a.example.org"])
+
+def test_issuing_checks_the_common_name_and_alt_domains(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+  def _issue(common_name, alt_domains=None):
+    return client.post("/1.0/cert/issue/root/server", query_string={"alt_domains": alt_domains or []}, data={"common_name": common_name, "key_type": "ec"})
+
+  assert _issue("www.example.com", ["api.example.com"]).status_code == 201
+  assert _issue("www.example.org").status_code == 400
+  assert _issue("example.com").status_code == 400
+  assert _issue("www.example.com", ["www.example.org"]).status_code == 400
+
+def test_role_changes_apply_to_the_next_request(client):
+  create_root(client)
+  put_role(client, "root", "server")
+  assert issue(client, common_name="example.com").status_code == 400
+
+  put_role(client, "root", "server", allow_naked=True)
+  assert issue(client, common_name="example.com").status_code == 201
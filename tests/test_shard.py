@@ -0,0 +1,82 @@
+import re
+
+from manager.file import sharded_path
+from manager.shard import shard_tree
+
+from helpers import create_root, put_role, issue, serial
+
+def _setup(client):
+  create_root(client)
+  put_role(client, "root", "server")
+
+def test_sharded_path():
+  path = sharded_path("123456789")
+
+  assert re.fullmatch(r"leaf/[0-9a-f]{2}/[0-9a-f]{2}", path)
+  assert sharded_path("123456789") == path
+  assert len({sharded_path(str(i)) for i in range(1000)}) > 500
+
+def test_flat_layout_is_the_default(app, client, tmp_path):
+  _setup(client)
+  name = str(serial(issue(client)))
+
+  assert (tmp_path / "certs" / name).is_file()
+  assert not (tmp_path / "certs" / "leaf").exists()
+  assert app.inventory.get(name)["path"] is None
+
+def test_sharded_layout(make_app, tmp_path):
+  app = make_app(CERTS_LAYOUT="sharded")
+  client = app.test_client()
+  _setup(client)
+
+  name = str(serial(issue(client)))
+
+  assert (tmp_path / "certs" / sharded_path(name) / name).is_file()
+  assert not (tmp_path / "certs" / name).exists()
+  assert app.inventory.get(name)["path"] == sharded_path(name)
+
+  assert client.get(f"/1.0/cert/info/{name}").get_json()["serial"] == int(name)
+  assert client.post(f"/1.0/cert/revoke/{name}").status_code == 200
+
+def test_migration_to_the_sharded_layout(make_app, tmp_path):
+  flat = make_app()
+  client = flat.test_client()
+  _setup(client)
+  # A CA named like a serial stays where it is
+  create_root(client, name="1234")
+
+  names = [str(serial(issue(client))) for _ in range(3)]
+
+  # Certificates written flat stay readable once the layout is switched, before they are migrated
+  sharded = make_app(CERTS_LAYOUT="sharded")
+  client = sharded.test_client()
+  assert client.get(f"/1.0/cert/info/{names[0]}").status_code == 200
+  names.append(str(serial(issue(client))))
+
+  assert shard_tree(str(tmp_path / "certs"), {"root", "1234"}, sharded.inventory) == 3
+  # Running it again only moves what is left
+  assert shard_tree(str(tmp_path / "certs"), {"root", "1234"}, sharded.inventory) == 0
+
+  for name in names:
+    assert (tmp_path / "certs" / sharded_path(name) / name).is_file()
+    assert not (tmp_path / "certs" / name).exists()
+    assert sharded.inventory.get(name)["path"] == sharded_path(name)
+    assert client.get(f"/1.0/cert/info/{name}").status_code == 200
+
+  assert (tmp_path / "certs" / "1234").exists()
+  assert client.post(f"/1.0/cert/revoke/{names[0]}").status_code == 200
+
+def test_listing_in_the_sharded_layout(make_app, tmp_path):
+  client = make_app().test_client()
+  _setup(client)
+  flat = str(serial(issue(client)))
+
+  app = make_app(CERTS_LAYOUT="sharded")
+  client = app.test_client()
+  sharded = str(serial(issue(client)))
+
+  # Listing follows the configured layout, so certificates written flat are listed once migrated
+  assert client.get("/1.0/cert").get_json() == [sharded]
+
+  shard_tree(str(tmp_path / "certs"), {"root"}, app.inventory)
+  assert sorted(client.get("/1.0/cert").get_json()) == sorted([flat, sharded])